@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of formatting the sbatch options of a job.
+
+Compares ``slurm_utils.format_values`` with the previous implementation,
+which built the formatter and the job variables for every option, on a
+config of 40 options. Run with ``python tests/benchmarks/bench_format_values.py``.
+"""
+import os
+import sys
+import timeit
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(__file__), os.pardir, os.pardir, "{{cookiecutter.profile_name}}"
+    )
+)
+import slurm_utils  # noqa: E402
+from slurm_utils import Wildcards, WorkflowError  # noqa: E402
+
+JOB_PROPERTIES = {
+    "rule": "bwa_mem",
+    "jobid": 3,
+    "wildcards": {"sample": "A", "lane": "1"},
+    "params": {"ref": "hg38.fa"},
+}
+
+OPTIONS = {"mem": "4G", "time": "1:00:00", "cpus-per-task": 4}
+for i in range(17):
+    OPTIONS[f"plain-{i}"] = f"value{i}"
+for i in range(10):
+    OPTIONS[f"number-{i}"] = i
+for i in range(10):
+    OPTIONS[f"pattern-{i}"] = "{rule}_{wildcards.sample}_%d" % i
+
+
+def legacy_format_wildcards(string, job_properties):
+    """``slurm_utils.format_wildcards`` before compiled templates."""
+
+    class Job(object):
+        def __init__(self, job_properties):
+            for key in job_properties:
+                setattr(self, key, job_properties[key])
+
+    job = Job(job_properties)
+    if "params" in job_properties:
+        job._format_params = Wildcards(fromdict=job_properties["params"])
+    else:
+        job._format_params = None
+    if "wildcards" in job_properties:
+        job._format_wildcards = Wildcards(fromdict=job_properties["wildcards"])
+    else:
+        job._format_wildcards = None
+    _variables = dict()
+    _variables.update(dict(params=job._format_params, wildcards=job._format_wildcards))
+    if hasattr(job, "rule"):
+        _variables.update(dict(rule=job.rule))
+    try:
+        return slurm_utils.format(string, **_variables)
+    except NameError as ex:
+        raise WorkflowError("NameError with group job {}: {}".format(job.jobid, str(ex)))
+
+
+def legacy_format_values(dictionary, job_properties):
+    formatted = dictionary.copy()
+    for key, value in list(formatted.items()):
+        if key == "mem":
+            value = str(slurm_utils._convert_units_to_mb(value))
+        if isinstance(value, str):
+            formatted[key] = legacy_format_wildcards(value, job_properties)
+    return formatted
+
+
+def main():
+    assert legacy_format_values(OPTIONS, JOB_PROPERTIES) == slurm_utils.format_values(
+        OPTIONS, JOB_PROPERTIES
+    )
+    for name, func in (
+        ("before", legacy_format_values),
+        ("after", slurm_utils.format_values),
+    ):
+        timer = timeit.Timer(lambda: func(OPTIONS, JOB_PROPERTIES))
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=5, number=number)) / number
+        print(f"{name:>6}: {best * 1e6:8.1f} us per job ({len(OPTIONS)} options)")
+
+
+if __name__ == "__main__":
+    main()
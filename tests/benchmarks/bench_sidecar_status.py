@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Load test of the status endpoint of the sidecar.
+
+Starts ``slurm-sidecar.py`` with the mock Slurm commands of the tests and
+lets ``--clients`` concurrent clients query job states, each over its own
+connection.  A fraction ``--unknown`` of the queries is for jobs unknown to
+``squeue``, which the sidecar looks up with a ``sacct`` taking
+``--sacct-delay`` seconds.  Reports requests per second and latency
+percentiles.  Run with ``python tests/benchmarks/bench_sidecar_status.py``.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir)
+SIDECAR = os.path.join(ROOT, "{{cookiecutter.profile_name}}", "slurm-sidecar.py")
+MOCK_BIN = os.path.join(ROOT, "tests", "mock-slurm", "bin")
+KNOWN_JOBIDS = ("1044785", "1044875")
+
+
+def start_sidecar(bindir):
+    env = dict(os.environ)
+    env["PATH"] = "%s:%s:%s" % (bindir, MOCK_BIN, env.get("PATH", ""))
+    # run in the temporary directory, where the sidecar writes its journal
+    proc = subprocess.Popen(
+        [sys.executable, SIDECAR], env=env, cwd=bindir, text=True, stdout=subprocess.PIPE
+    )
+    return proc, json.loads(proc.stdout.readline())
+
+
+def client(sidecar_vars, jobids, latencies, errors):
+    headers = {"Authorization": "Bearer %s" % sidecar_vars["server_secret"]}
+    for jobid in jobids:
+        start = time.perf_counter()
+        conn = http.client.HTTPConnection("localhost", sidecar_vars["server_port"], timeout=60)
+        try:
+            conn.request("GET", "/job/status/%s" % jobid, headers=headers)
+            conn.getresponse().read()
+        except OSError:
+            errors.append(jobid)
+            continue
+        finally:
+            conn.close()
+        latencies.append(time.perf_counter() - start)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=20, help="requests per client")
+    parser.add_argument("--unknown", type=float, default=0.01)
+    parser.add_argument("--sacct-delay", type=float, default=0.5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as bindir:
+        with open(os.path.join(bindir, "sacct"), "w") as fh:
+            fh.write("#!/bin/bash\nsleep %s\n" % args.sacct_delay)
+        os.chmod(os.path.join(bindir, "sacct"), 0o755)
+        proc, sidecar_vars = start_sidecar(bindir)
+        try:
+            latencies, errors, threads = [], [], []
+            unknown = iter(range(10 ** 6))
+            for _ in range(args.clients):
+                jobids = [
+                    "9%06d" % next(unknown)
+                    if random.random() < args.unknown
+                    else random.choice(KNOWN_JOBIDS)
+                    for _ in range(args.requests)
+                ]
+                threads.append(
+                    threading.Thread(target=client, args=(sidecar_vars, jobids, latencies, errors))
+                )
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+
+    print(
+        "%d clients, %d requests (%d failed) in %.2fs"
+        % (args.clients, len(latencies) + len(errors), len(errors), elapsed)
+    )
+    print("%8.1f requests/s" % (len(latencies) / elapsed))
+    for q in (0.5, 0.9, 0.99):
+        print("%8.1f ms p%d latency" % (percentile(latencies, q) * 1e3, q * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Startup time of ``slurm-status.py`` querying the sidecar.
+
+Starts ``slurm-sidecar.py`` with the mock Slurm commands of the tests and
+runs ``slurm-status.py`` ``--runs`` times for a job known to the sidecar,
+over the Unix domain socket of the sidecar (if it has one) and over TCP.
+Reports the wall time per call next to the startup time of the bare
+interpreter.  Run with ``python tests/benchmarks/bench_status_startup.py``.
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir)
+PROFILE = os.path.join(ROOT, "{{cookiecutter.profile_name}}")
+MOCK_BIN = os.path.join(ROOT, "tests", "mock-slurm", "bin")
+
+
+def start_sidecar(env, cwd):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(PROFILE, "slurm-sidecar.py")],
+        env=env,
+        cwd=cwd,
+        text=True,
+        stdout=subprocess.PIPE,
+    )
+    return proc, json.loads(proc.stdout.readline())
+
+
+def time_runs(cmd, env, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(name, times):
+    print(
+        "%-28s %8.1f ms mean %8.1f ms p50 %8.1f ms p90"
+        % (
+            name,
+            sum(times) / len(times) * 1e3,
+            percentile(times, 0.5) * 1e3,
+            percentile(times, 0.9) * 1e3,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["PATH"] = "%s:%s" % (MOCK_BIN, env.get("PATH", ""))
+    with tempfile.TemporaryDirectory() as workdir:
+        proc, sidecar_vars = start_sidecar(env, workdir)
+        try:
+            status = [sys.executable, os.path.join(PROFILE, "slurm-status.py"), "1044785"]
+            report("python -c pass", time_runs([sys.executable, "-c", "pass"], env, args.runs))
+            variants = [("tcp", {k: v for k, v in sidecar_vars.items() if k != "server_socket"})]
+            if "server_socket" in sidecar_vars:
+                variants.insert(0, ("unix socket", sidecar_vars))
+            for name, variant in variants:
+                env["SNAKEMAKE_CLUSTER_SIDECAR_VARS"] = json.dumps(variant)
+                report("slurm-status.py (%s)" % name, time_runs(status, env, args.runs))
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+
+
+if __name__ == "__main__":
+    main()
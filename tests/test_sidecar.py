@@ -2,25 +2,121 @@
 import json
 import os
 import signal
+import socket
 import subprocess
 import tempfile
+import threading
 import time
 
 import pytest
+import requests
 
 
-@pytest.mark.slow
-@pytest.mark.timeout(60)
-def test_cluster_sidecar_smoke():
+def mock_slurm_env():
     env = dict(os.environ)
     env["PATH"] = (
         os.path.realpath(os.path.dirname(__file__) + "/mock-slurm/bin") + ":" + env.get("PATH")
     )
+    return env
+
+
+@pytest.fixture
+def profile(cookies):
+    result = cookies.bake(template=str(pytest.cookie_template))
+    assert result.exit_code == 0
+    return result.project_path
+
+
+@pytest.fixture
+def sidecar_factory(profile, tmp_path):
+    """Factory running the sidecar of a baked profile.
+
+    Keyword arguments are added to the environment of the sidecar. Returns
+    the sidecar variables.
+    """
+    procs = []
+
+    def _sidecar_factory(**kwargs):
+        env = mock_slurm_env()
+        env.update(kwargs)
+        proc = subprocess.Popen(
+            ["python", str(profile / "slurm-sidecar.py")],
+            env=env,
+            text=True,
+            stdout=subprocess.PIPE,
+            cwd=str(tmp_path),
+        )
+        procs.append(proc)
+        return json.loads(proc.stdout.readline())
+
+    yield _sidecar_factory
+    for proc in procs:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=10)
+        assert proc.returncode == 0
+
+
+@pytest.fixture
+def sidecar(sidecar_factory):
+    return sidecar_factory()
+
+
+@pytest.fixture
+def mock_commands(tmp_path):
+    """Factory writing mock commands to ``tmp_path / "bin"``.
+
+    Keyword arguments map command names to the body of a bash script. Returns
+    a ``PATH`` finding the mock commands before the mock Slurm commands.
+    """
+    bindir = tmp_path / "bin"
+
+    def _mock_commands(**scripts):
+        bindir.mkdir(exist_ok=True)
+        for name, script in scripts.items():
+            (bindir / name).write_text("#!/bin/bash\n" + script)
+            (bindir / name).chmod(0o755)
+        return "%s:%s" % (bindir, mock_slurm_env()["PATH"])
+
+    return _mock_commands
+
+
+def wait_for(condition, timeout=30, interval=0.1):
+    """Poll condition until it returns a true value, and return that value."""
+    deadline = time.time() + timeout
+    while True:
+        result = condition()
+        if result or time.time() > deadline:
+            assert result, "condition not met within %ss" % timeout
+            return result
+        time.sleep(interval)
+
+
+def job_status(url, headers):
+    """Return the status of a job, or None if the sidecar does not know it."""
+    resp = requests.get(url, headers=headers)
+    return resp.json()["status"] if resp.status_code == 200 else None
+
+
+def write_jobscript(path, **properties):
+    props = {"rule": "foo", "jobid": 1, "wildcards": {}, "resources": {}}
+    props.update(properties)
+    path.write_text(
+        "#!/bin/bash\n# properties = %s\necho hello\n" % json.dumps(props)
+    )
+    return path
+
+
+@pytest.mark.slow
+@pytest.mark.timeout(60)
+def test_cluster_sidecar_smoke(tmp_path):
+    env = mock_slurm_env()
     path_sidecar_py = os.path.realpath(
         os.path.dirname(__file__) + "/../{{cookiecutter.profile_name}}/slurm-sidecar.py"
     )
     with tempfile.TemporaryFile("w+t") as tmpf:
-        with subprocess.Popen(["python", path_sidecar_py], env=env, text=True, stdout=tmpf) as proc:
+        with subprocess.Popen(
+            ["python", path_sidecar_py], env=env, text=True, stdout=tmpf, cwd=str(tmp_path)
+        ) as proc:
             time.sleep(2)
             os.kill(proc.pid, signal.SIGTERM)
         tmpf.seek(0)
@@ -29,3 +125,756 @@ def test_cluster_sidecar_smoke():
     assert "server_port" in the_vars
     assert "server_secret" in the_vars
     assert proc.returncode == 0
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_submit(sidecar, tmp_path):
+    jobscript = write_jobscript(tmp_path / "job.sh")
+    url = "http://localhost:%d/job/submit" % sidecar["server_port"]
+    data = json.dumps({"jobscript": str(jobscript), "cwd": str(tmp_path)})
+    resp = requests.post(url, data=data)
+    assert resp.status_code == 403
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    resp = requests.post(url, data=data, headers=headers)
+    assert resp.status_code == 200
+    assert resp.json() == {"jobid": "1044900"}
+    assert (tmp_path / "logs" / "slurm" / "foo").is_dir()
+    url = "http://localhost:%d/job/status/1044900" % sidecar["server_port"]
+    resp = requests.get(url, headers=headers)
+    assert resp.status_code == 404  # registered, but not seen by squeue yet
+    # malformed or incomplete requests
+    url = "http://localhost:%d/job/submit" % sidecar["server_port"]
+    for data in ("{", "[]", json.dumps({"cwd": str(tmp_path)})):
+        assert requests.post(url, data=data, headers=headers).status_code == 400
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_submit_pool(sidecar_factory, mock_commands, tmp_path):
+    calls = tmp_path / "sbatch.calls"
+    # the first call waits for a second one to overlap with
+    path = mock_commands(
+        sbatch='echo "start $*" >> {calls}\n'
+        "for i in $(seq 300); do [ $(grep -c start {calls}) -ge 2 ] && break; sleep 0.1; done\n"
+        "sleep 0.3\n"
+        "echo end >> {calls}\n"
+        "echo 1044900\n".format(calls=calls)
+    )
+    sidecar = sidecar_factory(PATH=path, SNAKEMAKE_SLURM_SUBMIT_WORKERS="2")
+    jobscript = write_jobscript(tmp_path / "job.sh")
+    url = "http://localhost:%d/job/submit" % sidecar["server_port"]
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    data = json.dumps(
+        {
+            "jobscript": str(jobscript),
+            "cwd": str(tmp_path),
+            "sbatch_options": {"partition": "resolved", "output": "out/%j.log"},
+        }
+    )
+    responses = []
+
+    def submit():
+        responses.append(requests.post(url, data=data, headers=headers))
+
+    threads = [threading.Thread(target=submit) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [r.json() for r in responses] == [{"jobid": "1044900"}] * 6
+    running = max_running = 0
+    for line in calls.read_text().splitlines():
+        running += 1 if line.startswith("start") else -1
+        max_running = max(max_running, running)
+        if line.startswith("start"):
+            assert "--partition=resolved" in line and "--output=out/%j.log" in line
+    assert max_running == 2
+    assert (tmp_path / "out").is_dir()
+
+
+@pytest.mark.timeout(60)
+def test_submit_script_uses_sidecar(sidecar, profile, tmp_path):
+    jobscript = write_jobscript(tmp_path / "job.sh")
+    env = mock_slurm_env()
+    env["SNAKEMAKE_CLUSTER_SIDECAR_VARS"] = json.dumps(sidecar)
+    env["SNAKEMAKE_SLURM_DEBUG"] = "1"
+    res = subprocess.run(
+        ["python", str(profile / "slurm-submit.py"), str(jobscript)],
+        env=env,
+        cwd=str(tmp_path),
+        capture_output=True,
+        text=True,
+    )
+    assert res.returncode == 0
+    assert res.stdout == "1044900\n"
+    assert "submitting directly" not in res.stderr
+
+
+@pytest.mark.timeout(60)
+def test_submit_script_sidecar_unreachable(profile, tmp_path):
+    jobscript = write_jobscript(tmp_path / "job.sh")
+    env = mock_slurm_env()
+    env["SNAKEMAKE_CLUSTER_SIDECAR_VARS"] = json.dumps({"server_port": 1, "server_secret": "x"})
+    res = subprocess.run(
+        ["python", str(profile / "slurm-submit.py"), str(jobscript)],
+        env=env,
+        cwd=str(tmp_path),
+        capture_output=True,
+        text=True,
+    )
+    assert res.returncode == 0
+    assert res.stdout == "1044900\n"
+
+
+@pytest.mark.timeout(60)
+def test_submit_script_sidecar_connection_lost(profile, tmp_path):
+    # the sidecar closes the connection after reading the request
+    server = socket.socket()
+    server.bind(("localhost", 0))
+    server.listen(1)
+
+    def serve():
+        conn, _ = server.accept()
+        conn.recv(65536)
+        conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    jobscript = write_jobscript(tmp_path / "job.sh")
+    env = mock_slurm_env()
+    env["SNAKEMAKE_CLUSTER_SIDECAR_VARS"] = json.dumps(
+        {"server_port": server.getsockname()[1], "server_secret": "x"}
+    )
+    res = subprocess.run(
+        ["python", str(profile / "slurm-submit.py"), str(jobscript)],
+        env=env,
+        cwd=str(tmp_path),
+        capture_output=True,
+        text=True,
+    )
+    thread.join()
+    server.close()
+    # not submitted again, the sidecar may have submitted the job
+    assert res.returncode == 1
+    assert res.stdout == ""
+    assert "submission through sidecar failed" in res.stderr
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_submit_job_array(sidecar_factory, tmp_path):
+    sidecar = sidecar_factory(SNAKEMAKE_SLURM_ARRAY_WINDOW="1", SNAKEMAKE_SLURM_ARRAY_SIZE="3")
+    url = "http://localhost:%d/job/submit" % sidecar["server_port"]
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    jobids = []
+    for i in range(4):
+        jobscript = write_jobscript(tmp_path / ("job%d.sh" % i), jobid=i, wildcards={"i": i})
+        data = json.dumps({"jobscript": str(jobscript), "cwd": str(tmp_path)})
+        resp = requests.post(url, data=data, headers=headers)
+        assert resp.status_code == 200
+        jobids.append(resp.json()["jobid"])
+    # the fourth job no longer fits into the first array
+    assert jobids == ["1044900_0", "1044900_1", "1044900_2", "1044900_0"]
+    spool_dirs = list((tmp_path / ".snakemake" / "slurm-arrays").iterdir())
+    assert len(spool_dirs) == 2
+    tasks = sorted(p.name for d in spool_dirs for p in d.iterdir())
+    assert tasks == ["0.sh", "0.sh", "1.sh", "2.sh", "array.sh", "array.sh"]
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_submit_job_array_concurrent(sidecar_factory, mock_commands, tmp_path):
+    # arrays of different rules are submitted concurrently, jobs of the same
+    # rule wait for the array being submitted
+    calls = tmp_path / "sbatch.calls"
+    path = mock_commands(
+        sbatch="echo start >> {calls}\n"
+        "for i in $(seq 300); do [ $(grep -c start {calls}) -ge 2 ] && break; sleep 0.1; done\n"
+        "echo end >> {calls}\n"
+        "echo 1044900\n".format(calls=calls)
+    )
+    sidecar = sidecar_factory(
+        PATH=path,
+        SNAKEMAKE_SLURM_ARRAY_WINDOW="5",
+        SNAKEMAKE_SLURM_SUBMIT_WORKERS="4",
+    )
+    url = "http://localhost:%d/job/submit" % sidecar["server_port"]
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    jobids = {}
+
+    def submit(i, rule):
+        jobscript = write_jobscript(tmp_path / ("job%d.sh" % i), rule=rule, jobid=i)
+        data = json.dumps({"jobscript": str(jobscript), "cwd": str(tmp_path)})
+        jobids[i] = requests.post(url, data=data, headers=headers).json()["jobid"]
+
+    threads = [
+        threading.Thread(target=submit, args=(i, rule))
+        for i, rule in enumerate(("foo", "foo", "bar", "bar"))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls.read_text().splitlines() == ["start", "start", "end", "end"]
+    assert sorted(jobids.values()) == ["1044900_0", "1044900_0", "1044900_1", "1044900_1"]
+    assert len(list((tmp_path / ".snakemake" / "slurm-arrays").iterdir())) == 2
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_submit_packed(sidecar_factory, tmp_path):
+    sidecar = sidecar_factory(SNAKEMAKE_SLURM_PACK_RUNTIME="10")
+    url = "http://localhost:%d/job/submit" % sidecar["server_port"]
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    jobids = []
+    for i, runtime in enumerate((5, 5, 30)):
+        jobscript = write_jobscript(
+            tmp_path / ("job%d.sh" % i), jobid=i, resources={"runtime": runtime}
+        )
+        data = json.dumps({"jobscript": str(jobscript), "cwd": str(tmp_path)})
+        resp = requests.post(url, data=data, headers=headers)
+        assert resp.status_code == 200
+        jobids.append(resp.json()["jobid"])
+    assert jobids[0].startswith("pack-") and jobids[0].endswith("-0")
+    assert jobids[1] == jobids[0][:-1] + "1"
+    assert jobids[2] == "1044900"  # too long to be packed
+    (spool_dir,) = (tmp_path / ".snakemake" / "slurm-pack").iterdir()
+    assert sorted(p.name for p in (spool_dir / "queue").iterdir()) == ["000000.sh", "000001.sh"]
+    assert (spool_dir / "worker.sh").exists()
+    url = "http://localhost:%d/job/status/%s" % (sidecar["server_port"], jobids[0])
+    resp = requests.get(url, headers=headers)
+    assert resp.json() == {"status": "PENDING"}
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_packed_state_from_spool(sidecar_factory, mock_commands, tmp_path):
+    # packed jobs of an earlier sidecar, whose classes are not known
+    path = mock_commands(sacct="echo '1044785|RUNNING|0:0'\necho '1044800|COMPLETED|0:0'\n")
+    state_dir = tmp_path / ".snakemake" / "slurm-pack" / "0a1b2c3d" / "state"
+    state_dir.mkdir(parents=True)
+    (state_dir / "000000").write_text("RUNNING 1044785\n")
+    (state_dir / "000001").write_text("RUNNING 1044800\n")
+    (state_dir / "000002").write_text("COMPLETED 1044785\n")
+    sidecar = sidecar_factory(PATH=path, SNAKEMAKE_SLURM_SIDECAR_SUBMIT="0")
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    base = "http://localhost:%d" % sidecar["server_port"]
+    jobids = ["pack-0a1b2c3d-%d" % i for i in range(4)]
+    statuses = requests.post(base + "/job/status", headers=headers, json={"jobids": jobids})
+    assert statuses.json()["statuses"] == dict(
+        zip(jobids, ["RUNNING", "FAILED", "COMPLETED", "PENDING"])
+    )
+    resp = requests.get(base + "/job/status/" + jobids[2], headers=headers)
+    assert resp.json() == {"status": "COMPLETED"}
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_bulk_status(sidecar):
+    url = "http://localhost:%d/job/status" % sidecar["server_port"]
+    data = json.dumps({"jobids": ["1044785", "1044875", "42"]})
+    resp = requests.post(url, data=data)
+    assert resp.status_code == 403
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    resp = requests.post(url, data=data, headers=headers)
+    assert resp.status_code == 200
+    assert resp.json() == {"statuses": {"1044785": "RUNNING", "1044875": "RUNNING", "42": None}}
+    resp = requests.post(url, data="{}", headers=headers)
+    assert resp.status_code == 400
+
+
+@pytest.mark.timeout(60)
+def test_status_script_bulk(sidecar, profile):
+    env = mock_slurm_env()
+    env["SNAKEMAKE_CLUSTER_SIDECAR_VARS"] = json.dumps(sidecar)
+    res = subprocess.run(
+        ["python", str(profile / "slurm-status.py"), "1044785", "1044875", "42"],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert res.returncode == 0
+    assert res.stdout == "1044785 running\n1044875 running\n42 running\n"
+
+
+@pytest.mark.timeout(60)
+def test_status_script_job_not_yet_accounted(profile, mock_commands, tmp_path):
+    # slurmctld has forgotten the job before slurmdbd has recorded it
+    calls = tmp_path / "sacct.calls"
+    env = mock_slurm_env()
+    env["PATH"] = mock_commands(
+        sacct="echo >> {calls}\n"
+        "[ $(wc -l < {calls}) -ge 3 ] && echo '42|COMPLETED'\n"
+        "exit 0\n".format(calls=calls),
+        scontrol="echo 'slurm_load_jobs error: Invalid job id specified' >&2\nexit 1\n",
+    )
+    env.pop("SNAKEMAKE_CLUSTER_SIDECAR_VARS", None)
+    res = subprocess.run(
+        ["python", str(profile / "slurm-status.py"), "42"],
+        env=env,
+        cwd=str(tmp_path),
+        capture_output=True,
+        text=True,
+    )
+    assert res.stdout == "success\n"
+    assert len(calls.read_text().splitlines()) == 3
+
+
+@pytest.mark.timeout(60)
+def test_status_script_unix_socket(sidecar, profile):
+    assert os.stat(sidecar["server_socket"]).st_mode & 0o777 == 0o600
+    # without the TCP port and sacct, the job state can only come from the socket
+    env = dict(os.environ)
+    env["SNAKEMAKE_CLUSTER_SIDECAR_VARS"] = json.dumps(dict(sidecar, server_port=1))
+    res = subprocess.run(
+        ["python", str(profile / "slurm-status.py"), "1044785"],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert res.returncode == 0
+    assert res.stdout == "running\n"
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_concurrent_requests(sidecar_factory, mock_commands, tmp_path):
+    # a slow sacct must not block the status queries of other clients
+    started, release = tmp_path / "sacct.started", tmp_path / "sacct.release"
+    path = mock_commands(
+        sacct="touch %s\nwhile [ ! -e %s ]; do sleep 0.1; done\n" % (started, release)
+    )
+    sidecar = sidecar_factory(PATH=path)
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    url = "http://localhost:%d/job/status/%%s" % sidecar["server_port"]
+    slow = threading.Thread(target=requests.get, args=(url % "42",), kwargs={"headers": headers})
+    slow.start()
+    wait_for(started.exists)
+    try:
+        resp = requests.get(url % "1044785", headers=headers, timeout=30)
+        assert slow.is_alive()
+        assert resp.json() == {"status": "RUNNING"}
+    finally:
+        release.touch()
+        slow.join()
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_coalesces_sacct(sidecar_factory, mock_commands, tmp_path):
+    calls = tmp_path / "sacct.calls"
+    path = mock_commands(sacct='echo "$@" >> %s\necho "7|COMPLETED"\n' % calls)
+    sidecar = sidecar_factory(PATH=path, SNAKEMAKE_SLURM_SACCT_WINDOW="2")
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    url = "http://localhost:%d/job/status/%%s" % sidecar["server_port"]
+    jobids = [str(i) for i in range(1, 11)] * 2
+    results = {}
+
+    def query(i, jobid):
+        results[i] = requests.get(url % jobid, headers=headers).status_code
+
+    threads = [threading.Thread(target=query, args=(i, j)) for i, j in enumerate(jobids)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results.values()) == [200] * 2 + [404] * 18
+    (call,) = calls.read_text().splitlines()
+    assert sorted(call.split()[3].split(","), key=int) == [str(i) for i in range(1, 11)]
+    # negative results are cached
+    assert requests.get(url % "1", headers=headers).status_code == 404
+    assert len(calls.read_text().splitlines()) == 1
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_poll_now(sidecar_factory, mock_commands, tmp_path):
+    calls = tmp_path / "squeue.calls"
+    path = mock_commands(squeue="date +%%s.%%N >> %s\necho JOBID,STATE\n" % calls)
+    sidecar = sidecar_factory(
+        PATH=path,
+        SNAKEMAKE_SLURM_SQUEUE_WAIT="3600",
+        SNAKEMAKE_SLURM_SQUEUE_MIN_WAIT="1",
+    )
+    assert len(calls.read_text().splitlines()) == 1
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    url = "http://localhost:%d/job/register/1044900" % sidecar["server_port"]
+    assert requests.post(url, headers=headers).status_code == 200
+    wait_for(lambda: len(calls.read_text().splitlines()) == 2)
+    first, second = map(float, calls.read_text().splitlines())
+    assert second - first >= 1  # not before min wait
+    time.sleep(1.5)
+    assert len(calls.read_text().splitlines()) == 2  # idle until triggered again
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_polls_own_jobs(sidecar_factory, mock_commands, tmp_path):
+    calls = tmp_path / "squeue.calls"
+    path = mock_commands(
+        squeue='echo "$@" >> %s\n'
+        "echo JOBID,STATE\n"
+        'case "$*" in\n'
+        "  *--jobs*) echo 1044900,COMPLETED ;;\n"
+        "  *) for i in $(seq 10); do echo $i,RUNNING; done ;;\n"
+        "esac\n" % calls
+    )
+    sidecar = sidecar_factory(
+        PATH=path,
+        SNAKEMAKE_SLURM_SQUEUE_WAIT="1",
+        SNAKEMAKE_SLURM_SQUEUE_MIN_WAIT="0",
+    )
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    url = "http://localhost:%d/job/register/1044900" % sidecar["server_port"]
+    assert requests.post(url, headers=headers).status_code == 200
+    url = "http://localhost:%d/job/status/1044900" % sidecar["server_port"]
+    wait_for(lambda: job_status(url, headers) == "COMPLETED")
+    lines = calls.read_text().splitlines()
+    time.sleep(2)  # no active job left, squeue is not called anymore
+    assert calls.read_text().splitlines() == lines
+    assert "--user" in lines[0] and "--jobs" not in lines[0]
+    # the controller only filters by user
+    assert all("--jobs=1044900" in line and "--user" in line for line in lines[1:])
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_evicts_finished_jobs(sidecar_factory, mock_commands, tmp_path):
+    path = mock_commands(
+        squeue="echo JOBID,STATE\n"
+        'case "$*" in\n'
+        "  *--jobs*) echo 1044900,COMPLETED; echo 1044901,FAILED ;;\n"
+        "  *) for i in $(seq 10); do echo $i,RUNNING; done ;;\n"
+        "esac\n"
+    )
+    sidecar = sidecar_factory(
+        PATH=path,
+        SNAKEMAKE_SLURM_SQUEUE_WAIT="1",
+        SNAKEMAKE_SLURM_SQUEUE_MIN_WAIT="0",
+        SNAKEMAKE_SLURM_STATE_TTL="5",
+    )
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    base = "http://localhost:%d" % sidecar["server_port"]
+    for jobid in ("1044900", "1044901"):
+        assert requests.post(base + "/job/register/" + jobid, headers=headers).status_code == 200
+
+    def get_stats():
+        return requests.get(base + "/stats", headers=headers).json()
+
+    wait_for(lambda: get_stats()["finished"] == 2)
+    stats = get_stats()
+    assert stats["jobs"] == 2 and stats["snapshot"] == 10
+    # the final state is served once, then the job is dropped
+    url = base + "/job/status/1044900"
+    assert requests.get(url, headers=headers).json() == {"status": "COMPLETED"}
+    assert get_stats()["jobs"] == 1
+    assert requests.get(url, headers=headers).status_code == 404  # unknown to mock sacct
+    # the unqueried job is dropped after the TTL
+    wait_for(lambda: get_stats()["jobs"] == 0)
+    assert get_stats()["finished"] == 0
+    assert requests.get(base + "/stats").status_code == 403
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_reloads_journal(sidecar_factory, mock_commands, tmp_path):
+    calls = tmp_path / "squeue.calls"
+    path = mock_commands(
+        squeue='echo "$@" >> %s\n'
+        "echo JOBID,STATE\n"
+        'case "$*" in\n'
+        "  *--jobs*) echo 1044900,RUNNING; echo 1044901,COMPLETED ;;\n"
+        "  *) for i in $(seq 10); do echo $i,RUNNING; done ;;\n"
+        "esac\n" % calls,
+        sacct="echo sacct >> %s\n" % calls,
+    )
+    env = dict(
+        PATH=path,
+        SNAKEMAKE_SLURM_SQUEUE_WAIT="60",
+        SNAKEMAKE_SLURM_SQUEUE_MIN_WAIT="0",
+    )
+    sidecar = sidecar_factory(SNAKEMAKE_SLURM_JOURNAL=str(tmp_path / "journal"), **env)
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    for jobid in ("1044900", "1044901", "1044902"):
+        url = "http://localhost:%d/job/register/%s" % (sidecar["server_port"], jobid)
+        assert requests.post(url, headers=headers).status_code == 200
+    stats_url = "http://localhost:%d/stats" % sidecar["server_port"]
+    wait_for(lambda: requests.get(stats_url, headers=headers).json()["finished"] == 1)
+    # restart from the journal as left by the running sidecar
+    (tmp_path / "journal.snapshot").rename(tmp_path / "copy.snapshot")
+    (tmp_path / "journal").rename(tmp_path / "copy")
+    calls.write_text("")
+    sidecar = sidecar_factory(SNAKEMAKE_SLURM_JOURNAL=str(tmp_path / "copy"), **env)
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    base = "http://localhost:%d" % sidecar["server_port"]
+    stats = requests.get(base + "/stats", headers=headers).json()
+    assert stats["jobs"] == 3 and stats["finished"] == 1
+    assert requests.get(base + "/job/status/1044901", headers=headers).json() == {
+        "status": "COMPLETED"
+    }
+    # not seen yet, triggers a poll of the unfinished jobs only
+    assert requests.get(base + "/job/status/1044902", headers=headers).status_code == 404
+    lines = wait_for(lambda: [line for line in calls.read_text().splitlines() if "--jobs" in line])
+    assert "sacct" not in calls.read_text().splitlines()
+    assert "--jobs=1044900,1044902" in lines[-1]
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_metrics(sidecar):
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    base = "http://localhost:%d" % sidecar["server_port"]
+    assert requests.get(base + "/job/status/1044785", headers=headers).status_code == 200
+    assert requests.get(base + "/job/status/42", headers=headers).status_code == 404
+    assert requests.get(base + "/metrics").status_code == 403
+    resp = requests.get(base + "/metrics", headers=headers)
+    assert resp.status_code == 200
+    samples = dict(
+        line.rsplit(" ", 1) for line in resp.text.splitlines() if not line.startswith("#")
+    )
+    assert samples['slurm_sidecar_command_calls_total{command="squeue"}'] == "1"
+    assert samples['slurm_sidecar_command_calls_total{command="sacct"}'] == "1"
+    assert samples['slurm_sidecar_command_seconds_count{command="squeue"}'] == "1"
+    assert samples["slurm_sidecar_squeue_lines_total"] == "2"
+    assert samples['slurm_sidecar_state_lookups_total{result="hit"}'] == "1"
+    assert samples['slurm_sidecar_state_lookups_total{result="miss"}'] == "1"
+    assert samples["slurm_sidecar_jobs"] == "1"
+    key = 'slurm_sidecar_http_request_seconds_count{method="GET",route="/job/status/<jobid>"}'
+    assert samples[key] == "2"
+    assert "# TYPE slurm_sidecar_command_seconds histogram" in resp.text
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_wait(sidecar_factory, mock_commands, tmp_path):
+    state = tmp_path / "state"
+    state.write_text("PENDING")
+    path = mock_commands(squeue="echo JOBID,STATE\necho 1044900,$(cat %s)\n" % state)
+    sidecar = sidecar_factory(
+        PATH=path,
+        SNAKEMAKE_SLURM_SQUEUE_WAIT="1",
+        SNAKEMAKE_SLURM_SQUEUE_MIN_WAIT="0",
+    )
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    base = "http://localhost:%d" % sidecar["server_port"]
+    assert requests.post(base + "/job/register/1044900", headers=headers).status_code == 200
+    wait_for(lambda: job_status(base + "/job/status/1044900", headers) == "PENDING")
+    url = base + "/job/wait"
+    # a state unknown to the client is returned at once
+    data = json.dumps({"states": {"1044900": None}, "timeout": 10})
+    resp = requests.post(url, data=data, headers=headers)
+    assert resp.json() == {"statuses": {"1044900": "PENDING"}}
+    # no change within the timeout
+    data = json.dumps({"states": {"1044900": "PENDING"}, "timeout": 0.5})
+    start = time.time()
+    assert requests.post(url, data=data, headers=headers).json() == {"statuses": {}}
+    assert time.time() - start >= 0.5
+    # the change is returned as soon as squeue reports it
+    threading.Timer(0.5, state.write_text, ("RUNNING",)).start()
+    data = json.dumps({"states": {"1044900": "PENDING"}, "timeout": 30})
+    resp = requests.post(url, data=data, headers=headers)
+    assert resp.json() == {"statuses": {"1044900": "RUNNING"}}
+    assert requests.post(url, data=data).status_code == 403
+    assert requests.post(url, data="{}", headers=headers).status_code == 400
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_wait_finished_job(sidecar_factory, mock_commands, tmp_path):
+    # a finished job is looked up once, not on every wakeup of the wait
+    path = mock_commands(
+        squeue="echo JOBID,STATE\n"
+        "echo x >> %s/polls\n"
+        "[ $(($(wc -l < %s/polls) %% 2)) = 0 ] && echo 1044900,RUNNING || echo 1044900,PENDING\n"
+        % (tmp_path, tmp_path),
+        sacct="echo x >> %s/sacct.calls\necho '1044901|COMPLETED|0:0'\n" % tmp_path,
+    )
+    sidecar = sidecar_factory(
+        PATH=path,
+        SNAKEMAKE_SLURM_SQUEUE_WAIT="1",
+        SNAKEMAKE_SLURM_SQUEUE_MIN_WAIT="0",
+        SNAKEMAKE_SLURM_SQUEUE_ADAPTIVE="0",
+    )
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    base = "http://localhost:%d" % sidecar["server_port"]
+    assert requests.post(base + "/job/register/1044900", headers=headers).status_code == 200
+    data = json.dumps({"states": {"1044901": "COMPLETED"}, "timeout": 1})
+
+    def wait():
+        resp = requests.post(base + "/job/wait", data=data, headers=headers)
+        assert resp.json() == {"statuses": {}}
+        return len((tmp_path / "polls").read_text().splitlines()) >= 3
+
+    wait_for(wait, interval=0)
+    assert len((tmp_path / "sacct.calls").read_text().splitlines()) == 1
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_squeue_iterate(sidecar_factory, mock_commands, tmp_path):
+    calls = tmp_path / "squeue.calls"
+    state = tmp_path / "state"
+    state.write_text("PENDING")
+    path = mock_commands(
+        squeue='echo "$@" >> {calls}\n'
+        'case "$*" in\n'
+        "  *--iterate=1*) while true; do echo 1044900,$(cat {state}); echo; sleep 1; done ;;\n"
+        "  *) echo JOBID,STATE; echo 1044900,$(cat {state}) ;;\n"
+        "esac\n".format(calls=calls, state=state)
+    )
+    sidecar = sidecar_factory(
+        PATH=path,
+        SNAKEMAKE_SLURM_SQUEUE_WAIT="1",
+        SNAKEMAKE_SLURM_SQUEUE_ITERATE="1",
+    )
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    url = "http://localhost:%d/job/status/1044900" % sidecar["server_port"]
+    assert requests.get(url, headers=headers).json() == {"status": "PENDING"}
+    state.write_text("RUNNING")
+    wait_for(lambda: job_status(url, headers) == "RUNNING")
+    # a single streaming squeue
+    (line,) = [line for line in calls.read_text().splitlines() if "--iterate=1" in line]
+    assert "--noheader" in line
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_squeue_iterate_stalled(sidecar_factory, mock_commands, tmp_path):
+    # squeue --iterate prints nothing, as if its output was buffered
+    state = tmp_path / "state"
+    state.write_text("PENDING")
+    path = mock_commands(
+        squeue='case "$*" in\n'
+        "  *--iterate=1*) exec sleep 60 ;;\n"
+        "  *) echo JOBID,STATE; echo 1044900,$(cat {state}) ;;\n"
+        "esac\n".format(state=state)
+    )
+    sidecar = sidecar_factory(
+        PATH=path,
+        SNAKEMAKE_SLURM_SQUEUE_WAIT="1",
+        SNAKEMAKE_SLURM_SQUEUE_ITERATE="1",
+    )
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    url = "http://localhost:%d/job/status/1044900" % sidecar["server_port"]
+    assert requests.get(url, headers=headers).json() == {"status": "PENDING"}
+    state.write_text("RUNNING")
+    # polled with a regular squeue call once no frame arrived for three intervals
+    wait_for(lambda: job_status(url, headers) == "RUNNING")
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_sacct_delta(sidecar_factory, mock_commands, tmp_path):
+    calls = tmp_path / "sacct.calls"
+    path = mock_commands(
+        squeue="echo JOBID,STATE\necho 1044900,RUNNING\n",
+        sacct='echo "$@" >> %s\n'
+        "echo '1044900|COMPLETED'\n"
+        "echo '1044901|CANCELLED by 1000'\n" % calls,
+    )
+    sidecar = sidecar_factory(
+        PATH=path,
+        SNAKEMAKE_SLURM_SQUEUE_WAIT="3600",
+        SNAKEMAKE_SLURM_SQUEUE_MIN_WAIT="0",
+        SNAKEMAKE_SLURM_SACCT_DELTA_WAIT="1",
+    )
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    base = "http://localhost:%d" % sidecar["server_port"]
+    assert requests.post(base + "/job/register/1044900", headers=headers).status_code == 200
+    url = base + "/job/status/1044900"
+    wait_for(lambda: job_status(url, headers) in ("RUNNING", "COMPLETED"))
+    # squeue is not called again for an hour, sacct reports the completion
+    wait_for(lambda: job_status(url, headers) == "COMPLETED")
+    args = calls.read_text().splitlines()[0]
+    assert "--format=JobID,State" in args and "-S" in args and "--state=" in args
+
+
+@pytest.mark.timeout(60)
+def test_shared_sidecar(sidecar_factory, tmp_path):
+    runtime_dir = tmp_path / "runtime"
+    env = dict(
+        SNAKEMAKE_SLURM_SHARED_SIDECAR="1",
+        SNAKEMAKE_SLURM_SHARED_IDLE="1",
+        SNAKEMAKE_SLURM_RUNTIME_DIR=str(runtime_dir),
+    )
+    run1 = sidecar_factory(**env)
+    try:
+        run2 = sidecar_factory(**env)
+        assert run1["server_port"] == run2["server_port"]
+        assert run1["server_secret"] != run2["server_secret"]
+        (runtime_file,) = runtime_dir.glob("sidecar-*.json")
+        shared = json.loads(runtime_file.read_text())
+        base = "http://localhost:%d" % run1["server_port"]
+        for run, jobid in ((run1, "1044900"), (run2, "1044901")):
+            headers = {"Authorization": "Bearer %s" % run["server_secret"]}
+            url = base + "/job/register/" + jobid
+            assert requests.post(url, headers=headers).status_code == 200
+        headers = {"Authorization": "Bearer %s" % run2["server_secret"]}
+        stats = requests.get(base + "/stats", headers=headers).json()
+        assert stats["runs"] == 2 and stats["run_jobs"] == 1 and stats["jobs"] == 2
+        # a run does not see the jobs of another run
+        assert requests.get(base + "/job/status/1044900", headers=headers).status_code == 404
+        assert requests.post(base + "/job/register/1044900", headers=headers).status_code == 409
+        statuses = requests.post(
+            base + "/job/status", headers=headers, json={"jobids": ["1044900"]}
+        ).json()["statuses"]
+        assert statuses == {"1044900": None}
+        statuses = requests.post(
+            base + "/job/wait", headers=headers, json={"states": {"1044900": "RUNNING"}}
+        ).json()["statuses"]
+        assert statuses == {"1044900": None}
+        # runs submit in-process with their own environment
+        submit = {"jobscript": "job.sh", "cwd": str(tmp_path)}
+        assert requests.post(base + "/job/submit", headers=headers, json=submit).status_code == 503
+        # the secret of the shared sidecar only attaches runs
+        admin = {"Authorization": "Bearer %s" % shared["server_secret"]}
+        assert requests.get(base + "/stats", headers=admin).status_code == 403
+        # detaching a run drops its jobs
+        os.kill(run1["pid"], signal.SIGTERM)
+        stats_url = base + "/stats"
+        wait_for(lambda: requests.get(stats_url, headers=headers).json()["runs"] == 1)
+        assert requests.get(stats_url, headers=headers).json()["jobs"] == 1
+        # the shared sidecar exits once idle
+        os.kill(run2["pid"], signal.SIGTERM)
+        wait_for(lambda: not runtime_file.exists())
+    finally:
+        shared = list(runtime_dir.glob("sidecar-*.json"))
+        if shared:
+            os.kill(json.loads(shared[0].read_text())["pid"], signal.SIGTERM)
+
+
+@pytest.mark.timeout(60)
+def test_shared_sidecar_forgets_evicted_jobs(sidecar_factory, mock_commands, tmp_path):
+    path = mock_commands(squeue="echo JOBID,STATE\necho 1044900,COMPLETED\n")
+    runtime_dir = tmp_path / "runtime"
+    run = sidecar_factory(
+        PATH=path,
+        SNAKEMAKE_SLURM_SHARED_SIDECAR="1",
+        SNAKEMAKE_SLURM_SHARED_IDLE="1",
+        SNAKEMAKE_SLURM_RUNTIME_DIR=str(runtime_dir),
+        SNAKEMAKE_SLURM_SQUEUE_WAIT="1",
+        SNAKEMAKE_SLURM_SQUEUE_MIN_WAIT="0",
+    )
+    try:
+        base = "http://localhost:%d" % run["server_port"]
+        headers = {"Authorization": "Bearer %s" % run["server_secret"]}
+        assert requests.post(base + "/job/register/1044900", headers=headers).status_code == 200
+        wait_for(lambda: job_status(base + "/job/status/1044900", headers) == "COMPLETED")
+        # the observed job is dropped from the table and from the run
+        stats = requests.get(base + "/stats", headers=headers).json()
+        assert stats["jobs"] == 0 and stats["run_jobs"] == 0
+    finally:
+        os.kill(run["pid"], signal.SIGTERM)
+        for _ in range(100):
+            shared = list(runtime_dir.glob("sidecar-*.json"))
+            if not shared:
+                break
+            time.sleep(0.1)
+        if shared:
+            os.kill(json.loads(shared[0].read_text())["pid"], signal.SIGTERM)
+
+
+@pytest.mark.timeout(60)
+def test_sidecar_adaptive_poll_interval(sidecar_factory, mock_commands, tmp_path):
+    # every call to squeue sees all jobs change their state
+    calls = tmp_path / "squeue.calls"
+    path = mock_commands(
+        squeue="echo >> {calls}\n"
+        "n=$(wc -l < {calls})\n"
+        "state=$([ $((n % 2)) = 0 ] && echo RUNNING || echo PENDING)\n"
+        "echo JOBID,STATE\n"
+        "for i in $(seq 20); do echo $i,$state; done\n".format(calls=calls)
+    )
+    sidecar = sidecar_factory(
+        PATH=path,
+        SNAKEMAKE_SLURM_SQUEUE_WAIT="60",
+        SNAKEMAKE_SLURM_SQUEUE_MIN_WAIT="0.2",
+    )
+    headers = {"Authorization": "Bearer %s" % sidecar["server_secret"]}
+    for jobid in range(1, 21):
+        url = "http://localhost:%d/job/register/%d" % (sidecar["server_port"], jobid)
+        assert requests.post(url, headers=headers).status_code == 200
+    # a fixed interval of 60s would have allowed a single triggered call
+    wait_for(lambda: len(calls.read_text().splitlines()) >= 5)
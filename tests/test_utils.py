@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
+import fcntl
+import http.server
+import json
 import os
 import re
 import sys
 import subprocess
+import threading
 import pytest
+from unittest.mock import patch
+from urllib.parse import parse_qs
 from docker.models.containers import Container
 
 sys.path.append(
     os.path.join(os.path.dirname(__file__), os.pardir, "{{cookiecutter.profile_name}}")
 )
 from CookieCutter import CookieCutter  # noqa: E402
+import slurm_history  # noqa: E402
+import slurm_pack  # noqa: E402
+import slurm_retry  # noqa: E402
 import slurm_utils  # noqa: E402
 from slurm_utils import Time, InvalidTimeUnitError  # noqa: E402
 
@@ -42,6 +51,18 @@ def test_si_units():
         m = slurm_utils._convert_units_to_mb("1000E")
 
 
+def test_expand_array_jobid():
+    assert slurm_utils.expand_array_jobid("1234") == ["1234"]
+    assert slurm_utils.expand_array_jobid("1234_7") == ["1234_7"]
+    assert slurm_utils.expand_array_jobid("1234_[1-3,7%2]") == [
+        "1234_1",
+        "1234_2",
+        "1234_3",
+        "1234_7",
+    ]
+    assert slurm_utils.expand_array_jobid("1234_[0-4:2]") == ["1234_0", "1234_2", "1234_4"]
+
+
 class TestTime:
     def test_parse_time_seconds(self):
         s = "4s"
@@ -159,3 +180,485 @@ class TestTime:
 
         with pytest.raises(InvalidTimeUnitError):
             actual = str(Time(s))
+
+
+def test_get_sbatch_options():
+    job_properties = {
+        "rule": "bwa_mem",
+        "jobid": 3,
+        "threads": 4,
+        "wildcards": {"sample": "A"},
+        "resources": {"runtime": "1h", "mem_mb": 1000},
+        "cluster": {"comment": "{wildcards.sample}"},
+    }
+    sbatch_config = ({"account": "staff"}, {"bwa_mem": {"mem": "2G"}})
+    options = slurm_utils.get_sbatch_options(job_properties, sbatch_config)
+    assert options["account"] == "staff"
+    assert options["cpus-per-task"] == 4
+    assert options["time"] == "1:00:00"
+    assert options["mem"] == "2000"
+    assert options["comment"] == "A"
+
+
+def test_compile_cluster_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(slurm_utils, "SBATCH_CACHE", str(tmp_path / "cache"))
+    monkeypatch.setattr(slurm_utils, "_compiled_configs", {})
+    config = tmp_path / "cluster.yaml"
+    config.write_text("__default__:\n  account: staff\nfoo:\n  mem: 2G\n")
+    base, rules = slurm_utils.compile_cluster_config(str(config))
+    assert base["account"] == "staff"
+    assert rules == {"foo": {"mem": "2G"}}
+    assert (tmp_path / "cache").exists()
+
+    # a new process loads the compiled config from the cache file
+    monkeypatch.setattr(slurm_utils, "_compiled_configs", {})
+    with patch.object(slurm_utils.io, "load_configfile", side_effect=AssertionError):
+        assert slurm_utils.compile_cluster_config(str(config)) == (base, rules)
+        # touching the file without changing it does not recompile
+        os.utime(config, ns=(0, 0))
+        assert slurm_utils.compile_cluster_config(str(config)) == (base, rules)
+
+    config.write_text("__default__:\n  account: other\n")
+    base, rules = slurm_utils.compile_cluster_config(str(config))
+    assert base["account"] == "other"
+    assert rules == {}
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        "plain",
+        "{rule}",
+        "{rule}_{wildcards.sample}.log",
+        "{wildcards}",
+        "{params.files}",
+        "{params.files:q}",
+        "{wildcards.sample!r:>8}",
+        "{{literal}} {rule}",
+        "}}",
+    ],
+)
+def test_format_wildcards_compiled(pattern):
+    job_properties = {
+        "rule": "bwa_mem",
+        "jobid": 3,
+        "wildcards": {"sample": "A B", "lane": "1"},
+        "params": {"files": ["a b", "c"]},
+    }
+    variables = slurm_utils._format_variables(job_properties)
+    expected = slurm_utils.format(pattern, **variables)
+    assert slurm_utils.format_wildcards(pattern, job_properties) == expected
+
+
+def test_format_wildcards_unknown_name():
+    with pytest.raises(slurm_utils.WorkflowError):
+        slurm_utils.format_wildcards("{foo}", {"rule": "bwa_mem", "jobid": 3})
+
+
+class TestAdmissionController:
+    @pytest.fixture
+    def controller(self, tmp_path):
+        return slurm_utils.AdmissionController(
+            path=str(tmp_path / "admission.json"), max_rate=10.0, burst=2.0
+        )
+
+    def state(self, controller):
+        with open(controller.path) as fh:
+            return json.load(fh)
+
+    def test_acquire_consumes_tokens(self, controller, monkeypatch):
+        waits = []
+        monkeypatch.setattr(slurm_utils, "sleep", waits.append)
+        controller.acquire()
+        controller.acquire()
+        assert waits == []
+        assert self.state(controller)["tokens"] < 1
+
+    def test_acquire_waits_for_tokens(self, controller, monkeypatch):
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            with controller._state() as state:
+                state["tokens"] = 1.0
+
+        monkeypatch.setattr(slurm_utils, "sleep", sleep)
+        with controller._state() as state:
+            state["tokens"] = 0.0
+        controller.acquire()
+        assert len(waits) == 1
+        assert 0 < waits[0] <= 1 / 5.0
+
+    def test_record_adapts_rate(self, controller):
+        controller.record(0.1)
+        assert self.state(controller)["rate"] == 6.0
+        controller.record(0.1, "sbatch: error: Socket timed out on send/recv operation")
+        assert self.state(controller)["rate"] == 3.0
+        controller.record(5.0)
+        assert self.state(controller)["rate"] == 1.5
+
+    def test_record_queue_limit(self, controller, monkeypatch):
+        monkeypatch.setattr(slurm_utils, "_count_queued_jobs", lambda: 42)
+        controller.record(
+            0.1, "sbatch: error: QOSMaxSubmitJobPerUserLimit\nBatch job submission failed"
+        )
+        state = self.state(controller)
+        assert state["queue_limit"] == 42
+        assert state["queued"] == 42
+
+    def test_queue_check_without_lock(self, controller, monkeypatch):
+        def count_queued_jobs():
+            # squeue is called while other processes can take the lock
+            with open(controller.path) as fh:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return 10
+
+        monkeypatch.setattr(slurm_utils, "_count_queued_jobs", count_queued_jobs)
+        monkeypatch.setattr(slurm_utils, "sleep", lambda seconds: None)
+        with controller._state() as state:
+            state["queue_limit"] = state["queued"] = 42
+            state["queue_limit_time"] = state["updated"]
+        controller.acquire()
+        assert self.state(controller)["queued"] == 11
+        controller.record(0.1, "sbatch: error: QOSMaxSubmitJobPerUserLimit")
+        assert self.state(controller)["queue_limit"] == 10
+
+
+    def test_queue_drained(self, controller, monkeypatch, tmp_path):
+        bindir = tmp_path / "bin"
+        bindir.mkdir()
+        (bindir / "squeue").write_text("#!/bin/sh\n")
+        (bindir / "squeue").chmod(0o755)
+        monkeypatch.setenv("PATH", "%s:%s" % (bindir, os.environ["PATH"]))
+        waits = []
+        monkeypatch.setattr(slurm_utils, "sleep", waits.append)
+        with controller._state() as state:
+            state["queue_limit"] = state["queued"] = 42
+            state["queue_limit_time"] = state["updated"]
+        controller.acquire()
+        assert waits == []
+        assert self.state(controller)["queued"] == 1
+        controller.record(0.1, "sbatch: error: QOSMaxSubmitJobPerUserLimit")
+        state = self.state(controller)
+        assert state["queued"] == 0 and state["queue_limit"] == 1
+        controller.acquire()
+        assert waits == []
+
+
+def test_ensure_private_dir(tmp_path):
+    path = tmp_path / "runtime"
+    slurm_utils.ensure_private_dir(str(path))
+    assert path.stat().st_mode & 0o777 == 0o700
+    slurm_utils.ensure_private_dir(str(path))  # exists already
+    path.chmod(0o755)
+    with pytest.raises(PermissionError):
+        slurm_utils.ensure_private_dir(str(path))
+    link = tmp_path / "link"
+    link.symlink_to(path)
+    path.chmod(0o700)
+    with pytest.raises(PermissionError):
+        slurm_utils.ensure_private_dir(str(link))
+
+
+def test_count_queued_jobs_timeout(monkeypatch):
+    def check_output(cmd, **kwargs):
+        raise subprocess.TimeoutExpired(cmd, kwargs["timeout"])
+
+    monkeypatch.setattr(slurm_utils.sp, "check_output", check_output)
+    assert slurm_utils._count_queued_jobs() is None
+
+
+@pytest.mark.parametrize(
+    "error,kind",
+    [
+        ("sbatch: error: Batch job submission failed: Socket timed out on send/recv operation", "transient"),
+        ("sbatch: error: Batch job submission failed: Resource temporarily unavailable", "transient"),
+        ("sbatch: error: QOSMaxSubmitJobPerUserLimit", "limit"),
+        ("sbatch: error: Batch job submission failed: Invalid partition name specified", "permanent"),
+        ("sbatch: error: Batch job submission failed: Invalid account or account/partition combination specified", "permanent"),
+        ("something else", "unknown"),
+        ("", "unknown"),
+    ],
+)
+def test_classify_error(error, kind):
+    assert slurm_retry.classify_error(error) == kind
+
+
+def test_retry_policy_delay():
+    policy = slurm_retry.RetryPolicy(base_delay=1.0, max_delay=4.0)
+    for try_num, bound in ((1, 1.0), (2, 2.0), (3, 4.0), (10, 4.0)):
+        assert all(0 <= policy.delay(try_num) <= bound for _ in range(100))
+
+
+def test_retry_policy_call(tmp_path, monkeypatch):
+    monkeypatch.setattr(slurm_retry.time, "sleep", lambda seconds: None)
+    counter = tmp_path / "counter"
+    counter.write_text("")
+    script = (
+        "import sys; f = open(%r, 'a+'); f.write('x'); f.seek(0); n = len(f.read()); "
+        "sys.stderr.write(sys.argv[1]); sys.exit(n < 3)" % str(counter)
+    )
+    policy = slurm_retry.RetryPolicy(max_tries=5)
+    tries = []
+    out = policy.call(
+        [sys.executable, "-c", script, "Socket timed out"],
+        after_try=lambda seconds, error: tries.append(error),
+    )
+    assert out == ""
+    assert tries == ["Socket timed out", "Socket timed out", None]
+
+    counter.write_text("")
+    with pytest.raises(subprocess.CalledProcessError):
+        policy.call([sys.executable, "-c", script, "Invalid partition name specified"])
+    assert counter.read_text() == "x"
+
+
+def test_packed_jobid(tmp_path):
+    jobid = slurm_pack.format_jobid("0a1b2c3d", 12)
+    assert jobid == "pack-0a1b2c3d-12"
+    assert slurm_pack.is_packed_jobid(jobid)
+    assert not slurm_pack.is_packed_jobid("1044900_1")
+    assert slurm_pack.parse_jobid(jobid) == ("0a1b2c3d", 12)
+    with pytest.raises(ValueError):
+        slurm_pack.parse_jobid("pack-xyz")
+
+    assert slurm_pack.read_state(jobid, str(tmp_path)) == ("PENDING", None)
+    state_dir = tmp_path / ".snakemake" / "slurm-pack" / "0a1b2c3d" / "state"
+    state_dir.mkdir(parents=True)
+    (state_dir / "000012").write_text("COMPLETED 1044900\n")
+    assert slurm_pack.read_state(jobid, str(tmp_path)) == ("COMPLETED", "1044900")
+
+
+def test_pack_worker_claims_fitting_jobs(tmp_path):
+    spool = tmp_path / "spool"
+    for d in ("queue", "run", "state"):
+        (spool / d).mkdir(parents=True)
+    for name, seconds in (("000000", 120), ("000001", 30)):
+        (spool / "queue" / (name + ".sh")).write_text(
+            slurm_pack.JOB_SCRIPT
+            % dict(cwd=tmp_path, seconds=seconds, jobscript="true", output="/dev/null", error="/dev/null")
+        )
+        (spool / "queue" / (name + ".sh")).chmod(0o755)
+    worker = tmp_path / "worker.sh"
+    worker.write_text(slurm_pack.WORKER_SCRIPT % dict(spool=spool, walltime_seconds=60, idle=1))
+    subprocess.run(["bash", str(worker)], env=dict(os.environ, SLURM_JOB_ID="1044900"), check=True)
+    # the long job does not fit into the allocation and stays queued
+    assert os.listdir(spool / "queue") == ["000000.sh"]
+    assert (spool / "state" / "000001").read_text() == "COMPLETED 1044900\n"
+
+
+class SlurmrestdStandIn(http.server.BaseHTTPRequestHandler):
+    """Emulates the slurmrestd endpoints used by ``RestBackend``"""
+
+    protocol_version = "HTTP/1.1"
+    jobs = [
+        {"job_id": 11, "job_state": "RUNNING", "user_name": "user", "array_job_id": 0},
+        {"job_id": 12, "job_state": "PENDING", "user_name": "user", "array_job_id": 12,
+         "array_task_string": "0-2"},
+        {"job_id": 13, "job_state": "RUNNING", "user_name": "other", "array_job_id": 0},
+    ]
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _reply(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    db_jobs = [
+        {"job_id": 10, "state": {"current": "COMPLETED"}, "array": {"job_id": 0}},
+        {"job_id": 11, "state": {"current": "RUNNING"}, "array": {"job_id": 0}},
+        {"job_id": 14, "state": {"current": "FAILED"}, "array": {"job_id": 12, "task_id": 2}},
+    ]
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path, None))
+        path, _, query = self.path.partition("?")
+        steps = parse_qs(query).get("step", [""])[0].split(",")
+        if path == "/slurm/v0.0.38/job/12_1":
+            job = dict(self.jobs[1], job_id=15, array_task_id=1, array_task_string="")
+            self._reply(200, {"jobs": [job], "errors": []})
+        elif path == "/slurmdb/v0.0.38/jobs":
+            jobs = [
+                j
+                for j in self.db_jobs
+                if str(j["job_id"]) in steps
+                or "%s_%s" % (j["array"]["job_id"], j["array"].get("task_id")) in steps
+            ]
+            self._reply(200, {"jobs": jobs, "errors": []})
+        else:
+            self._reply(404, {"errors": [{"error": "Unable to find job"}]})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(("POST", self.path, body))
+        if self.headers["X-SLURM-USER-TOKEN"] != "secret":
+            self._reply(401, {"errors": [{"error": "Authentication failure"}]})
+        elif body["job"].get("partition") == "nonexistent":
+            self._reply(500, {"errors": [{"error": "Invalid partition name specified"}]})
+        else:
+            self._reply(200, {"job_id": 1044900, "errors": []})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def slurmrestd():
+    server = http.server.ThreadingHTTPServer(("localhost", 0), SlurmrestdStandIn)
+    server.connections = 0
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_rest_backend_submit(slurmrestd, tmp_path):
+    url = "http://localhost:%d" % slurmrestd.server_port
+    backend = slurm_utils.RestBackend(url, "secret", "user")
+    jobscript = tmp_path / "job.sh"
+    jobscript.write_text("#!/bin/bash\necho hello\n")
+    jobid = backend.submit(
+        str(jobscript), cwd=str(tmp_path), time="1:00:00", mem="2G", **{"job-name": "foo"}
+    )
+    assert jobid == "1044900"
+    _, path, body = slurmrestd.requests[0]
+    assert path == "/slurm/v0.0.38/job/submit"
+    assert body["script"] == "#!/bin/bash\necho hello\n"
+    assert body["job"]["name"] == "foo"
+    assert body["job"]["time_limit"] == 60
+    assert body["job"]["memory_per_node"] == 2000
+    assert body["job"]["current_working_directory"] == str(tmp_path)
+
+    with pytest.raises(slurm_utils.SlurmRestError, match="Invalid partition"):
+        backend.submit(str(jobscript), partition="nonexistent")
+    assert len(slurmrestd.requests) == 2  # permanent errors are not retried
+    with pytest.raises(slurm_utils.SlurmRestError, match="Authentication"):
+        slurm_utils.RestBackend(url, "wrong", "user").submit(str(jobscript))
+
+
+def test_rest_backend_job_states(slurmrestd):
+    url = "http://localhost:%d" % slurmrestd.server_port
+    backend = slurm_utils.RestBackend(url, "secret", "user")
+    assert backend.job_states([]) == {}
+    states = backend.job_states(["11", "12_1", "12_2", "10", "9"])
+    assert states == {"11": "RUNNING", "12_1": "PENDING", "12_2": "FAILED", "10": "COMPLETED"}
+    # one slurmdbd query for all jobs, slurmctld only for the jobs it misses
+    assert [r[1] for r in slurmrestd.requests] == [
+        "/slurmdb/v0.0.38/jobs?step=11%2C12_1%2C12_2%2C10%2C9",
+        "/slurm/v0.0.38/job/12_1",
+        "/slurm/v0.0.38/job/9",
+    ]
+    # all requests are sent over one keep-alive connection
+    assert slurmrestd.connections == 1
+
+
+def test_history_parse_sacct():
+    output = (
+        "100|COMPLETED|00:10:30|\n"
+        "100.batch|COMPLETED|00:10:30|1500M\n"
+        "100.0|COMPLETED|00:10:00|2048K\n"
+        "101|OUT_OF_MEMORY|1-00:00:00|\n"
+        "101.batch|OUT_OF_MEMORY|1-00:00:00|4G\n"
+        "102|RUNNING|00:01:00|\n"
+        "103|CANCELLED by 1000|00:00:00|\n"
+    )
+    assert slurm_history.JobHistory.parse_sacct(output) == {
+        "100": ("COMPLETED", 10.5, 1500.0),
+        "101": ("OUT_OF_MEMORY", 1440.0, 4000.0),
+        "103": ("CANCELLED", 0.0, None),
+    }
+
+
+def test_history_rightsize(tmp_path):
+    history = slurm_history.JobHistory(str(tmp_path / "history.sqlite"), min_samples=3)
+    options = {"mem": "8G", "time": "2:00:00", "partition": "normal"}
+    output = ""
+    for i in range(3):
+        history.record(str(100 + i), "foo", options)
+        assert history.rightsize("foo", options) == options  # history too thin
+        output += "%d|COMPLETED|00:%02d:00|\n%d.batch|COMPLETED|00:%02d:00|%dM\n" % (
+            100 + i, 10 + i, 100 + i, 10 + i, 1000 + 100 * i
+        )
+    history.record("pack-0a1b2c3d-0", "foo", options)  # not recorded
+    with patch.object(slurm_history.JobHistory, "_sacct", return_value=history.parse_sacct(output)):
+        history.harvest()
+    assert history.rightsize("foo", options) == {"mem": 1440, "time": 15, "partition": "normal"}
+    assert history.rightsize("bar", options) == options
+    # never raise the declared requests
+    assert history.rightsize("foo", {"mem": 1000, "time": 10}) == {"mem": 1000, "time": 10}
+
+    history.record("103", "foo", options)
+    with patch.object(
+        slurm_history.JobHistory, "_sacct", return_value={"103": ("OUT_OF_MEMORY", 5.0, 8000.0)}
+    ):
+        history.harvest()  # too soon after the previous harvest
+        assert history.rightsize("foo", options)["mem"] == 1440
+        history.harvest(force=True)
+    assert history.rightsize("foo", options) == {"mem": "8G", "time": 15, "partition": "normal"}
+
+
+def test_history_rightsize_min_mem(tmp_path):
+    history = slurm_history.JobHistory(str(tmp_path / "history.sqlite"), min_samples=3)
+    options = {"mem": "8G", "time": "2:00:00"}
+    output = ""
+    for i in range(3):
+        history.record(str(100 + i), "foo", options)
+        output += "%d|COMPLETED|00:01:00|\n%d.batch|COMPLETED|00:01:00|0\n" % (100 + i, 100 + i)
+    with patch.object(slurm_history.JobHistory, "_sacct", return_value=history.parse_sacct(output)):
+        history.harvest()
+    assert history.rightsize("foo", options)["mem"] == 100
+
+
+def test_open_history_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(slurm_history, "RIGHTSIZE", True)
+    monkeypatch.setattr(slurm_history, "_histories", {})
+    history = slurm_history.open_history(str(tmp_path))
+    assert slurm_history.open_history(str(tmp_path)) is history
+    # the connection is shared by the submission threads of the sidecar
+    thread = threading.Thread(target=history.record, args=("100", "foo", {"mem": "2G"}))
+    thread.start()
+    thread.join()
+    assert history.claim_harvest()
+    assert not history.claim_harvest()
+    with patch.object(slurm_history.JobHistory, "_sacct", return_value={}) as sacct:
+        slurm_history.harvest_all()  # not due yet
+        assert not sacct.called
+        history.harvest(force=True)
+        assert sacct.call_args[0][0] == ["100"]
+
+
+def test_joblog_buckets():
+    joblog = slurm_utils.JobLog({"rule": "foo", "jobid": 3})
+    joblog.uid = "16fd2706-8baf-433b-82eb-8c7fada847da"
+    assert joblog.pattern_replace("logs/%r/%h/%S") == "logs/foo/16/fd/16fd2706"
+    bucket = joblog.pattern_replace("%H")
+    assert re.match(r"^[0-9a-f]{2}/[0-9a-f]{2}$", bucket)
+    assert slurm_utils.JobLog({"rule": "bar", "jobid": 3}).pattern_replace("%H") == bucket
+
+
+def test_get_sbatch_options_logmerge():
+    job_properties = {"rule": "foo", "jobid": 3, "wildcards": {}, "resources": {}}
+    with patch.object(CookieCutter, "get_cluster_logpath", return_value="logs/%r/%j"):
+        options = slurm_utils.get_sbatch_options(job_properties, ({}, {}))
+        assert options["output"] == "logs/foo/%j.out"
+        assert options["error"] == "logs/foo/%j.err"
+        with patch.object(CookieCutter, "get_cluster_logmerge", return_value=True):
+            options = slurm_utils.get_sbatch_options(job_properties, ({}, {}))
+    assert options["output"] == "logs/foo/%j.out"
+    assert "error" not in options
+
+
+def test_ensure_dirs_exist(tmp_path, monkeypatch):
+    monkeypatch.setattr(slurm_utils, "_existing_dirs", set())
+    slurm_utils.ensure_dirs_exist(str(tmp_path / "logs" / "foo" / "1.out"))
+    assert (tmp_path / "logs" / "foo").is_dir()
+    with patch.object(slurm_utils.os, "makedirs", side_effect=AssertionError):
+        slurm_utils.ensure_dirs_exist(str(tmp_path / "logs" / "foo" / "2.out"))
@@ -34,6 +34,10 @@ class CookieCutter:
     def get_cluster_logpath() -> str:
         return "{{cookiecutter.cluster_logpath}}"
 
+    @staticmethod
+    def get_cluster_logmerge() -> bool:
+        return "{{cookiecutter.cluster_logmerge}}" == "yes"
+
     @staticmethod
     def get_cluster_jobname() -> str:
         return "{{cookiecutter.cluster_jobname}}"
@@ -23,19 +23,116 @@ If the sidecar is queried for a job ID that it has not seen yet then it will
 perform a query to ``sacct`` such that it works well if Snakemake "resume
 external job" feature.  The ``slurm-submit.py`` script of the Snakemake profile
 will register all jobs via POST with this sidecar.
+
+Registering a job, or querying a registered job that ``squeue`` has not
+reported yet, triggers an early ``squeue`` call, though not earlier than
+``SNAKEMAKE_SLURM_SQUEUE_MIN_WAIT`` seconds (default 10) after the last one.
+
+With ``SNAKEMAKE_SLURM_SQUEUE_ADAPTIVE=1`` (the default), the interval
+between ``squeue`` calls adapts between ``SNAKEMAKE_SLURM_SQUEUE_MIN_WAIT``
+and ``SNAKEMAKE_SLURM_SQUEUE_WAIT``: it shrinks while many jobs change
+their state and grows while few do, but never below ten times the duration
+of the ``squeue`` call, nor above a third of ``SNAKEMAKE_SLURM_MIN_JOB_AGE``
+(default 300, Slurm's default ``MinJobAge``).
+
+With ``SNAKEMAKE_SLURM_SACCT_DELTA_WAIT`` set to a number of seconds, the
+sidecar also calls ``sacct`` that often for the jobs of the user that
+finished since the previous call.  Finished jobs are then not missed if
+they leave ``squeue`` before the next poll, and ``SNAKEMAKE_SLURM_SQUEUE_WAIT``
+is not bounded by ``SNAKEMAKE_SLURM_MIN_JOB_AGE``.
+
+With ``SNAKEMAKE_SLURM_SHARED_SIDECAR=1``, the sidecar started by Snakemake
+attaches the run to a sidecar shared by all runs of the user with this
+profile, started with ``--shared`` if not running yet, and stays attached
+until terminated.  The shared sidecar is found through a runtime file in
+``slurm_utils.RUNTIME_DIR`` and keeps a namespace of jobs per run.
+
+With ``SNAKEMAKE_SLURM_UNIX_SOCKET=1`` (the default), the sidecar also
+serves its HTTP API on a Unix domain socket in ``slurm_utils.RUNTIME_DIR``,
+passed as ``server_socket`` in ``SNAKEMAKE_CLUSTER_SIDECAR_VARS``.
+``slurm-status.py`` and ``slurm-submit.py`` connect to it with
+``slurm_sidecar_client.py``, which saves the TCP connection set-up.
+
+With ``SNAKEMAKE_SLURM_SQUEUE_ITERATE=1``, a single long-running
+``squeue --iterate`` process prints the jobs of the user every
+``SNAKEMAKE_SLURM_SQUEUE_WAIT`` seconds instead, and its output is parsed as
+it arrives, frame by frame.  This saves starting ``squeue`` for every poll, but the interval
+does not adapt and registrations do not trigger early polls.
+
+The sidecar also runs the submission service: ``slurm-submit.py`` forwards
+the jobscript path via POST to ``/job/submit`` and the sidecar resolves the
+sbatch options, calls ``sbatch`` and registers the job.  This saves each
+submission the start-up cost of loading Snakemake and the profile
+configuration.  Clients may also send the resolved sbatch options along.
+Submissions are run by ``SNAKEMAKE_SLURM_SUBMIT_WORKERS`` threads (default
+4), with at most ``SNAKEMAKE_SLURM_SUBMIT_RATE`` calls to ``sbatch`` per
+second (default 10), and the job is registered before its ID is returned.
+Note that ``sbatch`` is then run with the environment of the
+sidecar process.  Set ``SNAKEMAKE_SLURM_SIDECAR_SUBMIT=0`` to disable the
+service, in which case ``slurm-submit.py`` submits jobs itself.
+
+Jobs submitted through the sidecar can be coalesced into Slurm job arrays
+by setting ``SNAKEMAKE_SLURM_ARRAY_WINDOW`` to a number of seconds.  The
+first job with a given set of sbatch options reserves a held job array of
+``SNAKEMAKE_SLURM_ARRAY_SIZE`` tasks (default 100).  Jobs of the same rule
+with identical sbatch options (except for the job name) that are submitted
+within the window are assigned the next free task and receive the external
+job ID ``<arrayid>_<task>``.  When the window has passed or the array is
+full, the unused tasks are cancelled and the array is released.  As a job
+only starts once its array is released, jobs are delayed by up to the window.
+
+Short jobs submitted through the sidecar can be packed into shared worker
+allocations by setting ``SNAKEMAKE_SLURM_PACK_RUNTIME`` to a runtime in
+minutes.  Jobs with a ``time`` of at most this runtime (or of the rule's
+``pack_runtime`` resource, if set) are queued per resource class and run
+one after another by up to ``SNAKEMAKE_SLURM_PACK_WORKERS`` worker
+allocations of ``SNAKEMAKE_SLURM_PACK_WALLTIME`` minutes (see
+``slurm_pack.py``).  Packed jobs have the external job ID
+``pack-<class>-<n>``; their state is read from the spool directory.
+
+Only the jobs registered with or queried from the sidecar are kept in its
+state table.  Finished jobs are dropped once Snakemake has queried their
+final state, or ``SNAKEMAKE_SLURM_STATE_TTL`` seconds (default 3600) after
+they finished, such that the memory use of a long-running sidecar stays
+flat.  GET ``/stats`` reports the size of the table, and GET ``/metrics``
+the call counts, latencies and failures of ``squeue`` and ``sacct``, the
+state lookups and the HTTP request latencies in the Prometheus text format.
+POST ``/job/wait`` blocks until the state of one of the given jobs
+changes, at most ``SNAKEMAKE_SLURM_WAIT_MAX`` seconds (default 120).
+
+Changes of the state table are appended to the journal
+``SNAKEMAKE_SLURM_JOURNAL`` (default ``.snakemake/slurm-sidecar.journal``,
+empty to disable), which is periodically compacted into a snapshot.  A
+restarted sidecar reloads the table from it and resumes polling the jobs
+that have not finished, without looking them up with ``sacct``.
 """
 
+import fcntl
+import functools
+import hashlib
 import http.server
 import json
 import logging
 import os
+import select
+import shlex
+import shutil
 import subprocess
 import sys
 import signal
+import socketserver
 import time
 import threading
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from snakemake.utils import read_job_properties
 
+import slurm_history
+import slurm_pack
+import slurm_retry
+import slurm_sidecar_client
+import slurm_utils
 from CookieCutter import CookieCutter
 
 
@@ -47,6 +144,68 @@ LOG_REQUESTS = bool(int(os.environ.get("SNAKEMAKE_SLURM_LOG_REQUESTS", "0")))
 SQUEUE_CMD = os.environ.get("SNAKEMAKE_SLURM_SQUEUE_CMD", "squeue")
 #: Number of seconds to wait between ``squeue`` calls.
 SQUEUE_WAIT = int(os.environ.get("SNAKEMAKE_SLURM_SQUEUE_WAIT", "60"))
+#: Minimal number of seconds between ``squeue`` calls triggered early.
+SQUEUE_MIN_WAIT = float(os.environ.get("SNAKEMAKE_SLURM_SQUEUE_MIN_WAIT", "10"))
+#: Whether to adapt the interval between ``squeue`` calls to the job churn.
+SQUEUE_ADAPTIVE = bool(int(os.environ.get("SNAKEMAKE_SLURM_SQUEUE_ADAPTIVE", "1")))
+#: Whether to stream the job states from a long-running ``squeue --iterate``.
+SQUEUE_ITERATE = bool(int(os.environ.get("SNAKEMAKE_SLURM_SQUEUE_ITERATE", "0")))
+#: Seconds between ``sacct`` polls for finished jobs, ``0`` disables them.
+SACCT_DELTA_WAIT = float(os.environ.get("SNAKEMAKE_SLURM_SACCT_DELTA_WAIT", "0"))
+#: Slurm's ``MinJobAge``, finished jobs are polled within a third of it.
+MIN_JOB_AGE = int(os.environ.get("SNAKEMAKE_SLURM_MIN_JOB_AGE", "300"))
+#: Seconds to keep finished jobs whose state Snakemake has not queried.
+STATE_TTL = float(os.environ.get("SNAKEMAKE_SLURM_STATE_TTL", "3600"))
+#: Journal of the job state table, relative to the working directory; empty disables it.
+JOURNAL = os.environ.get(
+    "SNAKEMAKE_SLURM_JOURNAL", os.path.join(".snakemake", "slurm-sidecar.journal")
+)
+#: Maximal number of seconds a ``/job/wait`` request blocks.
+WAIT_MAX = float(os.environ.get("SNAKEMAKE_SLURM_WAIT_MAX", "120"))
+#: Whether the runs of the user share one sidecar per profile.
+SHARED = bool(int(os.environ.get("SNAKEMAKE_SLURM_SHARED_SIDECAR", "0")))
+#: Seconds a shared sidecar without attached runs keeps running.
+SHARED_IDLE = float(os.environ.get("SNAKEMAKE_SLURM_SHARED_IDLE", "60"))
+#: Whether the sidecar also listens on a Unix domain socket.
+UNIX_SOCKET = bool(int(os.environ.get("SNAKEMAKE_SLURM_UNIX_SOCKET", "1")))
+#: Seconds between the heartbeats of the runs attached to a shared sidecar.
+RUN_HEARTBEAT = 30
+#: Seconds after which a run without heartbeat is detached from a shared sidecar.
+RUN_TIMEOUT = 3 * RUN_HEARTBEAT
+#: Whether the sidecar submits jobs on behalf of ``slurm-submit.py``.
+SIDECAR_SUBMIT = bool(int(os.environ.get("SNAKEMAKE_SLURM_SIDECAR_SUBMIT", "1")))
+#: Number of threads of the sidecar calling ``sbatch`` concurrently.
+SUBMIT_WORKERS = int(os.environ.get("SNAKEMAKE_SLURM_SUBMIT_WORKERS", "4"))
+#: Maximal ``sbatch`` calls per second of the sidecar, ``0`` disables the limit.
+SUBMIT_RATE = float(os.environ.get("SNAKEMAKE_SLURM_SUBMIT_RATE", "10"))
+#: Seconds to collect submitted jobs into one job array, ``0`` disables arrays.
+ARRAY_WINDOW = float(os.environ.get("SNAKEMAKE_SLURM_ARRAY_WINDOW", "0"))
+#: Number of tasks to reserve per job array.
+ARRAY_SIZE = int(os.environ.get("SNAKEMAKE_SLURM_ARRAY_SIZE", "100"))
+#: Seconds to collect lookups of unknown jobs into one ``sacct`` call.
+SACCT_WINDOW = float(os.environ.get("SNAKEMAKE_SLURM_SACCT_WINDOW", "0.1"))
+#: Seconds to remember that ``sacct`` does not know a job.
+SACCT_NEGATIVE_TTL = float(os.environ.get("SNAKEMAKE_SLURM_SACCT_NEGATIVE_TTL", "10"))
+#: Jobs running at most this many minutes are packed, ``0`` disables packing.
+PACK_RUNTIME = int(os.environ.get("SNAKEMAKE_SLURM_PACK_RUNTIME", "0"))
+#: Walltime in minutes of the worker allocations running packed jobs.
+PACK_WALLTIME = int(os.environ.get("SNAKEMAKE_SLURM_PACK_WALLTIME", "60"))
+#: Maximal number of worker allocations per resource class.
+PACK_WORKERS = int(os.environ.get("SNAKEMAKE_SLURM_PACK_WORKERS", "4"))
+#: Seconds an idle worker waits for new jobs before it exits.
+PACK_IDLE = int(os.environ.get("SNAKEMAKE_SLURM_PACK_IDLE", "60"))
+
+#: Slurm job states of jobs that have not finished yet.
+ACTIVE_STATES = (
+    "PENDING",
+    "CONFIGURING",
+    "RUNNING",
+    "COMPLETING",
+    "SUSPENDED",
+    "REQUEUED",
+    "RESIZING",
+    "STAGE_OUT",
+)
 
 logger = logging.getLogger(__name__)
 if DEBUG:
@@ -54,37 +213,593 @@ if DEBUG:
     logger.setLevel(logging.DEBUG)
 
 
+class Metrics:
+    """Counters and histograms exported in the Prometheus text format
+
+    Metrics are declared in ``help`` with their type and help text, and
+    identified by their name and labels.
+    """
+
+    #: Upper bounds of the histogram buckets in seconds.
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    #: Dict mapping metric names to their type and help text.
+    help = {
+        "slurm_sidecar_command_calls_total": (
+            "counter",
+            "Calls to Slurm commands (and slurmrestd) by the sidecar.",
+        ),
+        "slurm_sidecar_command_failures_total": (
+            "counter",
+            "Failed calls to Slurm commands by reason (timeout or error).",
+        ),
+        "slurm_sidecar_command_seconds": ("histogram", "Duration of calls to Slurm commands."),
+        "slurm_sidecar_squeue_lines_total": ("counter", "Job lines parsed from squeue output."),
+        "slurm_sidecar_state_lookups_total": (
+            "counter",
+            "Job state queries answered from the state table (hit) or looked up (miss).",
+        ),
+        "slurm_sidecar_http_request_seconds": (
+            "histogram",
+            "Duration of HTTP requests by route.",
+        ),
+        "slurm_sidecar_jobs": ("gauge", "Jobs in the state table."),
+        "slurm_sidecar_finished_jobs": ("gauge", "Finished jobs in the state table."),
+        "slurm_sidecar_snapshot_jobs": ("gauge", "Other jobs of the user from squeue --user."),
+        "slurm_sidecar_state_table_bytes": ("gauge", "Approximate size of the state table."),
+        "slurm_sidecar_poll_interval_seconds": ("gauge", "Current interval between polls."),
+    }
+
+    def __init__(self):
+        #: Lock protecting the attributes below.
+        self.lock = threading.Lock()
+        #: Dict mapping name and labels of counters to their value.
+        self.counters = {}
+        #: Dict mapping name and labels of histograms to bucket counts, sum and count.
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        """Increment counter ``name`` by ``amount``."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Add ``value`` to histogram ``name``."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def record_call(self, command, seconds, error):
+        """Record a call to ``command``, suitable as ``after_try`` of a ``RetryPolicy``."""
+        self.inc("slurm_sidecar_command_calls_total", command=command)
+        self.observe("slurm_sidecar_command_seconds", seconds, command=command)
+        if error is not None:
+            reason = "timeout" if error == "timeout" else "error"
+            self.inc("slurm_sidecar_command_failures_total", command=command, reason=reason)
+
+    @staticmethod
+    def _labels(labels, **extra):
+        items = list(labels) + list(extra.items())
+        if not items:
+            return ""
+        return "{" + ",".join('%s="%s"' % (k, v) for k, v in items) + "}"
+
+    def render(self, gauges):
+        """Return all metrics and the ``gauges`` dict in the Prometheus text format."""
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault(name, []).append("%s%s %s" % (name, self._labels(labels), value))
+            for (name, labels), hist in self.histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, count in zip(self.buckets, hist):
+                    lines.append(
+                        "%s_bucket%s %d" % (name, self._labels(labels, le=bound), count)
+                    )
+                lines.append("%s_bucket%s %d" % (name, self._labels(labels, le="+Inf"), hist[-1]))
+                lines.append("%s_sum%s %s" % (name, self._labels(labels), hist[-2]))
+                lines.append("%s_count%s %d" % (name, self._labels(labels), hist[-1]))
+        for name, value in gauges.items():
+            samples[name] = ["%s %s" % (name, value)]
+        output = []
+        for name in sorted(samples):
+            kind, text = self.help[name]
+            output += ["# HELP %s %s" % (name, text), "# TYPE %s %s" % (name, kind)]
+            output += samples[name]
+        return "\n".join(output) + "\n"
+
+
+#: Metrics of the sidecar, exported at ``/metrics``.
+metrics = Metrics()
+
+
+class CoalescingLookup:
+    """Coalesce lookups of job states into batches
+
+    Jobs looked up within ``window`` seconds are fetched with a single call
+    to ``fetch(jobids)``, which returns a dict mapping the jobids found to
+    their states.  Concurrent lookups of the same job share the pending or
+    in-flight fetch, and jobs not found are remembered for ``negative_ttl``
+    seconds.
+    """
+
+    def __init__(self, fetch, window=0.1, negative_ttl=10.0, max_batch=1000):
+        #: Function fetching the states of a list of jobids.
+        self.fetch = fetch
+        #: Seconds to collect lookups before fetching.
+        self.window = window
+        #: Seconds to remember jobs that were not found.
+        self.negative_ttl = negative_ttl
+        #: Maximal number of jobids per call to ``fetch``.
+        self.max_batch = max_batch
+        #: Lock protecting the attributes below.
+        self.lock = threading.Lock()
+        #: Dict mapping jobids to be fetched to their ``Future``.
+        self.pending = {}
+        #: Dict mapping jobids being fetched to their ``Future``.
+        self.in_flight = {}
+        #: Dict mapping jobids not found to the time they expire.
+        self.negative = {}
+        #: Timer fetching the pending jobids.
+        self.timer = None
+
+    def lookup(self, jobids):
+        """Return dict mapping ``jobids`` to their state, or None if not found."""
+        futures = {}
+        now = time.time()
+        with self.lock:
+            for jobid in jobids:
+                if self.negative.get(jobid, 0) > now:
+                    continue
+                future = self.in_flight.get(jobid) or self.pending.get(jobid)
+                if future is None:
+                    future = self.pending[jobid] = Future()
+                futures[jobid] = future
+            if self.pending and self.timer is None:
+                self.timer = threading.Timer(self.window, self._fetch_pending)
+                self.timer.daemon = True
+                self.timer.start()
+        return {j: futures[j].result() if j in futures else None for j in jobids}
+
+    def _fetch_pending(self):
+        with self.lock:
+            batch, self.pending, self.timer = self.pending, {}, None
+            self.in_flight.update(batch)
+        jobids = list(batch)
+        logger.debug("Looking up %d unknown jobs", len(jobids))
+        try:
+            found = {}
+            for i in range(0, len(jobids), self.max_batch):
+                found.update(self.fetch(jobids[i : i + self.max_batch]))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+        else:
+            now = time.time()
+            with self.lock:
+                self.negative = {j: t for j, t in self.negative.items() if t > now}
+                for jobid in jobids:
+                    if found.get(jobid) is None:
+                        self.negative[jobid] = now + self.negative_ttl
+            for jobid, future in batch.items():
+                future.set_result(found.get(jobid))
+        finally:
+            with self.lock:
+                for jobid in jobids:
+                    self.in_flight.pop(jobid, None)
+
+
+class StateJournal:
+    """Crash-safe journal of the job state table
+
+    Every change of the table is appended to the journal as a line
+    ``<jobid> <state>``, with state ``?`` for jobs not seen yet and ``-``
+    for evicted jobs.  Once the journal has ``max_records`` lines, the
+    whole table is written to ``<path>.snapshot`` and the journal is
+    truncated.  Both files start with a generation number, a journal is
+    only replayed on top of the snapshot of its generation such that a
+    crash while compacting loses nothing.
+    """
+
+    #: Number of journal lines after which a snapshot is written.
+    max_records = 10000
+
+    def __init__(self, path):
+        #: Path of the journal.
+        self.path = path
+        #: Path of the snapshot.
+        self.snapshot_path = path + ".snapshot"
+        #: Generation of the snapshot and journal.
+        self.generation = 0
+        #: Number of lines in the journal.
+        self.records = 0
+        #: The journal, opened for appending by ``load()``.
+        self.fh = None
+
+    def _read(self, path):
+        """Return the generation and the complete lines of a file."""
+        try:
+            with open(path) as fh:
+                lines = fh.read().split("\n")[:-1]  # skip a torn last line
+        except FileNotFoundError:
+            return None, []
+        if not lines or not lines[0].startswith("#"):
+            return None, []
+        return int(lines[0][1:]), lines[1:]
+
+    def load(self):
+        """Return dict mapping the jobids of the journaled table to their states."""
+        states = {}
+        generation, snapshot = self._read(self.snapshot_path)
+        journal_generation, journal = self._read(self.path)
+        generation = generation or 0
+        if journal_generation != generation:
+            journal = []  # compacted into the snapshot already
+        for line in snapshot + journal:
+            jobid, _, state = line.partition(" ")
+            if state == "-":
+                states.pop(jobid, None)
+            elif state:
+                states[jobid] = None if state == "?" else state
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.generation = generation
+        self.fh = open(self.path, "a")
+        self.compact(states)  # start from a clean journal
+        return states
+
+    def write(self, jobid, state):
+        """Append a change of the state of ``jobid``, ``state`` is ``-`` if evicted."""
+        self.fh.write("%s %s\n" % (jobid, "?" if state is None else state))
+        self.records += 1
+
+    def flush(self):
+        """Hand the appended changes to the operating system."""
+        self.fh.flush()
+
+    def compact(self, states):
+        """Write the snapshot of ``states`` and truncate the journal."""
+        generation = self.generation + 1
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "w") as fh:
+            fh.write("#%d\n" % generation)
+            fh.writelines(
+                "%s %s\n" % (jobid, "?" if state is None else state)
+                for jobid, state in states.items()
+            )
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.snapshot_path)
+        self.fh.close()
+        self.fh = open(self.path, "w")
+        self.fh.write("#%d\n" % generation)
+        self.fh.flush()
+        self.generation = generation
+        self.records = 0
+        logger.debug("Wrote snapshot of %d jobs", len(states))
+
+
+class JobStateTable:
+    """Compact table of the states of the jobs of this run
+
+    Job IDs are stored as integers (array tasks ``<arrayid>_<task>`` are
+    packed into negative integers, other IDs as interned strings) and
+    states as small integer codes.  Jobs are added when registered or
+    queried; other jobs of the user seen by the last ``squeue --user``
+    call are kept in a separate snapshot that is replaced on every such
+    call, and moved to the table when queried.  Finished jobs are evicted
+    once their state has been observed by Snakemake, or ``ttl`` seconds
+    after they finished.
+
+    If a ``StateJournal`` is given, the jobs of this run are reloaded from
+    it and all changes are recorded in it.
+    """
+
+    #: Bits of the task ID in the integer key of array tasks.
+    task_bits = 22
+
+    def __init__(self, ttl=3600, journal=None):
+        #: Seconds to keep finished jobs whose state was not observed.
+        self.ttl = ttl
+        #: The ``StateJournal`` recording the jobs of this run, if any.
+        self.journal = journal
+        #: Lock protecting the attributes below, taken by the HTTP handler threads.
+        self.lock = threading.Lock()
+        #: List of the state names, indexed by their code; ``0`` is "not seen yet".
+        self.names = [None]
+        #: Dict mapping state names to their code.
+        self.codes = {None: 0}
+        #: Dict mapping the keys of the jobs of this run to their state code.
+        self.jobs = {}
+        #: Dict mapping the keys of other jobs of the user to their state code.
+        self.snapshot = {}
+        #: Dict mapping the keys of finished jobs of this run to the time first seen finished.
+        self.finished = {}
+        #: Number of updates changing the state of jobs of this run.
+        self.version = 0
+        #: Notified on every update changing the state of jobs of this run.
+        self.changed = threading.Condition(self.lock)
+        #: Called with the ID of every evicted job, holding ``lock``, if set.
+        self.on_evict = None
+        if journal is not None:
+            start = time.time()
+            for jobid, state in journal.load().items():
+                self._set(self._key(jobid), self._code(state), record=False)
+            logger.debug(
+                "Reloaded %d jobs (%d active) in %.3fs",
+                len(self.jobs),
+                len(self.jobs) - len(self.finished),
+                time.time() - start,
+            )
+
+    def _key(self, jobid):
+        """Return the compact key of ``jobid``."""
+        if jobid.isdigit():
+            return int(jobid)
+        arrayid, sep, task = jobid.partition("_")
+        if sep and arrayid.isdigit() and task.isdigit() and int(task) < 1 << self.task_bits:
+            return -((int(arrayid) << self.task_bits) | int(task))
+        return sys.intern(jobid)
+
+    def _jobid(self, key):
+        """Return the job ID of compact ``key``."""
+        if not isinstance(key, int):
+            return key
+        if key >= 0:
+            return str(key)
+        return "%d_%d" % (-key >> self.task_bits, -key & ((1 << self.task_bits) - 1))
+
+    def _code(self, state):
+        """Return the code of ``state``, assigning a new one if needed."""
+        code = self.codes.get(state)
+        if code is None:
+            code = self.codes[sys.intern(state)] = len(self.names)
+            self.names.append(state)
+        return code
+
+    def _set(self, key, code, record=True):
+        """Set the state code of job ``key`` of this run, tracking finished jobs."""
+        self.jobs[key] = code
+        if record and self.journal is not None:
+            self.journal.write(self._jobid(key), self.names[code])
+        if code and self.names[code] not in ACTIVE_STATES:
+            self.finished.setdefault(key, time.time())
+        else:
+            self.finished.pop(key, None)
+
+    def find(self, jobid):
+        """Return whether ``jobid`` is known, and its state."""
+        key = self._key(jobid)
+        with self.lock:
+            code = self.jobs.get(key)
+            if code is None:
+                code = self.snapshot.get(key)
+                if code is None:
+                    return False, None
+                self._set(key, code)  # queried, now a job of this run
+                self._flush()
+            return True, self.names[code]
+
+    def add(self, jobid, state=None):
+        """Add ``jobid`` to the jobs of this run unless known, return its state."""
+        key = self._key(jobid)
+        with self.lock:
+            code = self.jobs.get(key)
+            if code is None:
+                code = self.snapshot.get(key, self._code(state))
+                self._set(key, code)
+                self._flush()
+            return self.names[code]
+
+    def observed(self, jobid):
+        """Evict ``jobid`` if it has finished, its state has been observed."""
+        key = self._key(jobid)
+        with self.lock:
+            if key in self.finished:
+                self._evict(key)
+                self._flush()
+
+    def update(self, states, snapshot=False):
+        """Update jobs from ``states``, return the number of jobs of this run changing state.
+
+        If ``snapshot``, ``states`` lists all jobs of the user and replaces
+        the snapshot of the jobs not of this run.
+        """
+        changes = 0
+        other = {}
+        with self.lock:
+            for jobid, state in states.items():
+                key = self._key(jobid)
+                code = self._code(state)
+                prev = self.jobs.get(key)
+                if prev is None:
+                    other[key] = code
+                elif prev != code:
+                    self._set(key, code)
+                    changes += 1
+            if snapshot:
+                self.snapshot = other
+            if changes:
+                self._flush()
+                self.version += 1
+                self.changed.notify_all()
+        return changes
+
+    def wait(self, version, timeout):
+        """Wait up to ``timeout`` seconds for an update after ``version``."""
+        with self.lock:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+
+    def active(self):
+        """Return the IDs of the jobs of this run that have not finished."""
+        with self.lock:
+            return [self._jobid(k) for k in self.jobs if k not in self.finished]
+
+    def expire(self):
+        """Evict the jobs of this run that finished more than ``ttl`` seconds ago."""
+        deadline = time.time() - self.ttl
+        with self.lock:
+            expired = [k for k, t in self.finished.items() if t < deadline]
+            for key in expired:
+                self._evict(key)
+            if expired:
+                self._flush()
+        if expired:
+            logger.debug("Evicted %d finished jobs", len(expired))
+
+    def discard(self, jobids):
+        """Drop ``jobids`` from the jobs of this run, finished or not."""
+        with self.lock:
+            for jobid in jobids:
+                key = self._key(jobid)
+                if key in self.jobs:
+                    self._evict(key)
+            self._flush()
+
+    def _evict(self, key):
+        """Drop job ``key``."""
+        self.finished.pop(key, None)
+        del self.jobs[key]
+        if self.journal is not None:
+            self.journal.write(self._jobid(key), "-")
+        if self.on_evict is not None:
+            self.on_evict(self._jobid(key))
+
+    def _flush(self):
+        """Flush the journal, if any."""
+        if self.journal is not None:
+            self.journal.flush()
+
+    def compact(self, force=False):
+        """Write a snapshot of the journal if it has grown large, or if ``force``."""
+        with self.lock:
+            if self.journal is None:
+                return
+            if force or self.journal.records >= self.journal.max_records:
+                self.journal.compact(
+                    {self._jobid(k): self.names[c] for k, c in self.jobs.items()}
+                )
+
+    def stats(self):
+        """Return dict with the number of entries and the approximate memory use."""
+        with self.lock:
+            tables = (self.jobs, self.snapshot, self.finished)
+            size = sum(sys.getsizeof(t) for t in tables)
+            size += sum(sys.getsizeof(k) for t in (self.jobs, self.snapshot) for k in t)
+            return {
+                "jobs": len(self.jobs),
+                "finished": len(self.finished),
+                "snapshot": len(self.snapshot),
+                "states": len(self.names) - 1,
+                "bytes": size,
+            }
+
+
 class PollSqueueThread(threading.Thread):
-    """Thread that polls ``squeue`` until stopped by ``stop()``"""
+    """Thread that polls ``squeue`` until stopped by ``stop()``
+
+    Only the jobs of this run (registered or queried jobs) that have not
+    finished are polled: with ``squeue --user --jobs=<ids>`` in chunks of
+    ``jobs_chunk`` IDs if there are fewer of them than jobs of the user at
+    the last ``squeue --user`` call, and with ``squeue --user`` otherwise.
+    ``--user`` is always passed as slurmctld only filters by user, the job
+    IDs are filtered by ``squeue`` itself.  The number of jobs of the user
+    is refreshed with ``squeue --user`` every ``user_jobs_ttl`` seconds.
+    If no job of this run is active, ``squeue`` is not called at all.
+
+    If ``adaptive``, the interval between calls aims at ``churn_target``
+    state changes per call, bounded by ``min_wait``, ``latency_factor``
+    times the duration of the last call, ``squeue_wait`` and a third of
+    ``min_job_age``.
+
+    If ``sacct_wait`` is non-zero, a second thread calls ``sacct`` every
+    ``sacct_wait`` seconds for the jobs of the user that finished since
+    the previous call, such that jobs leaving ``squeue`` after
+    ``min_job_age`` are not missed and ``squeue_wait`` is not bounded by
+    it.  The ``sacct`` delta polls are not available with the slurmrestd
+    backend.
+    """
+
+    #: Maximal number of job IDs per ``squeue --jobs`` call.
+    jobs_chunk = 500
+    #: Maximal number of ``squeue --jobs`` calls per poll.
+    max_chunks = 4
+    #: Seconds after which ``user_jobs`` is refreshed by a ``squeue --user`` call.
+    user_jobs_ttl = 300
+    #: Number of state changes per poll that the adaptive interval aims at.
+    churn_target = 5
+    #: Minimal ratio of the interval to the duration of a ``squeue`` call.
+    latency_factor = 10
+    #: Seconds by which the windows of ``sacct`` delta polls overlap.
+    sacct_overlap = 60
+    #: Maximal running time of a ``sacct`` delta poll.
+    sacct_timeout = 30
 
     def __init__(
         self,
         squeue_wait,
         squeue_cmd,
         squeue_timeout=2,
-        sleep_time=0.01,
+        min_wait=10,
         max_tries=3,
+        adaptive=False,
+        min_job_age=300,
+        state_ttl=3600,
+        journal=None,
+        sacct_wait=0,
         *args,
         **kwargs
     ):
         super().__init__(target=self._work, *args, **kwargs)
-        #: Time to wait between squeue calls.
+        #: slurmrestd backend replacing the ``squeue`` and ``sacct`` calls.
+        self.backend = slurm_utils.get_backend() if slurm_utils.BACKEND == "rest" else None
+        #: Time to wait between ``sacct`` delta polls, ``0`` disables them.
+        self.sacct_wait = sacct_wait if self.backend is None else 0
+        #: Time to wait between squeue calls, the maximum if ``adaptive``.
+        #: Bounded by ``min_job_age`` unless finished jobs are polled with ``sacct``.
         self.squeue_wait = squeue_wait
+        if not self.sacct_wait:
+            self.squeue_wait = min(squeue_wait, min_job_age / 3)
+        #: Start of the window of the next ``sacct`` delta poll.
+        self.sacct_since = time.time()
+        #: Whether to adapt ``interval`` to the job churn.
+        self.adaptive = adaptive
+        #: Current time to wait between squeue calls.
+        self.interval = self.squeue_wait
+        #: Moving average of the state changes per second.
+        self.churn = 0.0
+        #: Duration of the last call to ``squeue``.
+        self.latency = 0.0
         #: Command to call squeue with.
         self.squeue_cmd = squeue_cmd
         #: Whether or not the thread should stop.
         self.stopped = threading.Event()
+        #: Set by ``poll_now()`` to call ``squeue`` before ``squeue_wait`` has passed.
+        self.triggered = threading.Event()
         #: Previous call to ``squeue``
         self.prev_call = 0.0
-        #: Time to sleep between iterations in seconds.  Thread can only be
-        #: terminated after this interval when waiting.
-        self.sleep_time = sleep_time
+        #: Minimal time between calls to ``squeue`` triggered by ``poll_now()``.
+        self.min_wait = min_wait
         #: Maximal running time to accept for call to ``squeue``.
         self.squeue_timeout = squeue_timeout
         #: Maximal number of tries if call to ``squeue`` fails.
         self.max_tries = max_tries
-        #: Dict mapping the job id to the job state string.
-        self.states = {}
+        #: Retry policy of calls to ``squeue`` and ``sacct``.
+        self.retry = slurm_retry.RetryPolicy(max_tries=max_tries, base_delay=0.2, max_delay=2.0)
+        #: The states of the jobs of this run, registered or queried.
+        self.table = JobStateTable(state_ttl, journal)
+        #: Number of jobs of the user at the last ``squeue --user`` call.
+        self.user_jobs = 0
+        #: Time of the last ``squeue --user`` call.
+        self.user_jobs_time = 0.0
+        #: Batched ``sacct`` lookups of jobs not seen by ``squeue``.
+        self.sacct = CoalescingLookup(self._get_states_sacct, SACCT_WINDOW, SACCT_NEGATIVE_TTL)
         #: Make at least one call to squeue, must not fail.
         logger.debug("initializing trhead")
         self._call_squeue(allow_failure=False)
@@ -93,83 +808,268 @@ class PollSqueueThread(threading.Thread):
     def _work(self):
         """Execute the thread's action"""
         while not self.stopped.is_set():
+            if self.triggered.is_set():
+                # wake up on stop() only
+                timeout = self.prev_call + self.min_wait - time.time()
+                if timeout > 0:
+                    self.stopped.wait(timeout)
+                    continue
+            else:
+                # wake up on poll_now() or stop()
+                timeout = self.prev_call + self.interval - time.time()
+                if timeout > 0:
+                    self.triggered.wait(timeout)
+                    continue
+            if self.stopped.is_set():
+                break
+            self.triggered.clear()
+            start = time.time()
+            changes = self._call_squeue()
             now = time.time()
-            if now - self.prev_call > self.squeue_wait:
-                self._call_squeue()
-                self.prev_call = now
-            time.sleep(self.sleep_time)
+            self.latency = now - start
+            if self.adaptive:
+                self._adapt_interval(changes, now - self.prev_call)
+            self.prev_call = now
+            self.table.expire()
+            self.table.compact()
+        self.table.compact(force=True)
+
+    def _adapt_interval(self, changes, elapsed):
+        """Update ``interval`` after a poll seeing ``changes`` in ``elapsed`` seconds."""
+        self.churn = 0.5 * self.churn + 0.5 * changes / max(elapsed, 1e-3)
+        interval = self.churn_target / self.churn if self.churn > 0 else self.squeue_wait
+        interval = max(interval, self.min_wait, self.latency_factor * self.latency)
+        self.interval = min(interval, self.squeue_wait)
+        logger.debug("%.2f state changes/s, polling every %.1fs", self.churn, self.interval)
+
+    def poll_now(self):
+        """Call ``squeue`` as soon as ``min_wait`` has passed since the last call."""
+        self.triggered.set()
 
     def get_state(self, jobid):
         """Return the job state for the given jobid."""
         jobid = str(jobid)
-        if jobid not in self.states:
-            self.states[jobid] = self._get_state_sacct(jobid)
-        return self.states.get(jobid, "__not_seen_yet__")
+        found, state = self.table.find(jobid)
+        metrics.inc("slurm_sidecar_state_lookups_total", result="hit" if found else "miss")
+        if not found:
+            state = self._get_state_sacct(jobid)
+            if state is None:
+                return None  # looked up again once the negative result expires
+            state = self.table.add(jobid, state)
+        if state is None:
+            self.poll_now()  # registered but not seen yet
+        else:
+            self.table.observed(jobid)
+        return state
+
+    def get_states(self, jobids, observe=True):
+        """Return dict mapping the given jobids to their states.
+
+        Jobs not seen by ``squeue`` yet are looked up with a single call to
+        ``sacct``.  Unless ``observe`` is False, finished jobs are evicted as
+        their state has been observed.
+        """
+        jobids = [str(j) for j in jobids]
+        states = {}
+        for jobid in jobids:
+            found, states[jobid] = self.table.find(jobid)
+            if not found:
+                del states[jobid]
+        unknown = [j for j in jobids if j not in states]
+        metrics.inc("slurm_sidecar_state_lookups_total", len(states), result="hit")
+        metrics.inc("slurm_sidecar_state_lookups_total", len(unknown), result="miss")
+        found = self.sacct.lookup(unknown) if unknown else {}
+        for jobid in unknown:
+            if found[jobid] is not None:
+                states[jobid] = self.table.add(jobid, found[jobid])
+        if observe:
+            for jobid in jobids:
+                if states.get(jobid) is not None:
+                    self.table.observed(jobid)
+        return {j: states.get(j) for j in jobids}
 
     def register_job(self, jobid):
         """Register job with the given ID."""
-        self.states.setdefault(jobid, None)
+        self.table.add(jobid)
+        self.poll_now()
 
     def _get_state_sacct(self, jobid):
         """Implement retrieving state via sacct for resuming jobs."""
+        state = self.sacct.lookup([jobid])[jobid]
+        logger.debug("Returning state of %s as %s", jobid, state)
+        return state
+
+    def _get_states_sacct(self, jobids):
+        """Return dict mapping jobids to states with a single call to sacct."""
+        if self.backend is not None:
+            return self._backend_job_states(jobids)
         cluster = CookieCutter.get_cluster_option()
-        cmd = ["sacct", "-P", "-b", "-j", jobid, "-n"]
+        cmd = ["sacct", "-P", "-b", "-j", ",".join(jobids), "-n"]
         if cluster:
             cmd.append(cluster)
-        try_num = 0
-        while try_num < self.max_tries:
-            try_num += 1
-            try:
-                logger.debug("Calling %s (try %d)", cmd, try_num)
-                output = subprocess.check_output(cmd, timeout=self.squeue_timeout, text=True)
-                break
-            except subprocess.TimeoutExpired as e:
-                logger.debug("Call to %s timed out (try %d of %d)", cmd, try_num, self.max_tries)
-            except subprocess.CalledProcessError as e:
-                logger.debug("Call to %s failed (try %d of %d)", cmd, try_num, self.max_tries)
-        if try_num >= self.max_tries:
-            raise Exception("Problem with call to %s" % cmd)
+        try:
+            output = self.retry.call(
+                cmd,
+                timeout=self.squeue_timeout,
+                after_try=functools.partial(metrics.record_call, "sacct"),
+            )
+        except (subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
+            raise Exception("Problem with call to %s" % cmd) from e
         else:
-            parsed = {x.split("|")[0]: x.split("|")[1] for x in output.strip().split("\n")}
-            logger.debug("Returning state of %s as %s", jobid, parsed[jobid])
-            return parsed[jobid]
+            parsed = {}
+            for line in output.strip().split("\n"):
+                arr = line.split("|")
+                if len(arr) < 2:
+                    continue
+                for task_id in slurm_utils.expand_array_jobid(arr[0]):
+                    parsed[task_id] = arr[1]
+            return parsed
+
+    def start(self):
+        """Start the thread, and the ``sacct`` delta poll thread if enabled."""
+        super().start()
+        if self.sacct_wait > 0:
+            threading.Thread(target=self._poll_sacct, name="poll-sacct").start()
+
+    def _poll_sacct(self):
+        """Call ``sacct`` for finished jobs every ``sacct_wait`` seconds until stopped."""
+        while not self.stopped.wait(self.sacct_wait):
+            self._call_sacct_delta()
+
+    def _call_sacct_delta(self):
+        """Update the table with the jobs of the user that finished since the last call."""
+        start = time.time()
+        if not self.table.active():
+            self.sacct_since = start
+            return 0
+        since = time.strftime(
+            "%Y-%m-%dT%H:%M:%S", time.localtime(self.sacct_since - self.sacct_overlap)
+        )
+        cmd = [
+            "sacct",
+            "-X",
+            "-n",
+            "-P",
+            "--format=JobID,State",
+            "--state={}".format(",".join(slurm_history.FINISHED_STATES)),
+            "-S",
+            since,
+            "-E",
+            "now",
+            "--user={}".format(os.environ.get("USER")),
+        ]
+        cluster = CookieCutter.get_cluster_option()
+        if cluster:
+            cmd.append(cluster)
+        try:
+            output = self.retry.call(
+                cmd,
+                timeout=self.sacct_timeout,
+                after_try=functools.partial(metrics.record_call, "sacct"),
+            )
+        except (subprocess.TimeoutExpired, subprocess.CalledProcessError):
+            logger.debug("Giving up on sacct for this round")
+            return 0
+        states = {}
+        for line in output.splitlines():
+            arr = line.strip().split("|")
+            if len(arr) < 2 or not arr[1]:
+                continue
+            for task_id in slurm_utils.expand_array_jobid(arr[0]):
+                states[task_id] = arr[1].split()[0]  # e.g. "CANCELLED by 1234"
+        self.sacct_since = start
+        changes = self.table.update(states)
+        logger.debug("sacct reported %d finished jobs, %d changes", len(states), changes)
+        return changes
 
     def stop(self):
         """Flag thread to stop execution"""
         logger.debug("stopping thread")
         self.stopped.set()
+        self.triggered.set()
 
     def _call_squeue(self, allow_failure=True):
-        """Run the call to ``squeue``"""
+        """Run the call to ``squeue``, return the number of jobs of this run changing state"""
+        if self.backend is not None:
+            # only the active jobs of this run, in chunks like ``squeue --jobs``
+            active = self.table.active()
+            states = {}
+            try:
+                for i in range(0, len(active), self.jobs_chunk):
+                    states.update(self._backend_job_states(active[i : i + self.jobs_chunk]))
+            except (OSError, slurm_utils.SlurmRestError):
+                if not allow_failure:
+                    raise
+                logger.debug("Giving up for this round")
+            return self.table.update(states)
         cluster = CookieCutter.get_cluster_option()
-        try_num = 0
-        cmd = [SQUEUE_CMD, "--user={}".format(os.environ.get("USER")), "--format=%i,%T", "--state=all"]
+        cmd = [
+            SQUEUE_CMD,
+            "--format=%i,%T",
+            "--state=all",
+            "--array",
+            "--user={}".format(os.environ.get("USER")),
+        ]
         if cluster:
             cmd.append(cluster)
-        while try_num < self.max_tries:
-            try_num += 1
+        active = sorted(self.table.active())
+        if not active and allow_failure:
+            logger.debug("No active jobs, skipping squeue")
+            return 0
+        chunks = [active[i : i + self.jobs_chunk] for i in range(0, len(active), self.jobs_chunk)]
+        after_try = functools.partial(metrics.record_call, "squeue")
+        changes = 0
+        if (
+            active
+            and len(active) < self.user_jobs
+            and len(chunks) <= self.max_chunks
+            and time.time() - self.user_jobs_time < self.user_jobs_ttl
+        ):
             try:
-                logger.debug("Calling %s (try %d)", cmd, try_num)
-                output = subprocess.check_output(cmd, timeout=self.squeue_timeout, text=True)
-                logger.debug("Output is:\n---\n%s\n---", output)
-                break
-            except subprocess.TimeoutExpired as e:
-                if not allow_failure:
-                    raise
-                logger.debug("Call to %s timed out (try %d of %d)", cmd, try_num, self.max_tries)
+                for chunk in chunks:
+                    output = self.retry.call(
+                        cmd + ["--jobs={}".format(",".join(chunk))],
+                        timeout=self.squeue_timeout,
+                        after_try=after_try,
+                    )
+                    changes += self.table.update(self._parse_output(output))
+                return changes
             except subprocess.CalledProcessError as e:
-                if not allow_failure:
-                    raise
-                logger.debug("Call to %s failed (try %d of %d)", cmd, try_num, self.max_tries)
-        if try_num >= self.max_tries:
+                # e.g. a single job that slurmctld has already forgotten
+                logger.debug("squeue --jobs failed, falling back to --user: %s", e.stderr)
+            except subprocess.TimeoutExpired:
+                logger.debug("Giving up for this round")
+                return changes
+        try:
+            output = self.retry.call(cmd, timeout=self.squeue_timeout, after_try=after_try)
+        except (subprocess.TimeoutExpired, subprocess.CalledProcessError):
+            if not allow_failure:
+                raise
             logger.debug("Giving up for this round")
         else:
-            logger.debug("parsing output")
-            self._parse_output(output)
+            self.user_jobs = max(0, output.count("\n") - 1)
+            self.user_jobs_time = time.time()
+            changes += self.table.update(self._parse_output(output), snapshot=True)
+        return changes
+
+    def _backend_job_states(self, jobids):
+        """Return ``backend.job_states(jobids)``, recording the call in the metrics."""
+        start = time.time()
+        error = None
+        try:
+            return self.backend.job_states(jobids)
+        except (OSError, slurm_utils.SlurmRestError) as e:
+            error = "timeout" if isinstance(e, TimeoutError) else str(e)
+            raise
+        finally:
+            metrics.record_call("slurmrestd", time.time() - start, error)
 
     def _parse_output(self, output):
-        """Parse output of ``squeue`` call."""
+        """Parse output of ``squeue`` call, return dict mapping jobids to states."""
+        logger.debug("Output is:\n---\n%s\n---", output)
         header = None
+        states = {}
+        lines = 0
         for line in output.splitlines():
             line = line.strip()
             arr = line.split(",")
@@ -178,39 +1078,640 @@ class PollSqueueThread(threading.Thread):
                     continue  # skip leader
                 header = arr
             else:
-                logger.debug("Updating state of %s to %s", arr[0], arr[1])
-                self.states[arr[0]] = arr[1]
+                # pending array tasks may be listed as ``<arrayid>_[<tasks>]``
+                lines += 1
+                for jobid in slurm_utils.expand_array_jobid(arr[0]):
+                    logger.debug("Updating state of %s to %s", jobid, arr[1])
+                    states[jobid] = arr[1]
+        metrics.inc("slurm_sidecar_squeue_lines_total", lines)
+        return states
+
+
+class IterateSqueueThread(PollSqueueThread):
+    """Thread that streams the job states from a long-running ``squeue --iterate``
+
+    Instead of calling ``squeue`` for every poll, a single ``squeue
+    --noheader --iterate=<squeue_wait> --user`` process prints all jobs of
+    the user every ``squeue_wait`` seconds, each frame followed by an empty
+    line.  The output is parsed from the pipe as it arrives, and a frame is
+    applied to the state table once its empty line has been read.
+
+    ``squeue`` block-buffers its output into a pipe, so it is run with
+    ``stdbuf -oL`` if available.  Otherwise, or if ``squeue`` stalls, no
+    frame may complete for a long time: if none has been applied for
+    ``stale_factor`` times ``squeue_wait`` seconds, the jobs are polled
+    with a regular ``squeue`` call instead.  If ``squeue`` exits, it is
+    restarted after a backoff.  The interval does not adapt and early polls
+    are not possible.
+    """
+
+    #: Multiple of ``squeue_wait`` without a complete frame after which to poll.
+    stale_factor = 3
+
+    def _work(self):
+        """Execute the thread's action"""
+        try_num = 0
+        while not self.stopped.is_set():
+            start = time.time()
+            self._stream()
+            if self.stopped.is_set():
+                break
+            metrics.inc("slurm_sidecar_command_failures_total", command="squeue", reason="error")
+            try_num = try_num + 1 if time.time() - start < 10 * self.squeue_wait else 1
+            delay = self.retry.delay(try_num)
+            logger.debug("squeue --iterate exited, restarting in %.2fs", delay)
+            self.stopped.wait(delay)
+        self.table.compact(force=True)
+
+    def _command(self):
+        """Return the ``squeue --iterate`` command."""
+        cmd = [
+            self.squeue_cmd,
+            "--noheader",
+            "--format=%i,%T",
+            "--state=all",
+            "--array",
+            "--iterate=%d" % max(1, round(self.squeue_wait)),
+            "--user={}".format(os.environ.get("USER")),
+        ]
+        cluster = CookieCutter.get_cluster_option()
+        if cluster:
+            cmd.append(cluster)
+        stdbuf = shutil.which("stdbuf")
+        if stdbuf:
+            cmd = [stdbuf, "-oL"] + cmd  # line-buffered output into the pipe
+        return cmd
+
+    def _stream(self):
+        """Run ``squeue --iterate`` and apply its frames until it exits or the thread stops."""
+        cmd = self._command()
+        logger.debug("Starting %s", cmd)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        fd = proc.stdout.fileno()
+        buf = b""
+        frame = {}
+        self.prev_call = time.time()
+        try:
+            while not self.stopped.is_set():
+                if not select.select([fd], [], [], 1.0)[0]:
+                    if time.time() - self.prev_call > self.stale_factor * self.squeue_wait:
+                        logger.debug("No frame from squeue --iterate, polling instead")
+                        self._poll()
+                    continue
+                chunk = os.read(fd, 1 << 16)
+                if not chunk:
+                    return  # squeue exited, a partial frame is dropped
+                lines = (buf + chunk).split(b"\n")
+                buf = lines.pop()
+                for line in lines:
+                    line = line.decode().strip()
+                    if not line:
+                        # the empty line ending a frame
+                        self._apply_frame(frame)
+                        frame = {}
+                        continue
+                    jobid, sep, state = line.partition(",")
+                    if not sep:
+                        continue
+                    for task_id in slurm_utils.expand_array_jobid(jobid):
+                        frame[task_id] = state
+        finally:
+            proc.kill()
+            proc.wait()
+            proc.stdout.close()
+
+    def _poll(self):
+        """Poll the jobs with a regular ``squeue`` call."""
+        changes = self._call_squeue()
+        logger.debug("Polled instead of a frame, %d changes", changes)
+        self.prev_call = time.time()
+        self.table.expire()
+        self.table.compact()
+
+    def _apply_frame(self, frame):
+        """Apply the states of all jobs of the user from one frame."""
+        metrics.inc("slurm_sidecar_command_calls_total", command="squeue --iterate")
+        metrics.inc("slurm_sidecar_squeue_lines_total", len(frame))
+        self.user_jobs = len(frame)
+        self.user_jobs_time = time.time()
+        changes = self.table.update(frame, snapshot=True)
+        logger.debug("Applied frame of %d jobs, %d changes", len(frame), changes)
+        self.prev_call = time.time()
+        self.table.expire()
+        self.table.compact()
+
+
+class JobArray:
+    """A held job array whose tasks are filled with submitted jobscripts"""
+
+    def __init__(self, spool_dir, size):
+        #: The job ID of the array, None until submitted.
+        self.jobid = None
+        #: Directory with one jobscript per task, named ``${task}.sh``.
+        self.spool_dir = spool_dir
+        #: Number of tasks reserved.
+        self.size = size
+        #: Number of tasks assigned to jobs.
+        self.used = 0
+        #: Timer closing the array at the end of the collection window.
+        self.timer = None
+        #: Set once the array has been submitted, or its submission failed.
+        self.opened = threading.Event()
+        #: The exception of a failed submission.
+        self.error = None
+
+    def add(self, jobscript):
+        """Assign ``jobscript`` to the next free task and return its index."""
+        task = self.used
+        shutil.copy(jobscript, os.path.join(self.spool_dir, "%d.sh" % task))
+        self.used += 1
+        return task
+
+    def wait_opened(self):
+        """Wait until the array has been submitted and return its job ID."""
+        self.opened.wait()
+        if self.error is not None:
+            raise RuntimeError("submission of job array failed: %s" % self.error)
+        return self.jobid
+
+
+class JobArrayBatcher:
+    """Coalesce jobs with identical sbatch options into job arrays
+
+    The lock only protects the assignment of jobs to arrays.  Arrays are
+    submitted, released and cancelled outside of it, paced by ``limiter``,
+    such that the latency of the Slurm controller does not hold up jobs
+    with other options.  Jobs added to an array that is being submitted
+    wait for its job ID.
+    """
+
+    def __init__(self, window, size, limiter=None):
+        #: Seconds an array accepts new jobs.
+        self.window = window
+        #: Number of tasks to reserve per array.
+        self.size = size
+        #: The ``RateLimiter`` of the calls to Slurm, if any.
+        self.limiter = limiter
+        #: Lock protecting ``arrays`` and the tasks of the arrays.
+        self.lock = threading.Lock()
+        #: Dict mapping option keys to the ``JobArray`` accepting jobs.
+        self.arrays = {}
+
+    def submit(self, jobscript, cwd, sbatch_options, name):
+        """Add ``jobscript`` to a job array and return ``<arrayid>_<task>``."""
+        key = (cwd, name) + tuple(
+            sorted((k, str(v)) for k, v in sbatch_options.items() if k not in ("job-name", "job_name"))
+        )
+        opening = full = False
+        with self.lock:
+            array = self.arrays.get(key)
+            if array is None:
+                array = JobArray(self._new_spool_dir(cwd), self.size)
+                self.arrays[key] = array
+                opening = True
+            task = array.add(jobscript)
+            if array.used == array.size:
+                del self.arrays[key]
+                full = True
+        if opening:
+            self._open(key, array, cwd, sbatch_options, name)
+        jobid = array.wait_opened()
+        if full:
+            self._close(array)
+        return "%s_%d" % (jobid, task)
+
+    @staticmethod
+    def _new_spool_dir(cwd):
+        """Create the spool directory of a new array with its ``array.sh``."""
+        spool_dir = os.path.join(cwd, ".snakemake", "slurm-arrays", uuid.uuid4().hex)
+        os.makedirs(spool_dir)
+        script = os.path.join(spool_dir, "array.sh")
+        with open(script, "w") as fh:
+            fh.write("#!/bin/bash\n")
+            fh.write('exec %s/"$SLURM_ARRAY_TASK_ID".sh\n' % shlex.quote(spool_dir))
+        return spool_dir
+
+    def _open(self, key, array, cwd, sbatch_options, name):
+        """Submit the held job array ``array`` for the jobs matching ``key``."""
+        options = {k: v for k, v in sbatch_options.items() if k not in ("job-name", "job_name")}
+        options["job-name"] = name
+        options["array"] = "0-%d" % (self.size - 1)
+        options["hold"] = None
+        try:
+            array.jobid = call_sbatch(
+                os.path.join(array.spool_dir, "array.sh"), cwd, options, self.limiter
+            )
+        except Exception as e:
+            array.error = e
+            with self.lock:
+                if self.arrays.get(key) is array:
+                    del self.arrays[key]
+            array.opened.set()
+            raise
+        logger.debug("Opened job array %s for %s", array.jobid, name)
+        array.timer = threading.Timer(self.window, self._expire, args=(key, array))
+        array.timer.daemon = True
+        array.timer.start()
+        array.opened.set()
+
+    def _expire(self, key, array):
+        """Close ``array`` at the end of its window unless already closed."""
+        with self.lock:
+            if self.arrays.get(key) is not array:
+                return
+            del self.arrays[key]
+        self._close(array)
+
+    def _close(self, array):
+        """Cancel the unused tasks of ``array`` and release the others.
+
+        The array must no longer be in ``arrays``, such that no task is
+        added while it is closed.
+        """
+        if array.timer is not None:
+            array.timer.cancel()
+        cluster = CookieCutter.get_cluster_option()
+        cmds = []
+        if array.used < array.size:
+            cmds.append(["scancel", "%s_[%d-%d]" % (array.jobid, array.used, array.size - 1)])
+        cmds.append(["scontrol", "release", array.jobid])
+        for cmd in cmds:
+            if cluster:
+                cmd.append(cluster)
+            if self.limiter is not None:
+                self.limiter.acquire()
+            start = time.time()
+            error = None
+            try:
+                logger.debug("Calling %s", cmd)
+                subprocess.check_call(cmd)
+            except subprocess.CalledProcessError as e:
+                error = str(e)
+                logger.error("Call to %s failed, job array %s may stay held", cmd, array.jobid)
+            finally:
+                metrics.record_call(cmd[0], time.time() - start, error)
+
+    def close_all(self):
+        """Close all arrays still accepting jobs."""
+        with self.lock:
+            arrays = list(self.arrays.values())
+            self.arrays.clear()
+        for array in arrays:
+            if array.opened.wait(60) and array.error is None:
+                self._close(array)
+
+
+class PackClass:
+    """Spool and worker allocations of packed jobs with the same resources"""
+
+    def __init__(self, class_id, cwd, sbatch_options):
+        #: Short hash identifying the class.
+        self.class_id = class_id
+        #: Directory submitting the jobs.
+        self.cwd = cwd
+        #: The sbatch options of the worker allocations.
+        self.sbatch_options = sbatch_options
+        #: The spool directory.
+        self.spool_dir = slurm_pack.spool_dir(cwd, class_id)
+        for d in ("queue", "run", "state", "jobs", "workers"):
+            os.makedirs(os.path.join(self.spool_dir, d), exist_ok=True)
+        #: Number of the next packed job, continuing after earlier runs.
+        self.next_number = len(os.listdir(os.path.join(self.spool_dir, "jobs")))
+        #: Job IDs of the worker allocations.
+        self.workers = []
+        #: Number of worker allocations being submitted.
+        self.starting = 0
+
+    def queued(self):
+        """Return the number of jobs not yet claimed by a worker."""
+        return len(os.listdir(os.path.join(self.spool_dir, "queue")))
+
+
+class JobPacker:
+    """Run short jobs in shared worker allocations, see ``slurm_pack.py``"""
+
+    def __init__(self, poll_thread, runtime, walltime, workers, idle, limiter=None):
+        #: The ``PollSqueueThread`` tracking the worker allocations.
+        self.poll_thread = poll_thread
+        #: The ``RateLimiter`` pacing the submission of workers, if any.
+        self.limiter = limiter
+        #: Default threshold in minutes on the runtime of packed jobs.
+        self.runtime = runtime
+        #: Walltime in minutes of the worker allocations.
+        self.walltime = walltime
+        #: Maximal number of worker allocations per class.
+        self.workers = workers
+        #: Seconds an idle worker waits for jobs.
+        self.idle = idle
+        #: Lock protecting ``classes`` and their workers.
+        self.lock = threading.Lock()
+        #: Dict mapping class IDs to ``PackClass`` objects.
+        self.classes = {}
+
+    def wants(self, job_properties, sbatch_options):
+        """Whether the job with the given resolved options is to be packed."""
+        threshold = int(job_properties.get("resources", {}).get("pack_runtime", self.runtime))
+        if threshold <= 0 or threshold >= self.walltime or "time" not in sbatch_options:
+            return False
+        minutes = slurm_utils.time_to_minutes(sbatch_options["time"])
+        return minutes is not None and minutes <= threshold
+
+    def submit(self, jobscript, cwd, sbatch_options):
+        """Queue ``jobscript`` and return its packed job ID."""
+        options = {
+            k: v
+            for k, v in sbatch_options.items()
+            if k not in ("time", "job-name", "job_name", "output", "error")
+        }
+        key = json.dumps([cwd, sorted((k, str(v)) for k, v in options.items())])
+        class_id = hashlib.sha1(key.encode()).hexdigest()[:8]
+        with self.lock:
+            pack_class = self.classes.get(class_id)
+            if pack_class is None:
+                pack_class = self.classes[class_id] = PackClass(class_id, cwd, options)
+            number = pack_class.next_number
+            pack_class.next_number += 1
+        jobid = slurm_pack.format_jobid(class_id, number)
+        name = slurm_pack.job_name(number)
+        copy = os.path.join(pack_class.spool_dir, "jobs", name + ".job")
+        shutil.copy(jobscript, copy)
+        logs = {}
+        for o in ("output", "error"):
+            # without an error file, stderr goes to the output file like in sbatch
+            path = (
+                sbatch_options.get(o)
+                or sbatch_options.get("output")
+                or os.path.join(pack_class.spool_dir, "jobs", name + "." + o)
+            )
+            logs[o] = shlex.quote(os.path.join(cwd, path.replace("%j", jobid)))
+        script = os.path.join(pack_class.spool_dir, "jobs", name + ".sh")
+        with open(script, "w") as fh:
+            fh.write(
+                slurm_pack.JOB_SCRIPT
+                % dict(
+                    cwd=shlex.quote(cwd),
+                    seconds=slurm_utils.time_to_minutes(sbatch_options["time"]) * 60,
+                    jobscript=shlex.quote(copy),
+                    **logs,
+                )
+            )
+        os.chmod(script, 0o755)
+        # queue atomically, workers only pick up complete scripts
+        os.rename(script, os.path.join(pack_class.spool_dir, "queue", name + ".sh"))
+        self.ensure_workers(pack_class)
+        return jobid
+
+    def get_state(self, jobid):
+        """Return the state of a packed job, starting workers if needed.
+
+        Returns None if the class of the job is not known to the packer.
+        """
+        class_id, _ = slurm_pack.parse_jobid(jobid)
+        pack_class = self.classes.get(class_id)
+        if pack_class is None:
+            return None
+        state, worker = slurm_pack.read_state(jobid, pack_class.cwd)
+        if state == "PENDING":
+            self.ensure_workers(pack_class)
+        elif state == "RUNNING" and not self._is_alive(worker):
+            state = "FAILED"  # worker allocation ended while running the job
+        return state
+
+    def _is_alive(self, worker):
+        found, state = self.poll_thread.table.find(worker)
+        return found and (state is None or state in ACTIVE_STATES)
+
+    def ensure_workers(self, pack_class):
+        """Submit a worker allocation if the queue is backing up.
+
+        ``sbatch`` is called outside the lock, through ``call_sbatch``.
+        """
+        with self.lock:
+            pack_class.workers = [w for w in pack_class.workers if self._is_alive(w)]
+            queued = pack_class.queued()
+            live = len(pack_class.workers) + pack_class.starting
+            if queued == 0 or live >= self.workers or (live and queued < live):
+                return
+            pack_class.starting += 1
+            script = os.path.join(pack_class.spool_dir, "worker.sh")
+            with open(script + ".tmp", "w") as fh:
+                fh.write(
+                    slurm_pack.WORKER_SCRIPT
+                    % dict(
+                        spool=shlex.quote(pack_class.spool_dir),
+                        walltime_seconds=self.walltime * 60,
+                        idle=self.idle,
+                    )
+                )
+            # replace atomically, sbatch may be reading the script of another worker
+            os.replace(script + ".tmp", script)
+        options = dict(pack_class.sbatch_options)
+        options["time"] = self.walltime
+        options["job-name"] = "snakemake-pack-" + pack_class.class_id
+        options["output"] = os.path.join(pack_class.spool_dir, "workers", "%j.out")
+        worker = None
+        try:
+            worker = call_sbatch(script, pack_class.cwd, options, self.limiter)
+            logger.debug("Started worker %s for class %s", worker, pack_class.class_id)
+            self.poll_thread.register_job(worker)
+        finally:
+            with self.lock:
+                pack_class.starting -= 1
+                if worker is not None:
+                    pack_class.workers.append(worker)
+
+    def stop(self):
+        """Cancel all worker allocations."""
+        workers = [w for c in self.classes.values() for w in c.workers]
+        if workers:
+            cmd = ["scancel"] + workers
+            cluster = CookieCutter.get_cluster_option()
+            if cluster:
+                cmd.append(cluster)
+            subprocess.call(cmd)
+
+
+class RateLimiter:
+    """Token bucket limiting the rate of ``sbatch`` calls of the sidecar
+
+    The release and cancellation of job arrays are paced by the same bucket.
+
+    Callers reserve a token and sleep until it is due, such that they are
+    served in order of arrival.
+    """
+
+    def __init__(self, rate, burst=None):
+        #: Tokens added per second.
+        self.rate = rate
+        #: Maximal number of tokens, one second's worth by default.
+        self.burst = burst or max(1.0, rate)
+        #: Lock protecting the attributes below.
+        self.lock = threading.Lock()
+        #: Available tokens, negative if reserved ahead.
+        self.tokens = self.burst
+        #: Time ``tokens`` was last updated.
+        self.updated = time.time()
+
+    def acquire(self):
+        """Wait until a token is available and take it."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            logger.debug("Rate limit reached, delaying sbatch by %.2fs", delay)
+            time.sleep(delay)
+
+
+def call_sbatch(jobscript, cwd, sbatch_options, limiter=None):
+    """Submit ``jobscript`` paced by ``limiter`` and return the job ID.
+
+    The call is recorded in the metrics.
+    """
+    if limiter is not None:
+        limiter.acquire()
+    start = time.time()
+    error = None
+    try:
+        return slurm_utils.submit_job(jobscript, cwd=cwd, **sbatch_options)
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        metrics.record_call("sbatch", time.time() - start, error)
+
+
+class JobSubmitter:
+    """Submit jobscripts on behalf of ``slurm-submit.py``
+
+    The compiled cluster configuration is kept in memory such that a
+    submission only has to resolve the sbatch options of the job itself.
+    Submissions are run by a pool of ``workers`` threads, and calls to
+    ``sbatch`` are paced by ``limiter`` (if any), such that concurrent
+    submissions do not overload the Slurm controller.
+    """
+
+    def __init__(self, poll_thread, batcher=None, packer=None, workers=4, limiter=None):
+        #: The ``PollSqueueThread`` to register submitted jobs with.
+        self.poll_thread = poll_thread
+        #: The ``JobArrayBatcher`` if jobs are to be submitted as job arrays.
+        self.batcher = batcher
+        #: The ``JobPacker`` if short jobs are to be packed.
+        self.packer = packer
+        #: Threads running the submissions.
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="submit")
+        #: The ``RateLimiter`` of ``sbatch`` calls, if any.
+        self.limiter = limiter
+        if slurm_history.RIGHTSIZE:
+            threading.Thread(target=self._harvest, name="harvest-history", daemon=True).start()
+
+    def _harvest(self):
+        """Collect the outcome of finished jobs of the histories in use, off the submission path."""
+        while True:
+            time.sleep(slurm_history.HARVEST_INTERVAL)
+            try:
+                slurm_history.harvest_all()
+            except Exception:
+                logger.exception("Collecting job outcomes failed")
+
+    def submit(self, jobscript, cwd, sbatch_options=None):
+        """Submit ``jobscript`` from directory ``cwd`` and return the job ID.
+
+        The job is registered before its ID is returned.  If
+        ``sbatch_options`` are given, they are used as resolved by the
+        client instead of being resolved from the cluster configuration.
+        """
+        return self.pool.submit(self._submit, jobscript, cwd, sbatch_options).result()
+
+    def _submit(self, jobscript, cwd, sbatch_options):
+        job_properties = read_job_properties(jobscript)
+        if sbatch_options is None:
+            sbatch_config = slurm_utils.compile_cluster_config(CookieCutter.CLUSTER_CONFIG)
+            sbatch_options = slurm_utils.get_sbatch_options(job_properties, sbatch_config)
+        rule = slurm_utils.JobLog(job_properties).rule_name
+        history = slurm_history.open_history(cwd)
+        if history is not None:
+            sbatch_options = history.rightsize(rule, sbatch_options)
+        for o in ("output", "error"):
+            if o in sbatch_options:
+                slurm_utils.ensure_dirs_exist(os.path.join(cwd, sbatch_options[o]))
+        if self.packer is not None and self.packer.wants(job_properties, sbatch_options):
+            jobid = self.packer.submit(jobscript, cwd, sbatch_options)
+            logger.debug("Packed %s as job %s", jobscript, jobid)
+            return jobid
+        if self.batcher is not None:
+            jobid = self.batcher.submit(jobscript, cwd, sbatch_options, rule)
+        else:
+            jobid = call_sbatch(jobscript, cwd, sbatch_options, self.limiter)
+        logger.debug("Submitted %s as job %s", jobscript, jobid)
+        if history is not None:
+            history.record(jobid, rule, sbatch_options)
+        self.poll_thread.register_job(jobid)
+        return jobid
 
 
 class JobStateHttpHandler(http.server.BaseHTTPRequestHandler):
-    """HTTP handler class that responds to ```/job/status/${jobid}/`` GET requests"""
+    """HTTP handler class that responds to ```/job/status/${jobid}/`` GET requests
+
+    The states of many jobs are queried at once by POSTing ``{"jobids": [...]}``
+    to ``/job/status``, the response is ``{"statuses": {jobid: state}}``.
+    POSTing ``{"states": {jobid: state}, "timeout": seconds}`` to ``/job/wait``
+    blocks until the state of any of the jobs differs from the given one, or
+    the timeout has passed, and responds with ``{"statuses": {jobid: state}}``
+    of the jobs whose state differs.
+
+    ``/stats`` reports the size of the job state table, and ``/metrics``
+    the metrics of the sidecar in the Prometheus text format.
+
+    A shared sidecar attaches runs on POSTs to ``/run/attach`` bearing its
+    secret, and detaches them on POSTs to ``/run/detach`` bearing theirs.
+    """
+
+    #: Routes of the HTTP request metrics.
+    routes = (
+        "/job/status/<jobid>",
+        "/job/register/<jobid>",
+        "/job/status",
+        "/job/wait",
+        "/job/submit",
+        "/stats",
+        "/metrics",
+        "/run/attach",
+        "/run/detach",
+    )
 
     def do_GET(self):
-        """Only to ``/job/status/${job_id}/?``"""
+        """Only to ``/job/status/${job_id}/?``, ``/stats`` and ``/metrics``"""
         logger.debug("--- BEGIN GET")
         # Remove trailing slashes from path.
         path = self.path
         while path.endswith("/"):
             path = path[:-1]
+        if path == "/stats":
+            self._stats()
+            logger.debug("--- END GET")
+            return
+        if path == "/metrics":
+            self._metrics()
+            logger.debug("--- END GET")
+            return
         # Ensure that /job/status was requested
         if not self.path.startswith("/job/status/"):
             self.send_response(400)
             self.end_headers()
             return
         # Ensure authentication bearer is correct
-        auth_required = "Bearer %s" % self.server.http_secret
-        auth_header = self.headers.get("Authorization")
-        logger.debug(
-            "Authorization header is %s, required: %s" % (repr(auth_header), repr(auth_required))
-        )
-        if auth_header != auth_required:
-            self.send_response(403)
-            self.end_headers()
+        run = self._authorize()
+        if run is None:
             return
         # Otherwise, query job ID status
         job_id = self.path[len("/job/status/") :]
         logger.debug("Querying for job ID %s" % repr(job_id))
-        status = self.server.poll_thread.get_state(job_id)
+        status = None
+        if self.server.claim(run, [job_id]):
+            status = self.server.get_state(job_id, run.cwd)
         logger.debug("Status: %s" % status)
         if not status:
             self.send_response(404)
@@ -225,55 +1726,461 @@ class JobStateHttpHandler(http.server.BaseHTTPRequestHandler):
         logger.debug("--- END GET")
 
     def do_POST(self):
-        """Handle POSTs (only to ``/job/register/${job_id}/?``)"""
+        """Handle POSTs (to ``/job/register/${job_id}/?``, ``/job/status``, ``/job/wait``
+        and ``/job/submit``)"""
         logger.debug("--- BEGIN POST")
         # Remove trailing slashes from path.
         path = self.path
         while path.endswith("/"):
             path = path[:-1]
+        if path == "/job/submit":
+            self._submit()
+            logger.debug("--- END POST")
+            return
+        if path == "/job/status":
+            self._bulk_status()
+            logger.debug("--- END POST")
+            return
+        if path == "/job/wait":
+            self._wait()
+            logger.debug("--- END POST")
+            return
+        if path == "/run/attach":
+            self._attach()
+            logger.debug("--- END POST")
+            return
+        if path == "/run/detach":
+            self._detach()
+            logger.debug("--- END POST")
+            return
         # Ensure that /job/register was requested
         if not self.path.startswith("/job/register/"):
             self.send_response(400)
             self.end_headers()
             return
         # Ensure authentication bearer is correct
-        auth_required = "Bearer %s" % self.server.http_secret
-        auth_header = self.headers.get("Authorization")
-        logger.debug(
-            "Authorization header is %s, required: %s", repr(auth_header), repr(auth_required)
-        )
+        run = self._authorize()
+        if run is None:
+            return
         # Otherwise, register job ID
-        job_id = self.path[len("/job/status/") :]
+        job_id = path[len("/job/register/") :]
+        if not self.server.claim(run, [job_id]):
+            self.send_response(409)  # job of another run
+            self.end_headers()
+            return
         self.server.poll_thread.register_job(job_id)
         self.send_response(200)
         self.end_headers()
         logger.debug("--- END POST")
 
+    def _bulk_status(self):
+        """Send the states of the jobids given in the JSON body of the request."""
+        run = self._authorize()
+        if run is None:
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            jobids = [str(j) for j in json.loads(self.rfile.read(length))["jobids"]]
+        except (ValueError, KeyError, TypeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+        visible = self.server.claim(run, jobids)
+        statuses = dict.fromkeys(jobids)
+        statuses.update(
+            self.server.get_states([j for j in jobids if j in visible], cwd=run.cwd)
+        )
+        self._send_json(200, {"statuses": statuses})
+
+    def _wait(self):
+        """Send the states of the jobs that differ from the states in the request."""
+        run = self._authorize()
+        if run is None:
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length))
+            known = {str(j): s for j, s in request["states"].items()}
+            timeout = float(request.get("timeout", WAIT_MAX))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+        visible = self.server.claim(run, known)
+        # jobs of other runs are unknown to this run
+        hidden = {j: None for j, s in known.items() if j not in visible and s is not None}
+        if hidden:
+            self._send_json(200, {"statuses": hidden})
+            return
+        known = {j: s for j, s in known.items() if j in visible}
+        self._send_json(200, {"statuses": self.server.wait_states(known, timeout, run.cwd)})
+
+    def _stats(self):
+        """Send the size of the job state table."""
+        run = self._authorize()
+        if run is None:
+            return
+        stats = self.server.poll_thread.table.stats()
+        stats["runs"] = len(self.server.runs)
+        stats["run_jobs"] = len(run.jobs) if self.server.shared else stats["jobs"]
+        self._send_json(200, stats)
+
+    def _metrics(self):
+        """Send the metrics in the Prometheus text format."""
+        run = self._authorize()
+        if run is None:
+            return
+        poll_thread = self.server.poll_thread
+        stats = poll_thread.table.stats()
+        output = metrics.render(
+            {
+                "slurm_sidecar_jobs": stats["jobs"],
+                "slurm_sidecar_finished_jobs": stats["finished"],
+                "slurm_sidecar_snapshot_jobs": stats["snapshot"],
+                "slurm_sidecar_state_table_bytes": stats["bytes"],
+                "slurm_sidecar_poll_interval_seconds": poll_thread.interval,
+            }
+        )
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4")
+        self.end_headers()
+        self.wfile.write(output.encode("utf-8"))
+
+    def _submit(self):
+        """Submit the jobscript given in the JSON body of the request.
+
+        The body is ``{"jobscript": path, "cwd": path}``, optionally with the
+        resolved ``"sbatch_options"``.
+        """
+        run = self._authorize()
+        if run is None:
+            return
+        if self.server.submitter is None:
+            self.send_response(503)
+            self.end_headers()
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length))
+            jobscript = str(request["jobscript"])
+            cwd = str(request["cwd"])
+            sbatch_options = request.get("sbatch_options")
+            if sbatch_options is not None and not isinstance(sbatch_options, dict):
+                raise TypeError("sbatch_options must be an object")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+        try:
+            jobid = self.server.submitter.submit(jobscript, cwd, sbatch_options)
+        except Exception as e:
+            logger.exception("Submission of %s failed", jobscript)
+            self._send_json(500, {"error": str(e)})
+        else:
+            self.server.claim(run, [jobid])
+            self._send_json(200, {"jobid": jobid})
+
+    def _attach(self):
+        """Attach a run to the shared sidecar and send its variables."""
+        if not self.server.shared or self.headers.get("Authorization") != (
+            "Bearer %s" % self.server.http_secret
+        ):
+            self.send_response(403)
+            self.end_headers()
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            cwd = json.loads(self.rfile.read(length) or "{}").get("cwd")
+        except (ValueError, AttributeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+        run = self.server.attach(cwd)
+        if run is None:
+            self.send_response(503)  # shutting down
+            self.end_headers()
+            return
+        run_vars = {"server_port": self.server.server_port, "server_secret": run.secret}
+        if self.server.server_socket_path:
+            run_vars["server_socket"] = self.server.server_socket_path
+        self._send_json(200, run_vars)
+
+    def _detach(self):
+        """Detach the run of the request from the shared sidecar."""
+        run = self._authorize()
+        if run is None:
+            return
+        self.server.detach(run)
+        self.send_response(200)
+        self.end_headers()
+
+    def _authorize(self):
+        """Return the ``ClientRun`` of the bearer of the request, or send 403 and return None."""
+        run = self.server.authorize(self.headers.get("Authorization"))
+        if run is None:
+            self.send_response(403)
+            self.end_headers()
+        return run
+
+    def _send_json(self, code, data):
+        """Send ``data`` as JSON response with status ``code``."""
+        output = json.dumps(data)
+        logger.debug("Sending %s" % repr(output))
+        self.send_response(code)
+        self.send_header("Content-type", "application/json")
+        self.end_headers()
+        self.wfile.write(output.encode("utf-8"))
+
     def log_request(self, *args, **kwargs):
         if LOG_REQUESTS:
             super().log_request(*args, **kwargs)
 
+    def address_string(self):
+        """Return the client address, clients on the Unix domain socket have none."""
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix-socket"
+
+    def handle_one_request(self):
+        """Handle a request, recording its duration by route in the metrics."""
+        self.command = None
+        start = time.time()
+        super().handle_one_request()
+        if not self.command:
+            return  # connection closed or malformed request
+        path = self.path.rstrip("/")
+        for prefix in ("/job/status/", "/job/register/"):
+            if path.startswith(prefix):
+                path = prefix + "<jobid>"
+        if path not in self.routes:
+            path = "other"
+        metrics.observe(
+            "slurm_sidecar_http_request_seconds",
+            time.time() - start,
+            method=self.command,
+            route=path,
+        )
+
+
+class ClientRun:
+    """A Snakemake run served by the sidecar, with its namespace of jobs"""
 
-class JobStateHttpServer(http.server.HTTPServer):
-    """The HTTP server class"""
+    def __init__(self, secret, cwd=None):
+        #: The secret of the requests of the run.
+        self.secret = secret
+        #: Working directory of the run, holding the spool of its packed jobs.
+        self.cwd = cwd or os.getcwd()
+        #: IDs of the jobs registered, submitted or queried by the run, if shared.
+        self.jobs = set()
+        #: Time of the last request of the run.
+        self.seen = time.time()
+
+
+class JobStateHttpServer(http.server.ThreadingHTTPServer):
+    """The HTTP server class, handling each request in its own thread
+
+    A ``shared`` server serves the runs attached to it and writes its
+    variables to ``shared_runtime_file()`` instead of stdout.  It shuts
+    down when no run has been attached for ``SHARED_IDLE`` seconds; runs
+    not seen for ``RUN_TIMEOUT`` seconds are detached.
+    """
 
     allow_reuse_address = False
+    #: Raise the listen backlog for many concurrent status clients.
+    request_queue_size = 128
 
-    def __init__(self, poll_thread):
+    def __init__(self, poll_thread, shared=False):
         """Initialize thread and print the ``SNAKEMAKE_CLUSTER_SIDECAR_VARS`` to stdout, then flush."""
         super().__init__(("0.0.0.0", 0), JobStateHttpHandler)
+        #: Whether the sidecar is shared by the runs of the user.
+        self.shared = shared
+        #: Dict mapping secrets to the attached ``ClientRun``.
+        self.runs = {}
+        #: Dict mapping the IDs of the jobs of the runs to their ``ClientRun``, if shared.
+        self.owners = {}
+        #: Lock protecting ``runs``, ``owners`` and the jobs of the runs.
+        self.runs_lock = threading.Lock()
+        #: Whether the shared sidecar is shutting down.
+        self.closing = False
         #: The ``PollSqueueThread`` with the state dictionary.
         self.poll_thread = poll_thread
-        #: The secret to use.
+        #: The ``JobSubmitter`` running the submission service, if enabled.  A
+        #: shared sidecar does not submit, as ``sbatch`` would export its
+        #: environment instead of the one of the run; its runs submit in-process.
+        self.submitter = None
+        if SIDECAR_SUBMIT and not shared:
+            limiter = RateLimiter(SUBMIT_RATE) if SUBMIT_RATE > 0 else None
+            batcher = None
+            if ARRAY_WINDOW > 0:
+                batcher = JobArrayBatcher(ARRAY_WINDOW, ARRAY_SIZE, limiter)
+            packer = None
+            if PACK_RUNTIME > 0:
+                packer = JobPacker(
+                    poll_thread, PACK_RUNTIME, PACK_WALLTIME, PACK_WORKERS, PACK_IDLE, limiter
+                )
+            self.submitter = JobSubmitter(
+                poll_thread, batcher, packer, SUBMIT_WORKERS, limiter
+            )
+        #: The secret to use, of the single run or of attaching runs if ``shared``.
         self.http_secret = str(uuid.uuid4())
+        #: The ``UnixJobStateHttpServer`` serving the Unix domain socket, if enabled.
+        self.unix_server = None
+        #: Path of the Unix domain socket, or None.
+        self.server_socket_path = None
+        if UNIX_SOCKET:
+            path = os.path.join(slurm_utils.RUNTIME_DIR, "sidecar-%d.sock" % os.getpid())
+            try:
+                self.unix_server = UnixJobStateHttpServer(path, self)
+                self.server_socket_path = path
+            except OSError as e:
+                logger.warning("Not listening on Unix domain socket %s: %s", path, e)
         sidecar_vars = {
             "server_port": self.server_port,
             "server_secret": self.http_secret,
             "pid": os.getpid(),
         }
+        if self.server_socket_path:
+            sidecar_vars["server_socket"] = self.server_socket_path
         logger.debug(json.dumps(sidecar_vars))
-        sys.stdout.write(json.dumps(sidecar_vars) + "\n")
-        sys.stdout.flush()
+        if shared:
+            poll_thread.table.on_evict = self._forget
+            write_runtime_file(shared_runtime_file(), sidecar_vars)
+            threading.Thread(target=self._watch_runs, name="watch-runs", daemon=True).start()
+        else:
+            self.runs[self.http_secret] = ClientRun(self.http_secret)
+            sys.stdout.write(json.dumps(sidecar_vars) + "\n")
+            sys.stdout.flush()
+
+    def authorize(self, header):
+        """Return the ``ClientRun`` bearing the ``Authorization`` header, or None."""
+        if not header or not header.startswith("Bearer "):
+            return None
+        run = self.runs.get(header[len("Bearer ") :])
+        if run is not None:
+            run.seen = time.time()
+        return run
+
+    def claim(self, run, jobids):
+        """Add ``jobids`` to the namespace of ``run``, return the set of those it may see.
+
+        Jobs already in the namespace of another run are neither added nor
+        returned, such that runs attached to a shared sidecar only see
+        their own jobs.  Jobs of no run are claimed by the first run asking
+        for them, which covers runs whose registration of a job failed.
+        The single run of a sidecar that is not shared sees all jobs.
+        """
+        if not self.shared:
+            return set(jobids)
+        visible = set()
+        with self.runs_lock:
+            for jobid in jobids:
+                if self.owners.setdefault(jobid, run) is run:
+                    visible.add(jobid)
+            run.jobs.update(visible)
+        return visible
+
+    def _forget(self, jobid):
+        """Drop evicted ``jobid`` from the namespace of its run."""
+        with self.runs_lock:
+            run = self.owners.pop(jobid, None)
+            if run is not None:
+                run.jobs.discard(jobid)
+
+    def attach(self, cwd=None):
+        """Return a new ``ClientRun`` working in ``cwd``, or None if shutting down."""
+        with self.runs_lock:
+            if self.closing:
+                return None
+            run = ClientRun(str(uuid.uuid4()), cwd)
+            self.runs[run.secret] = run
+        logger.debug("Attached run, %d runs", len(self.runs))
+        return run
+
+    def detach(self, run):
+        """Detach ``run`` and drop its jobs that no other run uses."""
+        with self.runs_lock:
+            self.runs.pop(run.secret, None)
+            orphaned = list(run.jobs)
+            for jobid in orphaned:
+                self.owners.pop(jobid, None)
+        self.poll_thread.table.discard(orphaned)
+        logger.debug("Detached run with %d jobs, %d runs", len(run.jobs), len(self.runs))
+
+    def _watch_runs(self):
+        """Detach runs gone silent, shut down when idle for ``SHARED_IDLE`` seconds."""
+        idle_since = time.time()
+        while True:
+            time.sleep(min(1.0, SHARED_IDLE / 2))
+            now = time.time()
+            for run in list(self.runs.values()):
+                if now - run.seen > RUN_TIMEOUT:
+                    logger.debug("Run not seen for %ds, detaching", now - run.seen)
+                    self.detach(run)
+            with self.runs_lock:
+                if self.runs:
+                    idle_since = now
+                elif now - idle_since >= SHARED_IDLE:
+                    self.closing = True
+            if self.closing:
+                logger.debug("No runs attached, shutting down")
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+
+    def get_state(self, jobid, cwd=None):
+        """Return the state of a Slurm job or packed job of a run working in ``cwd``."""
+        if slurm_pack.is_packed_jobid(jobid):
+            state = None
+            if self.submitter is not None and self.submitter.packer is not None:
+                state = self.submitter.packer.get_state(jobid)
+            if state is None:
+                state = self._get_packed_state(jobid, cwd or os.getcwd())
+            return state
+        return self.poll_thread.get_state(jobid)
+
+    def _get_packed_state(self, jobid, cwd):
+        """Return the state of a packed job from its spool directory in ``cwd``.
+
+        Used for packed jobs of classes unknown to the packer, e.g. after a
+        restart of the sidecar, like ``slurm-status.py`` does.
+        """
+        state, worker = slurm_pack.read_state(jobid, cwd)
+        if state == "RUNNING" and worker:
+            worker_state = self.poll_thread.get_states([worker], observe=False)[worker]
+            if worker_state is not None and worker_state not in ACTIVE_STATES:
+                state = "FAILED"  # worker allocation ended while running the job
+        return state
+
+    def get_states(self, jobids, observe=True, cwd=None):
+        """Return dict mapping jobids of Slurm jobs or packed jobs to states."""
+        packed = [j for j in jobids if slurm_pack.is_packed_jobid(j)]
+        states = self.poll_thread.get_states([j for j in jobids if j not in packed], observe)
+        for jobid in packed:
+            states[jobid] = self.get_state(jobid, cwd)
+        return states
+
+    def wait_states(self, known, timeout, cwd=None):
+        """Return dict mapping the jobs whose state differs from ``known`` to their states.
+
+        If no state differs, waits up to ``timeout`` seconds (at most
+        ``WAIT_MAX``) for one to change.  Packed jobs are re-read every
+        second as their state changes are not signalled.  Finished jobs are
+        only evicted once their change has been returned, such that they are
+        not looked up again on every wakeup.
+        """
+        table = self.poll_thread.table
+        deadline = time.time() + min(timeout, WAIT_MAX)
+        packed = any(slurm_pack.is_packed_jobid(j) for j in known)
+        while True:
+            version = table.version
+            states = self.get_states(list(known), observe=False, cwd=cwd)
+            changed = {j: s for j, s in states.items() if s != known[j]}
+            remaining = deadline - time.time()
+            if changed or remaining <= 0:
+                for jobid, state in changed.items():
+                    if state is not None:
+                        table.observed(jobid)
+                return changed
+            table.wait(version, min(remaining, 1) if packed else remaining)
 
     def log_message(self, *args, **kwargs):
         """Log messages are printed if ``DEBUG`` is ``True``."""
@@ -281,16 +2188,181 @@ class JobStateHttpServer(http.server.HTTPServer):
             super().log_message(*args, **kwargs)
 
 
+class UnixJobStateHttpServer(socketserver.ThreadingUnixStreamServer):
+    """Serves the requests of a ``JobStateHttpServer`` on a Unix domain socket
+
+    The socket is accessible by the user only, in a directory only the
+    user can enter.  All other attributes are those of the TCP server,
+    such that the handler sees the same state on either transport.
+    """
+
+    daemon_threads = True
+    #: Raise the listen backlog for many concurrent status clients.
+    request_queue_size = 128
+
+    def __init__(self, path, tcp_server):
+        slurm_utils.ensure_private_dir(os.path.dirname(path))
+        if os.path.exists(path):
+            os.remove(path)  # left behind by a process with the same pid
+        #: The ``JobStateHttpServer`` whose state is served.
+        self.tcp_server = tcp_server
+        super().__init__(path, JobStateHttpHandler)
+        os.chmod(path, 0o600)
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["tcp_server"], name)
+
+    def server_close(self):
+        """Close the socket and remove its file."""
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def shared_runtime_file():
+    """Return the runtime file of the shared sidecar of the user and this profile."""
+    profile_dir = os.path.dirname(os.path.abspath(__file__))
+    profile_hash = hashlib.sha1(profile_dir.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(slurm_utils.RUNTIME_DIR, "sidecar-%s.json" % profile_hash)
+
+
+def write_runtime_file(path, sidecar_vars):
+    """Atomically write the variables of the shared sidecar, readable by the user only."""
+    slurm_utils.ensure_private_dir(os.path.dirname(path))
+    tmp = "%s.%d" % (path, os.getpid())
+    with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as fh:
+        json.dump(sidecar_vars, fh)
+    os.replace(tmp, path)
+
+
+def read_runtime_file(path):
+    """Return the variables of the shared sidecar, or None."""
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def shared_request(sidecar_vars, method, path, body=None):
+    """Send a request to the shared sidecar, return the status and the body."""
+    return slurm_sidecar_client.request(sidecar_vars, method, path, body, timeout=30)
+
+
+def start_shared(path):
+    """Start the shared sidecar and wait until it has written its runtime file."""
+    logger.debug("Starting shared sidecar")
+    with open(path[: -len(".json")] + ".log", "a") as log:
+        proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--shared"],
+            cwd=os.path.dirname(path),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+            start_new_session=True,
+        )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        sidecar_vars = read_runtime_file(path)
+        if sidecar_vars is not None and sidecar_vars["pid"] == proc.pid:
+            return
+        if proc.poll() is not None:
+            break
+        time.sleep(0.1)
+    raise RuntimeError("shared sidecar did not start, see %s" % log.name)
+
+
+def attach_shared():
+    """Attach a run to the shared sidecar, starting it if needed, and return its variables."""
+    path = shared_runtime_file()
+    slurm_utils.ensure_private_dir(os.path.dirname(path))
+    attach = {"cwd": os.getcwd()}
+    with open(path[: -len(".json")] + ".lock", "w") as lock:
+        # one run at a time discovers or starts the shared sidecar
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        sidecar_vars = read_runtime_file(path)
+        if sidecar_vars is not None:
+            try:
+                status, body = shared_request(sidecar_vars, "POST", "/run/attach", attach)
+            except OSError:
+                status = None  # stale runtime file
+            if status == 200:
+                return json.loads(body)
+        start_shared(path)
+        status, body = shared_request(read_runtime_file(path), "POST", "/run/attach", attach)
+        if status != 200:
+            raise RuntimeError("could not attach to shared sidecar (%d)" % status)
+        return json.loads(body)
+
+
+def run_shared_client():
+    """Attach to the shared sidecar, print the variables and stay attached until terminated.
+
+    The run is detached when this process is terminated by Snakemake, or
+    when Snakemake has gone.
+    """
+    run_vars = attach_shared()
+    run_vars["pid"] = os.getpid()
+    sys.stdout.write(json.dumps(run_vars) + "\n")
+    sys.stdout.flush()
+
+    stopped = threading.Event()
+
+    def signal_handler(signum, frame):
+        stopped.set()
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    parent = os.getppid()
+    while not stopped.wait(RUN_HEARTBEAT):
+        if os.getppid() != parent:
+            break  # Snakemake has gone
+        try:
+            shared_request(run_vars, "GET", "/stats")
+        except OSError as e:
+            logger.debug("Heartbeat to shared sidecar failed: %s", e)
+    try:
+        shared_request(run_vars, "POST", "/run/detach")
+    except OSError as e:
+        logger.debug("Detaching from shared sidecar failed: %s", e)
+
+
 def main():
+    shared = "--shared" in sys.argv[1:]
+    if SHARED and not shared:
+        return run_shared_client()
+    journal = JOURNAL
+    if shared and JOURNAL:
+        journal = shared_runtime_file()[: -len(".json")] + ".journal"
+
     # Start thread to poll ``squeue`` in a controlled fashion.
-    poll_thread = PollSqueueThread(SQUEUE_WAIT, SQUEUE_CMD, name="poll-squeue")
+    poll_class = PollSqueueThread
+    if SQUEUE_ITERATE and slurm_utils.BACKEND == "cli":
+        poll_class = IterateSqueueThread
+    poll_thread = poll_class(
+        SQUEUE_WAIT,
+        SQUEUE_CMD,
+        min_wait=SQUEUE_MIN_WAIT,
+        adaptive=SQUEUE_ADAPTIVE,
+        min_job_age=MIN_JOB_AGE,
+        state_ttl=STATE_TTL,
+        journal=StateJournal(journal) if journal else None,
+        sacct_wait=SACCT_DELTA_WAIT,
+        name="poll-squeue",
+    )
     poll_thread.start()
 
     # Initialize HTTP server that makes available the output of ``squeue --user [user]``
     # in a controlled fashion.
-    http_server = JobStateHttpServer(poll_thread)
+    http_server = JobStateHttpServer(poll_thread, shared=shared)
     http_thread = threading.Thread(name="http-server", target=http_server.serve_forever)
     http_thread.start()
+    unix_server = http_server.unix_server
+    if unix_server is not None:
+        unix_thread = threading.Thread(name="unix-server", target=unix_server.serve_forever)
+        unix_thread.start()
 
     # Allow for graceful shutdown of poll thread and HTTP server.
     def signal_handler(signum, frame):
@@ -300,6 +2372,14 @@ def main():
         # set_trace()
         poll_thread.stop()
         http_server.shutdown()
+        if unix_server is not None:
+            unix_server.shutdown()
+        if http_server.submitter is not None and http_server.submitter.batcher is not None:
+            http_server.submitter.batcher.close_all()
+        if http_server.submitter is not None and http_server.submitter.packer is not None:
+            http_server.submitter.packer.stop()
+        if http_server.submitter is not None:
+            http_server.submitter.pool.shutdown(wait=False)
         logger.info("... HTTP server and poll thread shutdown complete.")
         for thread in threading.enumerate():
             logger.info("ACTIVE %s", thread.name)
@@ -312,6 +2392,13 @@ def main():
     logger.debug("poll_thread done")
     http_thread.join()
     logger.debug("http_thread done")
+    if unix_server is not None:
+        unix_thread.join()
+        unix_server.server_close()
+    if shared:
+        sidecar_vars = read_runtime_file(shared_runtime_file())
+        if sidecar_vars is not None and sidecar_vars["pid"] == os.getpid():
+            os.remove(shared_runtime_file())
 
 
 if __name__ == "__main__":
@@ -1,19 +1,33 @@
 #!/usr/bin/env python3
+"""
+Snakemake SLURM status script.
+
+Called with a single job ID, prints the status of the job (``running``,
+``success`` or ``failed``) as expected by Snakemake's ``--cluster-status``.
+Called with several job IDs, prints one line ``<jobid> <status>`` per job,
+looking up all jobs with a single request to the sidecar or a single call
+to ``sacct``.
+
+The sidecar is queried with the standard library only, preferably over its
+Unix domain socket; the modules calling ``sacct`` and ``scontrol`` are
+only imported when querying them directly, which keeps the start-up of
+this script short.
+"""
 import json
 import os
-import re
-import requests
-import subprocess as sp
-import shlex
 import sys
-import time
 import logging
-from CookieCutter import CookieCutter
+import slurm_pack
+import slurm_sidecar_client
 
 logger = logging.getLogger(__name__)
 
 STATUS_ATTEMPTS = 20
+#: Seconds to keep looking up a job in sacct once slurmctld has forgotten it,
+#: as slurmdbd may not have recorded the job yet
+ACCOUNTING_DELAY = 60
 SIDECAR_VARS = os.environ.get("SNAKEMAKE_CLUSTER_SIDECAR_VARS", None)
+BACKEND = os.environ.get("SNAKEMAKE_SLURM_BACKEND", "cli")
 DEBUG = bool(int(os.environ.get("SNAKEMAKE_SLURM_DEBUG", "0")))
 
 if DEBUG:
@@ -21,14 +35,43 @@ if DEBUG:
     logger.setLevel(logging.DEBUG)
 
 
+def status_retry():
+    """Return the retry policy of ``sacct`` and ``scontrol`` calls"""
+    import slurm_retry
+
+    return slurm_retry.RetryPolicy(max_tries=STATUS_ATTEMPTS, base_delay=0.5, max_delay=5.0)
+
+
+def get_status_rest(jobid):
+    """Get status from slurmrestd"""
+    import slurm_utils
+
+    return slurm_utils.get_backend().job_states([jobid]).get(jobid) or ""
+
+
 def get_status_direct(jobid):
     """Get status directly from sacct/scontrol"""
+    if BACKEND == "rest":
+        return get_status_rest(jobid)
+    import re
+    import shlex
+    import subprocess as sp
+    import time
+    from CookieCutter import CookieCutter
+
+    retry = status_retry()
     cluster = CookieCutter.get_cluster_option()
+    deadline = time.time() + ACCOUNTING_DELAY
     for i in range(STATUS_ATTEMPTS):
         try:
-            sacct_res = sp.check_output(shlex.split(f"sacct {cluster} -P -b -j {jobid} -n"))
+            sacct_res = sp.check_output(
+                shlex.split(f"sacct {cluster} -P -b -j {jobid} -n"), stderr=sp.PIPE
+            )
             res = {x.split("|")[0]: x.split("|")[1] for x in sacct_res.decode().strip().split("\n")}
-            break
+            if jobid in res:
+                break
+            # pending job array tasks are listed as ``<arrayid>_[<tasks>]``
+            logger.debug("sacct has no entry for %s", jobid)
         except sp.CalledProcessError as e:
             logger.error("sacct process error")
             logger.error(e)
@@ -37,70 +80,160 @@ def get_status_direct(jobid):
             pass
         # Try getting job with scontrol instead in case sacct is misconfigured
         try:
-            sctrl_res = sp.check_output(shlex.split(f"scontrol {cluster} -o show job {jobid}"))
+            sctrl_res = sp.check_output(
+                shlex.split(f"scontrol {cluster} -o show job {jobid}"), stderr=sp.PIPE
+            )
             m = re.search(r"JobState=(\w+)", sctrl_res.decode())
             res = {jobid: m.group(1)}
             break
         except sp.CalledProcessError as e:
             logger.error("scontrol process error")
             logger.error(e)
+            error = e.stderr.decode()
             if i >= STATUS_ATTEMPTS - 1:
-                print("failed")
-                exit(0)
-            else:
-                time.sleep(1)
+                return "FAILED"
+            if not retry.should_retry(error):
+                # a job unknown to slurmctld may not have reached slurmdbd yet
+                if "Invalid job id" not in error or time.time() >= deadline:
+                    return "FAILED"
+            time.sleep(retry.delay(i + 1))
 
     return res[jobid] or ""
 
 
+def get_statuses_direct(jobids):
+    """Get status of many jobs with a single call to sacct"""
+    statuses = {}
+    slurm_jobids = [j for j in jobids if not slurm_pack.is_packed_jobid(j)]
+    if slurm_jobids and BACKEND == "rest":
+        import slurm_utils
+
+        statuses.update(slurm_utils.get_backend().job_states(slurm_jobids))
+    elif slurm_jobids:
+        import subprocess as sp
+        from CookieCutter import CookieCutter
+
+        cmd = ["sacct", "-P", "-b", "-n", "-j", ",".join(slurm_jobids)]
+        cluster = CookieCutter.get_cluster_option()
+        if cluster:
+            cmd.append(cluster)
+        try:
+            output = status_retry().call(cmd)
+        except (sp.CalledProcessError, sp.TimeoutExpired) as e:
+            logger.error("sacct process error")
+            logger.error(e)
+        else:
+            for line in output.splitlines():
+                arr = line.strip().split("|")
+                if len(arr) >= 2 and arr[0] in slurm_jobids:
+                    statuses[arr[0]] = arr[1]
+    for jobid in jobids:
+        if statuses.get(jobid):
+            continue
+        # packed jobs, pending job array tasks or jobs unknown to sacct
+        if slurm_pack.is_packed_jobid(jobid):
+            statuses[jobid] = get_status_packed(jobid)
+        else:
+            statuses[jobid] = get_status_direct(jobid)
+    return statuses
+
+
+def get_status_packed(jobid):
+    """Get status of a packed job from its spool directory"""
+    state, worker = slurm_pack.read_state(jobid, os.getcwd())
+    if state == "RUNNING" and get_status_direct(worker) not in ("RUNNING", "COMPLETING"):
+        return "FAILED"  # worker allocation ended while running the job
+    return state
+
+
 def get_status_sidecar(jobid):
     """Get status from cluster sidecar"""
     sidecar_vars = json.loads(SIDECAR_VARS)
-    url = "http://localhost:%d/job/status/%s" % (sidecar_vars["server_port"], jobid)
-    headers = {"Authorization": "Bearer %s" % sidecar_vars["server_secret"]}
     try:
-        resp = requests.get(url, headers=headers)
-        if resp.status_code == 404:
-            return ""  # not found yet
-        logger.debug("sidecar returned: %s" % resp.json())
-        resp.raise_for_status()
-        return resp.json().get("status") or ""
-    except requests.exceptions.ConnectionError as e:
+        status, body = slurm_sidecar_client.request(
+            sidecar_vars, "GET", "/job/status/%s" % jobid
+        )
+    except OSError as e:
         logger.warning("slurm-status.py: could not query side car: %s", e)
         logger.info("slurm-status.py: falling back to direct query")
+        if slurm_pack.is_packed_jobid(jobid):
+            return get_status_packed(jobid)
         return get_status_direct(jobid)
+    if status == 404:
+        return ""  # not found yet
+    logger.debug("sidecar returned: %s" % body)
+    if status != 200:
+        raise RuntimeError("sidecar returned %d: %s" % (status, body))
+    return json.loads(body).get("status") or ""
+
+
+def get_statuses_sidecar(jobids):
+    """Get status of many jobs from cluster sidecar with a single request"""
+    sidecar_vars = json.loads(SIDECAR_VARS)
+    try:
+        status, body = slurm_sidecar_client.request(
+            sidecar_vars, "POST", "/job/status", body={"jobids": jobids}
+        )
+    except OSError as e:
+        logger.warning("slurm-status.py: could not query side car: %s", e)
+        logger.info("slurm-status.py: falling back to direct query")
+        return get_statuses_direct(jobids)
+    logger.debug("sidecar returned: %s" % body)
+    if status != 200:
+        raise RuntimeError("sidecar returned %d: %s" % (status, body))
+    return {k: v or "" for k, v in json.loads(body)["statuses"].items()}
+
 
+def status_to_snakemake(status):
+    """Translate the Slurm job state to the status reported to Snakemake"""
+    if status == "BOOT_FAIL":
+        return "failed"
+    elif status == "OUT_OF_MEMORY":
+        return "failed"
+    elif status.startswith("CANCELLED"):
+        return "failed"
+    elif status == "COMPLETED":
+        return "success"
+    elif status == "DEADLINE":
+        return "failed"
+    elif status == "FAILED":
+        return "failed"
+    elif status == "NODE_FAIL":
+        return "failed"
+    elif status == "PREEMPTED":
+        return "failed"
+    elif status == "TIMEOUT":
+        return "failed"
+    elif status == "SUSPENDED":
+        return "running"
+    else:
+        return "running"
+
+
+if len(sys.argv) > 2:
+    jobids = sys.argv[1:]
+    if SIDECAR_VARS:
+        logger.debug("slurm-status.py: querying sidecar")
+        statuses = get_statuses_sidecar(jobids)
+    else:
+        logger.debug("slurm-status.py: direct query")
+        statuses = get_statuses_direct(jobids)
+    for jobid in jobids:
+        print(jobid, status_to_snakemake(statuses.get(jobid, "")))
+    sys.exit(0)
 
 jobid = sys.argv[1]
 
 if SIDECAR_VARS:
     logger.debug("slurm-status.py: querying sidecar")
     status = get_status_sidecar(jobid)
+elif slurm_pack.is_packed_jobid(jobid):
+    logger.debug("slurm-status.py: reading packed job state")
+    status = get_status_packed(jobid)
 else:
     logger.debug("slurm-status.py: direct query")
     status = get_status_direct(jobid)
 
 logger.debug("job status: %s", repr(status))
 
-if status == "BOOT_FAIL":
-    print("failed")
-elif status == "OUT_OF_MEMORY":
-    print("failed")
-elif status.startswith("CANCELLED"):
-    print("failed")
-elif status == "COMPLETED":
-    print("success")
-elif status == "DEADLINE":
-    print("failed")
-elif status == "FAILED":
-    print("failed")
-elif status == "NODE_FAIL":
-    print("failed")
-elif status == "PREEMPTED":
-    print("failed")
-elif status == "TIMEOUT":
-    print("failed")
-elif status == "SUSPENDED":
-    print("running")
-else:
-    print("running")
+print(status_to_snakemake(status))
@@ -1,16 +1,19 @@
 #!/usr/bin/env python3
 """
 Snakemake SLURM submit script.
+
+If the cluster sidecar is running, the jobscript is forwarded to it and
+submitted by its submission service, which keeps the profile
+configuration loaded between jobs. Only if the sidecar cannot be reached
+are the (comparatively slow to import) submission modules loaded and
+the job submitted in-process.
 """
 import json
 import logging
 import os
+import sys
 
-import requests
-from snakemake.utils import read_job_properties
-
-import slurm_utils
-from CookieCutter import CookieCutter
+import slurm_sidecar_client
 
 logger = logging.getLogger(__name__)
 
@@ -22,84 +25,93 @@ if DEBUG:
     logger.setLevel(logging.DEBUG)
 
 
+class SidecarUnavailable(Exception):
+    """The sidecar cannot take the submission."""
+
+
+def submit_with_sidecar(jobscript):
+    """Forward jobscript to the sidecar and return the jobid."""
+    sidecar_vars = json.loads(SIDECAR_VARS)
+    body = {"jobscript": os.path.abspath(jobscript), "cwd": os.getcwd()}
+    logger.debug("POST to /job/submit on port %d", sidecar_vars["server_port"])
+    try:
+        status, output = slurm_sidecar_client.request(sidecar_vars, "POST", "/job/submit", body)
+    except slurm_sidecar_client.ConnectError as e:
+        raise SidecarUnavailable(e)
+    except OSError as e:
+        # the sidecar may have submitted the job, submitting again could duplicate it
+        sys.stderr.write("slurm-submit.py: submission through sidecar failed: %s\n" % e)
+        sys.exit(1)
+    output = output.decode()
+    if status in (400, 404, 503):
+        # sidecar without (enabled) submission service
+        raise SidecarUnavailable("sidecar returned %d" % status)
+    if status != 200:
+        sys.stderr.write("slurm-submit.py: submission failed: %s\n" % output)
+        sys.exit(1)
+    return json.loads(output)["jobid"]
+
+
 def register_with_sidecar(jobid):
+    """Register the job with the sidecar, if it can be reached.
+
+    The job is submitted at this point, so failing to register it must not
+    fail the submission; the sidecar looks up unregistered jobs on their
+    first status query.
+    """
     if SIDECAR_VARS is None:
         return
     sidecar_vars = json.loads(SIDECAR_VARS)
-    url = "http://localhost:%d/job/register/%s" % (sidecar_vars["server_port"], jobid)
-    logger.debug("POST to %s", url)
-    headers = {"Authorization": "Bearer %s" % sidecar_vars["server_secret"]}
-    requests.post(url, headers=headers)
-
-
-# cookiecutter arguments
-SBATCH_DEFAULTS = CookieCutter.SBATCH_DEFAULTS
-CLUSTER = CookieCutter.get_cluster_option()
-CLUSTER_CONFIG = CookieCutter.CLUSTER_CONFIG
-
-RESOURCE_MAPPING = {
-    "time": ("time", "runtime", "walltime"),
-    "mem": ("mem", "mem_mb", "ram", "memory"),
-    "mem-per-cpu": ("mem-per-cpu", "mem_per_cpu", "mem_per_thread"),
-    "nodes": ("nodes", "nnodes"),
-    "partition": ("partition", "queue"),
-}
-
-# parse job
-jobscript = slurm_utils.parse_jobscript()
-job_properties = read_job_properties(jobscript)
-
-sbatch_options = {}
-cluster_config = slurm_utils.load_cluster_config(CLUSTER_CONFIG)
-
-# 1) sbatch default arguments and cluster
-sbatch_options.update(slurm_utils.parse_sbatch_defaults(SBATCH_DEFAULTS))
-sbatch_options.update(slurm_utils.parse_sbatch_defaults(CLUSTER))
-
-# 2) cluster_config defaults
-sbatch_options.update(cluster_config["__default__"])
-
-# 3) Convert resources (no unit conversion!) and threads
-sbatch_options.update(slurm_utils.convert_job_properties(job_properties, RESOURCE_MAPPING))
-
-# 4) cluster_config for particular rule
-sbatch_options.update(cluster_config.get(job_properties.get("rule"), {}))
-
-# 5) cluster_config options
-sbatch_options.update(job_properties.get("cluster", {}))
-
-# convert human-friendly time - leaves slurm format time as is
-if "time" in sbatch_options:
-    duration = str(sbatch_options["time"])
-    sbatch_options["time"] = str(slurm_utils.Time(duration))
-
-# 6) Format pattern in snakemake style
-sbatch_options = slurm_utils.format_values(sbatch_options, job_properties)
-
-# 7) create output and error filenames and paths
-joblog = slurm_utils.JobLog(job_properties)
-log = ""
-if "output" not in sbatch_options and CookieCutter.get_cluster_logpath():
-    outlog = joblog.outlog
-    log = outlog
-    sbatch_options["output"] = outlog
-
-if "error" not in sbatch_options and CookieCutter.get_cluster_logpath():
-    errlog = joblog.errlog
-    log = errlog
-    sbatch_options["error"] = errlog
-
-# ensure sbatch output dirs exist
-for o in ("output", "error"):
-    slurm_utils.ensure_dirs_exist(sbatch_options[o]) if o in sbatch_options else None
-
-# 9) Set slurm job name
-if "job-name" not in sbatch_options and "job_name" not in sbatch_options:
-    sbatch_options["job-name"] = joblog.jobname
-
-# submit job and echo id back to Snakemake (must be the only stdout)
-jobid = slurm_utils.submit_job(jobscript, **sbatch_options)
-logger.debug("Registering %s with sidecar...", jobid)
-register_with_sidecar(jobid)
-logger.debug("... done registering with sidecar")
+    logger.debug("POST to /job/register/%s", jobid)
+    try:
+        slurm_sidecar_client.request(sidecar_vars, "POST", "/job/register/%s" % jobid)
+    except OSError as e:
+        logger.warning("slurm-submit.py: could not register %s with sidecar: %s", jobid, e)
+
+
+def submit_direct():
+    """Submit the job from this process and return the jobid."""
+    from snakemake.utils import read_job_properties
+
+    import slurm_history
+    import slurm_utils
+    from CookieCutter import CookieCutter
+
+    # parse job
+    jobscript = slurm_utils.parse_jobscript()
+    job_properties = read_job_properties(jobscript)
+
+    sbatch_config = slurm_utils.compile_cluster_config(CookieCutter.CLUSTER_CONFIG)
+    sbatch_options = slurm_utils.get_sbatch_options(job_properties, sbatch_config)
+
+    # lower mem and time requests according to the history of the rule
+    rule = slurm_utils.JobLog(job_properties).rule_name
+    history = slurm_history.open_history()
+    if history is not None:
+        slurm_history.harvest_detached(history)
+        sbatch_options = history.rightsize(rule, sbatch_options)
+
+    # ensure sbatch output dirs exist
+    for o in ("output", "error"):
+        slurm_utils.ensure_dirs_exist(sbatch_options[o]) if o in sbatch_options else None
+
+    jobid = slurm_utils.submit_job(jobscript, **sbatch_options)
+    if history is not None:
+        history.record(jobid, rule, sbatch_options)
+    logger.debug("Registering %s with sidecar...", jobid)
+    register_with_sidecar(jobid)
+    logger.debug("... done registering with sidecar")
+    return jobid
+
+
+jobid = None
+if SIDECAR_VARS and len(sys.argv) == 2:
+    try:
+        jobid = submit_with_sidecar(sys.argv[1])
+    except SidecarUnavailable as e:
+        logger.debug("slurm-submit.py: sidecar unavailable (%s), submitting directly", e)
+if jobid is None:
+    jobid = submit_direct()
+
+# echo id back to Snakemake (must be the only stdout)
 print(jobid)
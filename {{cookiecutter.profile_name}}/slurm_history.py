@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""History of finished jobs for right-sizing memory and time requests.
+
+Every submitted job is recorded with its rule and requested ``mem`` and
+``time`` in a SQLite database, by default
+``<workdir>/.snakemake/slurm-history.sqlite``.  The outcome of finished
+jobs (``State``, ``Elapsed`` and ``MaxRSS``) is collected from ``sacct``
+in batches, at most every ``HARVEST_INTERVAL`` seconds, off the submission
+path: by a background thread of the sidecar, or by a detached process
+started by ``slurm-submit.py`` (``python slurm_history.py <database>``).
+
+With ``SNAKEMAKE_SLURM_RIGHTSIZE=1``, the ``mem`` and ``time`` requests of a
+rule are lowered to a high quantile of the usage of its completed jobs plus
+a safety margin.  Requests are never raised, and are left as declared if
+the rule has fewer than ``SNAKEMAKE_SLURM_RIGHTSIZE_MIN_SAMPLES`` completed
+jobs or recently ran out of memory or time.
+"""
+import logging
+import math
+import os
+import re
+import sqlite3
+import subprocess as sp
+import sys
+import threading
+import time
+
+import slurm_retry
+import slurm_utils
+from CookieCutter import CookieCutter
+
+logger = logging.getLogger(__name__)
+
+#: Derive ``mem`` and ``time`` from the history of the rule.
+RIGHTSIZE = bool(int(os.environ.get("SNAKEMAKE_SLURM_RIGHTSIZE", "0")))
+#: Quantile of the usage of completed jobs to request.
+RIGHTSIZE_QUANTILE = float(os.environ.get("SNAKEMAKE_SLURM_RIGHTSIZE_QUANTILE", "0.95"))
+#: Factor applied to the quantile.
+RIGHTSIZE_MARGIN = float(os.environ.get("SNAKEMAKE_SLURM_RIGHTSIZE_MARGIN", "1.2"))
+#: Minimal number of completed jobs of a rule to derive requests from.
+RIGHTSIZE_MIN_SAMPLES = int(os.environ.get("SNAKEMAKE_SLURM_RIGHTSIZE_MIN_SAMPLES", "5"))
+#: Minimal ``mem`` in MB to request; Slurm reads ``--mem=0`` as all memory of the node.
+RIGHTSIZE_MIN_MEM = int(os.environ.get("SNAKEMAKE_SLURM_RIGHTSIZE_MIN_MEM", "100"))
+#: Path of the database, relative to the working directory.
+HISTORY_DB = os.environ.get(
+    "SNAKEMAKE_SLURM_HISTORY_DB", os.path.join(".snakemake", "slurm-history.sqlite")
+)
+#: Minimal seconds between two collections of job outcomes from sacct.
+HARVEST_INTERVAL = 60
+#: Number of recent jobs of a rule to derive requests from.
+WINDOW = 50
+
+#: States of finished jobs, as reported by sacct
+FINISHED_STATES = (
+    "BOOT_FAIL",
+    "CANCELLED",
+    "COMPLETED",
+    "DEADLINE",
+    "FAILED",
+    "NODE_FAIL",
+    "OUT_OF_MEMORY",
+    "PREEMPTED",
+    "TIMEOUT",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    jobid TEXT PRIMARY KEY,
+    rule TEXT NOT NULL,
+    submitted REAL NOT NULL,
+    req_mem_mb REAL,
+    req_minutes REAL,
+    state TEXT,
+    elapsed_minutes REAL,
+    max_rss_mb REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_rule ON jobs (rule, submitted);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);
+"""
+
+_slurm_jobid = re.compile(r"^\d+(_\d+)?$")
+
+
+def mem_to_mb(mem):
+    """Convert a memory request or ``MaxRSS`` value to MB, or return None."""
+    if mem is None or mem == "":
+        return None
+    mem = str(mem)
+    if mem.isdigit():
+        return float(mem)
+    if mem[-1] in "KMGT" and mem[:-1].replace(".", "", 1).isdigit():
+        return float(mem[:-1]) * {"K": 1e-3, "M": 1, "G": 1e3, "T": 1e6}[mem[-1]]
+    return None
+
+
+def elapsed_to_minutes(elapsed):
+    """Convert an ``Elapsed`` value like ``1-02:03:04`` to minutes."""
+    days, _, clock = elapsed.rpartition("-")
+    seconds = 0
+    for part in clock.split(":"):
+        seconds = seconds * 60 + float(part)
+    return int(days or 0) * 24 * 60 + seconds / 60
+
+
+def quantile(values, q):
+    """Return the nearest-rank quantile ``q`` of ``values``."""
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+class JobHistory:
+    """SQLite store of submitted jobs and their outcomes"""
+
+    def __init__(self, path, quantile=0.95, margin=1.2, min_samples=5, min_mem=100):
+        #: Path of the database.
+        self.path = path
+        #: Quantile of the usage to request.
+        self.quantile = quantile
+        #: Factor applied to the quantile.
+        self.margin = margin
+        #: Minimal number of completed jobs to derive requests from.
+        self.min_samples = min_samples
+        #: Minimal ``mem`` in MB to request.
+        self.min_mem = max(1, min_mem)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        #: Lock serializing the use of the connection by the threads of the sidecar.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.db.executescript(SCHEMA)
+
+    def record(self, jobid, rule, sbatch_options):
+        """Record a submitted job with its requested resources."""
+        if not _slurm_jobid.match(jobid):
+            return  # e.g. packed jobs, unknown to sacct
+        minutes = None
+        if "time" in sbatch_options:
+            minutes = slurm_utils.time_to_minutes(sbatch_options["time"])
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO jobs (jobid, rule, submitted, req_mem_mb, req_minutes) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (jobid, rule, time.time(), mem_to_mb(sbatch_options.get("mem")), minutes),
+            )
+
+    def claim_harvest(self, force=False):
+        """Whether a harvest is due, in which case it is claimed for the caller.
+
+        Harvests are due ``HARVEST_INTERVAL`` seconds after the previous one
+        of any process using the database.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'harvested'").fetchone()
+            if not force and row is not None and now - row[0] < HARVEST_INTERVAL:
+                return False
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('harvested', ?)", (now,))
+        return True
+
+    def harvest(self, force=False):
+        """Collect the outcome of finished jobs from sacct, if due or ``force``."""
+        if not self.claim_harvest(force):
+            return
+        with self.lock:
+            jobids = [
+                r[0]
+                for r in self.db.execute(
+                    "SELECT jobid FROM jobs WHERE state IS NULL AND submitted > ?",
+                    (time.time() - 30 * 24 * 3600,),
+                )
+            ]
+        for i in range(0, len(jobids), 500):
+            chunk = jobids[i : i + 500]
+            try:
+                outcomes = self._sacct(chunk)
+            except (sp.CalledProcessError, sp.TimeoutExpired) as e:
+                logger.debug("Could not collect job outcomes: %s", e)
+                return
+            with self.lock, self.db:
+                self.db.executemany(
+                    "UPDATE jobs SET state = ?, elapsed_minutes = ?, max_rss_mb = ? "
+                    "WHERE jobid = ?",
+                    [(s, e, m, j) for j, (s, e, m) in outcomes.items()],
+                )
+
+    def _sacct(self, jobids):
+        """Return dict mapping finished jobs to state, elapsed minutes and MaxRSS."""
+        cmd = ["sacct", "-P", "-n", "--format=JobID,State,Elapsed,MaxRSS", "-j", ",".join(jobids)]
+        cluster = CookieCutter.get_cluster_option()
+        if cluster:
+            cmd.append(cluster)
+        output = slurm_retry.RetryPolicy(max_tries=3).call(cmd, timeout=60)
+        return self.parse_sacct(output)
+
+    @staticmethod
+    def parse_sacct(output):
+        """Parse ``JobID|State|Elapsed|MaxRSS`` lines, taking MaxRSS over steps."""
+        outcomes = {}
+        max_rss = {}
+        for line in output.splitlines():
+            arr = line.strip().split("|")
+            if len(arr) < 4:
+                continue
+            jobid, _, step = arr[0].partition(".")
+            rss = mem_to_mb(arr[3])
+            if rss is not None:
+                max_rss[jobid] = max(rss, max_rss.get(jobid, 0))
+            state = arr[1].split()[0] if arr[1] else ""
+            if not step and state in FINISHED_STATES:
+                outcomes[jobid] = (state, elapsed_to_minutes(arr[2]))
+        return {j: (s, e, max_rss.get(j)) for j, (s, e) in outcomes.items()}
+
+    def rightsize(self, rule, sbatch_options):
+        """Return ``sbatch_options`` with ``mem`` and ``time`` derived from history."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT state, elapsed_minutes, max_rss_mb FROM jobs "
+                "WHERE rule = ? AND state IS NOT NULL ORDER BY submitted DESC LIMIT ?",
+                (rule, WINDOW),
+            ).fetchall()
+        states = {r[0] for r in rows}
+        completed = [r for r in rows if r[0] == "COMPLETED"]
+        if len(completed) < self.min_samples:
+            return sbatch_options
+        options = dict(sbatch_options)
+        declared = mem_to_mb(options.get("mem"))
+        usage = [r[2] for r in completed if r[2] is not None]
+        if declared and "OUT_OF_MEMORY" not in states and len(usage) >= self.min_samples:
+            mem = max(self.min_mem, math.ceil(quantile(usage, self.quantile) * self.margin))
+            if mem < declared:
+                logger.debug("Lowering mem of rule %s from %d to %d", rule, declared, mem)
+                options["mem"] = mem
+        declared = slurm_utils.time_to_minutes(options["time"]) if "time" in options else None
+        if declared and "TIMEOUT" not in states:
+            elapsed = quantile([r[1] for r in completed], self.quantile)
+            minutes = max(1, math.ceil(elapsed * self.margin))
+            if minutes < declared:
+                logger.debug("Lowering time of rule %s from %d to %d", rule, declared, minutes)
+                options["time"] = minutes
+        return options
+
+
+#: Dict mapping database paths to the opened ``JobHistory``.
+_histories = {}
+#: Lock protecting ``_histories``.
+_histories_lock = threading.Lock()
+
+
+def open_history(cwd=None):
+    """Return the ``JobHistory`` of the working directory if right-sizing is enabled.
+
+    The history is opened once per process and working directory.
+    """
+    if not RIGHTSIZE:
+        return None
+    path = os.path.join(os.path.abspath(cwd or os.getcwd()), HISTORY_DB)
+    with _histories_lock:
+        history = _histories.get(path)
+        if history is None:
+            history = _histories[path] = JobHistory(
+                path,
+                RIGHTSIZE_QUANTILE,
+                RIGHTSIZE_MARGIN,
+                RIGHTSIZE_MIN_SAMPLES,
+                RIGHTSIZE_MIN_MEM,
+            )
+    return history
+
+
+def harvest_all():
+    """Collect the outcome of finished jobs of all histories opened by the process."""
+    with _histories_lock:
+        histories = list(_histories.values())
+    for history in histories:
+        history.harvest()
+
+
+def harvest_detached(history):
+    """Collect the outcome of finished jobs in a detached process, if due."""
+    if not history.claim_harvest():
+        return
+    sp.Popen(
+        [sys.executable, os.path.abspath(__file__), history.path],
+        stdin=sp.DEVNULL,
+        stdout=sp.DEVNULL,
+        stderr=sp.DEVNULL,
+        start_new_session=True,
+    )
+
+
+if __name__ == "__main__":
+    JobHistory(sys.argv[1]).harvest(force=True)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Packing of short jobs into shared worker allocations.
+
+The sidecar queues short jobs in a spool directory per resource class,
+``<workdir>/.snakemake/slurm-pack/<class>``, instead of submitting them
+with ``sbatch``.  Worker allocations of that class, submitted by the
+sidecar, run ``WORKER_SCRIPT``: they claim queued jobs one at a time by
+moving them from ``queue/`` to ``run/``, and record the job state in
+``state/``.  A packed job has the external job ID ``pack-<class>-<n>``.
+
+This module only uses the standard library as it is imported by
+``slurm-status.py``.
+"""
+import os
+import re
+
+#: Prefix of the external job IDs of packed jobs
+PACK_PREFIX = "pack-"
+
+_packed_jobid = re.compile(r"^pack-([0-9a-f]+)-(\d+)$")
+
+WORKER_SCRIPT = """#!/bin/bash
+# Worker of packed Snakemake jobs: runs the jobs queued in the spool
+# directory one at a time until idle or out of time.  Only jobs whose
+# time limit fits into the rest of the allocation are claimed.
+spool=%(spool)s
+end=$((SECONDS + %(walltime_seconds)d))
+last=$SECONDS
+while [ $((SECONDS - last)) -lt %(idle)d ] && [ $SECONDS -lt $end ]; do
+    claimed=""
+    for job in "$spool"/queue/*.sh; do
+        [ -e "$job" ] || continue
+        seconds=$(sed -n 's/^seconds=//p' "$job")
+        [ $((SECONDS + ${seconds:-0})) -le $end ] || continue
+        id=$(basename "$job" .sh)
+        mv "$job" "$spool/run/$id.sh" 2>/dev/null || continue
+        claimed=$id
+        break
+    done
+    if [ -z "$claimed" ]; then
+        sleep 1
+        continue
+    fi
+    echo "RUNNING $SLURM_JOB_ID" > "$spool/state/$claimed"
+    "$spool/run/$claimed.sh"
+    case $? in
+        0) state=COMPLETED ;;
+        124) state=TIMEOUT ;;
+        *) state=FAILED ;;
+    esac
+    echo "$state $SLURM_JOB_ID" > "$spool/state/$claimed.tmp"
+    mv "$spool/state/$claimed.tmp" "$spool/state/$claimed"
+    last=$SECONDS
+done
+"""
+
+JOB_SCRIPT = """#!/bin/bash
+seconds=%(seconds)d
+cd %(cwd)s || exit 1
+exec timeout $seconds %(jobscript)s >> %(output)s 2>> %(error)s
+"""
+
+
+def is_packed_jobid(jobid):
+    """Whether ``jobid`` is the external job ID of a packed job."""
+    return jobid.startswith(PACK_PREFIX)
+
+
+def format_jobid(class_id, number):
+    """Return the external job ID of packed job ``number`` of a class."""
+    return "%s%s-%d" % (PACK_PREFIX, class_id, number)
+
+
+def parse_jobid(jobid):
+    """Return the class and number of a packed job ID."""
+    m = _packed_jobid.match(jobid)
+    if m is None:
+        raise ValueError("not a packed job ID: %s" % jobid)
+    return m.group(1), int(m.group(2))
+
+
+def spool_dir(cwd, class_id):
+    """Return the spool directory of a resource class."""
+    return os.path.join(cwd, ".snakemake", "slurm-pack", class_id)
+
+
+def job_name(number):
+    """Return the file name of packed job ``number`` in the spool."""
+    return "%06d" % number
+
+
+def read_state(jobid, cwd):
+    """Return the state and worker job ID of a packed job.
+
+    Jobs that are still queued are ``PENDING`` without a worker.
+    """
+    class_id, number = parse_jobid(jobid)
+    path = os.path.join(spool_dir(cwd, class_id), "state", job_name(number))
+    try:
+        with open(path) as fh:
+            state, _, worker = fh.read().strip().partition(" ")
+    except FileNotFoundError:
+        return "PENDING", None
+    return state, worker or None
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Retry policy for calls to Slurm commands.
+
+Errors reported by Slurm commands are classified as transient (the
+controller is busy or temporarily unreachable, or a submission limit is
+reached) or permanent (the request itself is invalid). Transient errors
+are retried with capped exponential backoff and full jitter, such that
+processes failing at the same time do not retry in lockstep. Permanent
+errors fail at once.
+
+This module only uses the standard library as it is imported by
+``slurm-status.py``.
+"""
+import logging
+import random
+import re
+import subprocess as sp
+import time
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT = "transient"
+LIMIT = "limit"
+PERMANENT = "permanent"
+UNKNOWN = "unknown"
+
+#: Errors of an overloaded or temporarily unreachable controller
+TRANSIENT_ERRORS = re.compile(
+    r"Socket timed out|Resource temporarily unavailable|"
+    r"Unable to contact slurm controller|slurmctld.*busy|Transport endpoint|"
+    r"Connection refused|Connection reset|Slurm backup controller in standby mode|"
+    r"Zero Bytes were transmitted or received|Slurmdbd connection",
+    re.IGNORECASE,
+)
+#: Errors of a reached submission limit, transient but lasting
+LIMIT_ERRORS = re.compile(r"MaxSubmitJob|QOSMaxSubmitJob|AssocMaxSubmitJob")
+#: Errors of invalid requests that retrying cannot fix
+PERMANENT_ERRORS = re.compile(
+    r"Invalid partition|Invalid account|Invalid qos|Invalid job id|"
+    r"Invalid generic resource|Invalid feature specification|"
+    r"Requested node configuration is not available|"
+    r"Requested time limit is invalid|Invalid user id|"
+    r"unrecognized option|invalid option|Invalid --",
+    re.IGNORECASE,
+)
+
+
+def classify_error(error):
+    """Classify the error output of a Slurm command."""
+    if not error:
+        return UNKNOWN
+    if LIMIT_ERRORS.search(error):
+        return LIMIT
+    if PERMANENT_ERRORS.search(error):
+        return PERMANENT
+    if TRANSIENT_ERRORS.search(error):
+        return TRANSIENT
+    return UNKNOWN
+
+
+class RetryPolicy:
+    """Capped exponential backoff with full jitter for classified errors"""
+
+    def __init__(self, max_tries=5, base_delay=0.5, max_delay=30.0, retry_unknown=True):
+        #: Maximal number of tries.
+        self.max_tries = max_tries
+        #: Backoff before the second try, doubled for every further try.
+        self.base_delay = base_delay
+        #: Upper bound of the backoff.
+        self.max_delay = max_delay
+        #: Whether errors that cannot be classified are retried.
+        self.retry_unknown = retry_unknown
+
+    def delay(self, try_num):
+        """Return the (random) seconds to wait after the failed ``try_num``."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (try_num - 1)))
+
+    def should_retry(self, error):
+        """Whether a call failing with output ``error`` should be retried."""
+        kind = classify_error(error)
+        if kind == UNKNOWN:
+            return self.retry_unknown
+        return kind != PERMANENT
+
+    def call(self, cmd, timeout=None, before_try=None, after_try=None, **kwargs):
+        """Run ``cmd`` and return its output, retrying transient failures.
+
+        ``before_try()`` is called before and ``after_try(seconds, error)``
+        after each try. Raises ``subprocess.CalledProcessError`` or
+        ``subprocess.TimeoutExpired`` of the last try.
+        """
+        try_num = 0
+        while True:
+            try_num += 1
+            if before_try is not None:
+                before_try()
+            start = time.time()
+            try:
+                logger.debug("Calling %s (try %d)", cmd, try_num)
+                proc = sp.run(
+                    cmd, capture_output=True, text=True, check=True, timeout=timeout, **kwargs
+                )
+            except sp.TimeoutExpired as e:
+                error, retry = "timeout", True
+                exc = e
+            except sp.CalledProcessError as e:
+                error, retry = e.stderr, self.should_retry(e.stderr)
+                exc = e
+            else:
+                if after_try is not None:
+                    after_try(time.time() - start, None)
+                return proc.stdout
+            if after_try is not None:
+                after_try(time.time() - start, error)
+            if not retry or try_num >= self.max_tries:
+                logger.debug("Call to %s failed (try %d of %d), giving up", cmd, try_num, self.max_tries)
+                raise exc
+            delay = self.delay(try_num)
+            logger.debug(
+                "Call to %s failed (try %d of %d), retrying in %.2fs: %s",
+                cmd,
+                try_num,
+                self.max_tries,
+                delay,
+                error.strip(),
+            )
+            time.sleep(delay)
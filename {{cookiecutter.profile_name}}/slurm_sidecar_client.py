@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Client of the cluster sidecar.
+
+Requests are sent over the Unix domain socket of the sidecar,
+``server_socket`` of its variables, if it has one and can be connected
+to, and otherwise over TCP to ``server_port``.  Only connection failures
+fall back to TCP, such that a request is never sent twice.  They raise
+``ConnectError``, which callers can tell from failures after the request
+may have been sent and processed.
+
+The sidecar answers with HTTP/1.0 and closes the connection after the
+response, so the client writes the request and reads the response up to
+the end of the stream instead of importing ``http.client``, which would
+take longer than the request itself.
+
+This module only uses the standard library as it is imported by
+``slurm-status.py`` and ``slurm-submit.py``, whose start-up time it keeps
+short.
+"""
+import json
+import logging
+import socket
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectError(ConnectionError):
+    """The sidecar cannot be reached, the request has not been sent."""
+
+
+def connect(sidecar_vars, timeout=None):
+    """Return a socket connected to the sidecar.
+
+    Raises ``ConnectError`` if the sidecar cannot be reached.
+    """
+    socket_path = sidecar_vars.get("server_socket")
+    if socket_path:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            return sock
+        except OSError as e:
+            sock.close()
+            logger.debug("Could not connect to %s, using TCP: %s", socket_path, e)
+    try:
+        return socket.create_connection(("localhost", sidecar_vars["server_port"]), timeout)
+    except OSError as e:
+        raise ConnectError(e) from e
+
+
+def request(sidecar_vars, method, path, body=None, timeout=None):
+    """Send a request to the sidecar, return the status and the body of the response.
+
+    ``body`` is sent as JSON.  Raises ``ConnectError`` if the sidecar cannot
+    be reached, and other ``OSError`` if the connection fails later on.
+    """
+    headers = ["Authorization: Bearer %s" % sidecar_vars["server_secret"]]
+    payload = b""
+    if body is not None:
+        payload = json.dumps(body).encode()
+        headers.append("Content-type: application/json")
+    headers.append("Content-Length: %d" % len(payload))
+    head = "%s %s HTTP/1.0\r\nHost: localhost\r\n%s\r\n\r\n" % (method, path, "\r\n".join(headers))
+    with connect(sidecar_vars, timeout=timeout) as sock:
+        sock.sendall(head.encode() + payload)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    response = b"".join(chunks)
+    head, sep, body = response.partition(b"\r\n\r\n")
+    status = head.split(b" ", 2)[1:2]
+    if not sep or not status or not status[0].isdigit():
+        raise ConnectionError("malformed response from sidecar: %r" % response[:80])
+    return int(status[0]), body
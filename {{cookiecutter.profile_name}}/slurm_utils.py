@@ -1,18 +1,32 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
+import fcntl
+import functools
+import hashlib
+import http.client
+import json
 import math
 import os
+import pickle
+import queue
 import re
 import subprocess as sp
 import sys
 from datetime import timedelta
 from os.path import dirname
+from time import sleep
 from time import time as unix_time
 from typing import Union
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
 from uuid import uuid4
 import shlex
+import stat
+import tempfile
 from io import StringIO
 
+import slurm_retry
 from CookieCutter import CookieCutter
 from snakemake import io
 from snakemake.exceptions import WorkflowError
@@ -22,6 +36,46 @@ from snakemake.utils import AlwaysQuotedFormatter
 from snakemake.utils import QuotedFormatter
 from snakemake.utils import SequenceFormatter
 
+RESOURCE_MAPPING = {
+    "time": ("time", "runtime", "walltime"),
+    "mem": ("mem", "mem_mb", "ram", "memory"),
+    "mem-per-cpu": ("mem-per-cpu", "mem_per_cpu", "mem_per_thread"),
+    "nodes": ("nodes", "nnodes"),
+    "partition": ("partition", "queue"),
+}
+
+#: File caching the compiled cluster configuration
+SBATCH_CACHE = os.path.join(dirname(__file__), ".sbatch_options.cache")
+
+# compiled cluster configurations of this process by cache key
+_compiled_configs = {}
+
+# directories known to exist, created or seen by this process
+_existing_dirs = set()
+
+#: Directory for state shared between the submitting processes of the user,
+#: only accessible by the user (see ``ensure_private_dir``)
+RUNTIME_DIR = os.environ.get(
+    "SNAKEMAKE_SLURM_RUNTIME_DIR",
+    os.path.join(
+        os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(),
+        f"snakemake-slurm-{os.getuid()}",
+    ),
+)
+#: Pace sbatch calls with the adaptive ``AdmissionController``
+ADMISSION_CONTROL = bool(int(os.environ.get("SNAKEMAKE_SLURM_ADMISSION", "0")))
+#: Upper bound of the admitted submissions per second
+ADMISSION_MAX_RATE = float(os.environ.get("SNAKEMAKE_SLURM_ADMISSION_MAX_RATE", "10"))
+#: Retry policy of sbatch calls; errors that cannot be classified are not
+#: retried as the job may have been submitted nevertheless
+SUBMIT_RETRY = slurm_retry.RetryPolicy(max_tries=5, max_delay=30.0, retry_unknown=False)
+#: Backend submitting and querying jobs, ``cli`` or ``rest`` (slurmrestd)
+BACKEND = os.environ.get("SNAKEMAKE_SLURM_BACKEND", "cli")
+#: URL of slurmrestd for the ``rest`` backend
+RESTD_URL = os.environ.get("SNAKEMAKE_SLURM_RESTD_URL", "http://localhost:6820")
+#: Version of the slurmrestd API
+RESTD_API = os.environ.get("SNAKEMAKE_SLURM_RESTD_API", "v0.0.38")
+
 
 def _convert_units_to_mb(memory):
     """If memory is specified with SI unit, convert to MB"""
@@ -73,6 +127,66 @@ def load_cluster_config(path):
     return dcc
 
 
+def compile_cluster_config(path):
+    """Compile sbatch defaults and cluster config to per-rule option bases.
+
+    Return a tuple of the options common to all jobs (sbatch defaults,
+    cluster option and ``__default__`` entry) and a dict with the options
+    of each rule. The result is cached in ``SBATCH_CACHE``, keyed by the
+    modification time and content hash of the cluster config, such that the
+    config is only parsed again after it has changed.
+    """
+    if not path:
+        return _compile_cluster_config(path)
+    source = os.path.join(dirname(__file__), os.path.expandvars(path))
+    key = (source, CookieCutter.SBATCH_DEFAULTS, CookieCutter.get_cluster_option())
+    st = os.stat(source)
+    cached = _compiled_configs.get(key)
+    if cached is None:
+        cached = _read_sbatch_cache(key)
+    if cached is not None and cached["mtime"] == (st.st_mtime_ns, st.st_size):
+        _compiled_configs[key] = cached
+        return cached["config"]
+    with open(source, "rb") as fh:
+        digest = hashlib.sha1(fh.read()).hexdigest()
+    if cached is None or cached["digest"] != digest:
+        cached = {"key": key, "digest": digest, "config": _compile_cluster_config(path)}
+    cached["mtime"] = (st.st_mtime_ns, st.st_size)
+    _compiled_configs[key] = cached
+    _write_sbatch_cache(cached)
+    return cached["config"]
+
+
+def _compile_cluster_config(path):
+    cluster_config = load_cluster_config(path)
+    base = {}
+    base.update(parse_sbatch_defaults(CookieCutter.SBATCH_DEFAULTS))
+    base.update(parse_sbatch_defaults(CookieCutter.get_cluster_option()))
+    base.update(cluster_config.pop("__default__"))
+    return base, cluster_config
+
+
+def _read_sbatch_cache(key):
+    """Return the cache entry in ``SBATCH_CACHE`` if it matches ``key``."""
+    try:
+        with open(SBATCH_CACHE, "rb") as fh:
+            cached = pickle.loads(fh.read())
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    return cached if cached.get("key") == key else None
+
+
+def _write_sbatch_cache(cached):
+    """Atomically replace ``SBATCH_CACHE``, profile may be read-only."""
+    try:
+        fd, tmp = tempfile.mkstemp(dir=dirname(SBATCH_CACHE), prefix=".sbatch_options.")
+        with os.fdopen(fd, "wb") as fh:
+            pickle.dump(cached, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, SBATCH_CACHE)
+    except OSError as e:
+        logger.debug(f"could not write {SBATCH_CACHE}: {e}")
+
+
 # adapted from format function in snakemake.utils
 def format(_pattern, _quote_all=False, **kwargs):  # noqa: A001
     """Format a pattern in Snakemake style.
@@ -87,53 +201,102 @@ def format(_pattern, _quote_all=False, **kwargs):  # noqa: A001
     try:
         return fmt.format(_pattern, **kwargs)
     except KeyError as ex:
-        raise NameError(
-            f"The name {ex} is unknown in this context. Please "
-            "make sure that you defined that variable. "
-            "Also note that braces not used for variable access "
-            "have to be escaped by repeating them "
-        )
+        raise _unknown_name_error(ex)
 
 
-#  adapted from Job.format_wildcards in snakemake.jobs
-def format_wildcards(string, job_properties):
-    """Format a string with variables from the job."""
+def _unknown_name_error(ex):
+    return NameError(
+        f"The name {ex} is unknown in this context. Please "
+        "make sure that you defined that variable. "
+        "Also note that braces not used for variable access "
+        "have to be escaped by repeating them "
+    )
 
-    class Job(object):
-        def __init__(self, job_properties):
-            for key in job_properties:
-                setattr(self, key, job_properties[key])
 
-    job = Job(job_properties)
+# formatter shared by all compiled templates
+_formatter = SequenceFormatter(separator=" ")
+_formatter.element_formatter = QuotedFormatter()
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_template(pattern):
+    """Parse a pattern once into its literal text and replacement fields.
+
+    Return None for patterns the compiled form does not support (positional
+    or nested fields), these are formatted by ``format``.
+    """
+    parts = []
+    for literal, field_name, format_spec, conversion in _formatter.parse(pattern):
+        if field_name is not None and (
+            field_name == "" or field_name[0].isdigit() or "{" in format_spec
+        ):
+            return None
+        parts.append((literal, field_name, format_spec, conversion))
+    return tuple(parts)
+
+
+def _format_template(parts, variables):
+    """Substitute ``variables`` into a pattern compiled by ``_compile_template``."""
+    result = []
+    for literal, field_name, format_spec, conversion in parts:
+        result.append(literal)
+        if field_name is None:
+            continue
+        try:
+            obj, _ = _formatter.get_field(field_name, (), variables)
+        except KeyError as ex:
+            raise _unknown_name_error(ex)
+        obj = _formatter.convert_field(obj, conversion)
+        result.append(_formatter.format_field(obj, format_spec))
+    return "".join(result)
+
+
+def _format_variables(job_properties):
+    """Return the variables available for formatting patterns of a job."""
+    _variables = dict(params=None, wildcards=None)
     if "params" in job_properties:
-        job._format_params = Wildcards(fromdict=job_properties["params"])
-    else:
-        job._format_params = None
+        _variables["params"] = Wildcards(fromdict=job_properties["params"])
     if "wildcards" in job_properties:
-        job._format_wildcards = Wildcards(fromdict=job_properties["wildcards"])
-    else:
-        job._format_wildcards = None
-    _variables = dict()
-    _variables.update(dict(params=job._format_params, wildcards=job._format_wildcards))
-    if hasattr(job, "rule"):
-        _variables.update(dict(rule=job.rule))
+        _variables["wildcards"] = Wildcards(fromdict=job_properties["wildcards"])
+    if "rule" in job_properties:
+        _variables["rule"] = job_properties["rule"]
+    return _variables
+
+
+#  adapted from Job.format_wildcards in snakemake.jobs
+def format_wildcards(string, job_properties, _variables=None):
+    """Format a string with variables from the job.
+
+    Patterns are compiled once and cached; strings without braces are
+    returned as is. ``_variables`` may pass the result of
+    ``_format_variables`` when formatting several strings of a job.
+    """
+    if "{" not in string and "}" not in string:
+        return string
+    if _variables is None:
+        _variables = _format_variables(job_properties)
+    parts = _compile_template(string)
+    jobid = job_properties.get("jobid")
     try:
-        return format(string, **_variables)
+        if parts is None:
+            return format(string, **_variables)
+        return _format_template(parts, _variables)
     except NameError as ex:
-        raise WorkflowError("NameError with group job {}: {}".format(job.jobid, str(ex)))
+        raise WorkflowError("NameError with group job {}: {}".format(jobid, str(ex)))
     except IndexError as ex:
-        raise WorkflowError("IndexError with group job {}: {}".format(job.jobid, str(ex)))
+        raise WorkflowError("IndexError with group job {}: {}".format(jobid, str(ex)))
 
 
 # adapted from ClusterExecutor.cluster_params function in snakemake.executor
 def format_values(dictionary, job_properties):
     formatted = dictionary.copy()
+    _variables = _format_variables(job_properties)
     for key, value in list(formatted.items()):
         if key == "mem":
             value = str(_convert_units_to_mb(value))
         if isinstance(value, str):
             try:
-                formatted[key] = format_wildcards(value, job_properties)
+                formatted[key] = format_wildcards(value, job_properties, _variables)
             except NameError as e:
                 msg = "Failed to format cluster config " "entry for job {}.".format(
                     job_properties["rule"]
@@ -168,16 +331,85 @@ def convert_job_properties(job_properties, resource_mapping=None):
     return options
 
 
+def get_sbatch_options(job_properties, sbatch_config):
+    """Resolve the sbatch options of a job.
+
+    ``sbatch_config`` is the result of ``compile_cluster_config``. Arguments
+    are set and overridden in the order documented in the README; the log
+    paths are relative to the submitting directory.
+    """
+    base, rules = sbatch_config
+
+    # 1) sbatch default arguments and cluster
+    # 2) cluster_config defaults
+    sbatch_options = dict(base)
+
+    # 3) Convert resources (no unit conversion!) and threads
+    sbatch_options.update(convert_job_properties(job_properties, RESOURCE_MAPPING))
+
+    # 4) cluster_config for particular rule
+    sbatch_options.update(rules.get(job_properties.get("rule"), {}))
+
+    # 5) cluster_config options
+    sbatch_options.update(job_properties.get("cluster", {}))
+
+    # convert human-friendly time - leaves slurm format time as is
+    if "time" in sbatch_options:
+        duration = str(sbatch_options["time"])
+        sbatch_options["time"] = str(Time(duration))
+
+    # 6) Format pattern in snakemake style
+    sbatch_options = format_values(sbatch_options, job_properties)
+
+    # 7) create output and error filenames and paths
+    joblog = JobLog(job_properties)
+    if "output" not in sbatch_options and CookieCutter.get_cluster_logpath():
+        sbatch_options["output"] = joblog.outlog
+
+    if (
+        "error" not in sbatch_options
+        and CookieCutter.get_cluster_logpath()
+        and not CookieCutter.get_cluster_logmerge()
+    ):
+        # without --error, slurm writes stderr to the output file
+        sbatch_options["error"] = joblog.errlog
+
+    # 8) Set slurm job name
+    if "job-name" not in sbatch_options and "job_name" not in sbatch_options:
+        sbatch_options["job-name"] = joblog.jobname
+
+    return sbatch_options
+
+
 def ensure_dirs_exist(path):
-    """Ensure output folder for Slurm log files exist."""
+    """Ensure output folder for Slurm log files exist.
+
+    Folders are only created (or checked) once per process.
+    """
     di = dirname(path)
-    if di == "":
+    if di == "" or di in _existing_dirs:
         return
-    if not os.path.exists(di):
-        os.makedirs(di, exist_ok=True)
+    os.makedirs(di, exist_ok=True)
+    _existing_dirs.add(di)
     return
 
 
+def ensure_private_dir(path):
+    """Create directory ``path`` accessible by the user only, unless it exists.
+
+    Raises ``PermissionError`` if ``path`` is not a directory owned by the
+    user and inaccessible to others, e.g. created by another user in a
+    shared temporary directory, as its files could then be planted or
+    replaced.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(
+            f"{path} must be a directory owned by the user and inaccessible to others"
+        )
+
+
 def format_sbatch_options(**sbatch_options):
     """Format sbatch options"""
     options = []
@@ -189,21 +421,431 @@ def format_sbatch_options(**sbatch_options):
     return options
 
 
-def submit_job(jobscript, **sbatch_options):
-    """Submit jobscript and return jobid."""
-    options = format_sbatch_options(**sbatch_options)
-    try:
-        cmd = ["sbatch"] + ["--parsable"] + options + [jobscript]
-        res = sp.check_output(cmd)
-    except sp.CalledProcessError as e:
-        raise e
-    # Get jobid
-    res = res.decode()
+def submit_job(jobscript, cwd=None, **sbatch_options):
+    """Submit jobscript with the configured backend and return jobid.
+
+    ``cwd`` is the directory to submit from and defaults to the current
+    working directory.
+    """
+    return get_backend().submit(jobscript, cwd=cwd, **sbatch_options)
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend():
+    """Return the backend selected by ``BACKEND``, shared by the process."""
+    if BACKEND == "cli":
+        return CliBackend()
+    if BACKEND == "rest":
+        return RestBackend(
+            RESTD_URL, os.environ.get("SLURM_JWT"), os.environ.get("USER"), RESTD_API
+        )
+    raise ValueError("unknown backend '%s', must be 'cli' or 'rest'" % BACKEND)
+
+
+def _admission_hooks():
+    """Return the hooks pacing submissions if ``ADMISSION_CONTROL`` is set."""
+    if not ADMISSION_CONTROL:
+        return {}
+    controller = AdmissionController()
+    return dict(before_try=controller.acquire, after_try=controller.record)
+
+
+class CliBackend:
+    """Submit jobs by calling ``sbatch``
+
+    The sidecar and ``slurm-status.py`` call ``squeue`` and ``sacct``
+    themselves to query job states, only ``RestBackend`` queries them.
+    """
+
+    def submit(self, jobscript, cwd=None, **sbatch_options):
+        """Submit jobscript with sbatch and return jobid.
+
+        Transient sbatch failures are retried according to ``SUBMIT_RETRY``.
+        If ``ADMISSION_CONTROL`` is set, the calls to sbatch are paced by the
+        shared ``AdmissionController``.
+        """
+        options = format_sbatch_options(**sbatch_options)
+        try:
+            cmd = ["sbatch"] + ["--parsable"] + options + [jobscript]
+            res = SUBMIT_RETRY.call(cmd, cwd=cwd, **_admission_hooks())
+        except sp.CalledProcessError as e:
+            sys.stderr.write(e.stderr)
+            raise e
+        # Get jobid
+        try:
+            jobid = re.search(r"(\d+)", res).group(1)
+        except Exception as e:
+            raise e
+        return jobid
+
+
+class SlurmRestError(Exception):
+    """Error response of slurmrestd."""
+
+
+class RestBackend:
+    """Submit and query jobs through the slurmrestd REST API.
+
+    Requests are sent over a small pool of keep-alive connections, such
+    that subsequent calls of a process (in particular the sidecar) do not
+    reconnect. The states of the queried jobs are fetched with one request
+    to slurmdbd, filtered on them.
+    """
+
+    #: Names of the job description fields differing from the sbatch options
+    FIELDS = {
+        "job-name": "name",
+        "output": "standard_output",
+        "error": "standard_error",
+        "time": "time_limit",
+        "ntasks": "tasks",
+        "mem": "memory_per_node",
+        "chdir": "current_working_directory",
+        "constraint": "constraints",
+    }
+
+    def __init__(self, url, token, user, api_version="v0.0.38", pool_size=4, timeout=30):
+        parts = urlsplit(url)
+        #: Connection class, HTTP or HTTPS.
+        self.connection_class = (
+            http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        )
+        #: Host and port of slurmrestd.
+        self.netloc = parts.netloc
+        #: Path prefix of the API.
+        self.prefix = parts.path.rstrip("/")
+        #: JSON web token to authenticate with.
+        self.token = token
+        #: Name of the user to act as.
+        self.user = user
+        #: Version of the API, e.g. ``v0.0.38``.
+        self.api_version = api_version
+        #: Timeout in seconds of the connections.
+        self.timeout = timeout
+        #: Idle connections for reuse.
+        self.pool = queue.LifoQueue(pool_size)
+
+    def _connection(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return self.connection_class(self.netloc, timeout=self.timeout)
+
+    def _release(self, conn):
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, method, path, body=None, **params):
+        """Send a request to slurmrestd and return the decoded response.
+
+        Raises ``SlurmRestError`` with the error messages of the response.
+        """
+        url = self.prefix + path
+        if params:
+            url += "?" + urlencode(params)
+        headers = {"Accept": "application/json", "X-SLURM-USER-NAME": self.user or ""}
+        if self.token:
+            headers["X-SLURM-USER-TOKEN"] = self.token
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        while True:
+            conn = self._connection()
+            reused = conn.sock is not None
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                if reused:
+                    continue  # idle connection closed by the server
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            break
+        try:
+            result = json.loads(data) if data else {}
+        except ValueError:
+            result = {"errors": [{"error": data.decode(errors="replace")}]}
+        errors = [
+            e.get("error") or e.get("description") or str(e) for e in result.get("errors") or ()
+        ]
+        if resp.status >= 400 or errors:
+            raise SlurmRestError(
+                "%s %s failed (%d): %s" % (method, path, resp.status, "; ".join(errors))
+            )
+        return result
+
+    def job_description(self, cwd=None, **sbatch_options):
+        """Convert sbatch options to a slurmrestd job description."""
+        job = {
+            "current_working_directory": os.path.abspath(cwd or os.getcwd()),
+            "environment": dict(os.environ),
+        }
+        for k, v in sbatch_options.items():
+            if k == "time":
+                v = time_to_minutes(v)
+            elif k in ("mem", "mem-per-cpu"):
+                v = _convert_units_to_mb(v)
+            job[self.FIELDS.get(k, k.replace("-", "_"))] = True if v is None else v
+        return job
+
+    def submit(self, jobscript, cwd=None, **sbatch_options):
+        """Submit jobscript through slurmrestd and return jobid.
+
+        Errors are retried as sbatch failures are, according to
+        ``SUBMIT_RETRY``, and paced by the ``AdmissionController`` if
+        ``ADMISSION_CONTROL`` is set.
+        """
+        with open(jobscript) as fh:
+            body = {"script": fh.read(), "job": self.job_description(cwd, **sbatch_options)}
+        path = "/slurm/%s/job/submit" % self.api_version
+        hooks = _admission_hooks()
+        try_num = 0
+        while True:
+            try_num += 1
+            if "before_try" in hooks:
+                hooks["before_try"]()
+            start = unix_time()
+            try:
+                result = self.request("POST", path, body)
+            except SlurmRestError as e:
+                error = str(e)
+                if "after_try" in hooks:
+                    hooks["after_try"](unix_time() - start, error)
+                if try_num >= SUBMIT_RETRY.max_tries or not SUBMIT_RETRY.should_retry(error):
+                    raise
+                sleep(SUBMIT_RETRY.delay(try_num))
+            else:
+                if "after_try" in hooks:
+                    hooks["after_try"](unix_time() - start, None)
+                return str(result["job_id"])
+
+    def job_states(self, jobids):
+        """Return dict mapping the given job IDs to their states.
+
+        The jobs are looked up in slurmdbd with a single request filtered on
+        them, like ``sacct -j``; only the jobs slurmdbd does not know yet are
+        requested from slurmctld, one at a time.  The jobs of the cluster are
+        never listed, slurmctld would send all of them.
+        """
+        states = {}
+        jobids = list(jobids)
+        if not jobids:
+            return states
+        try:
+            result = self.request(
+                "GET", "/slurmdb/%s/jobs" % self.api_version, step=",".join(jobids)
+            )
+        except SlurmRestError as e:
+            logger.debug(f"slurmdbd lookup of {len(jobids)} jobs failed: {e}")
+        else:
+            for job in result.get("jobs", ()):
+                for jobid in self._db_job_ids(job):
+                    if jobid in jobids:
+                        states[jobid] = self._state(job.get("state", {}).get("current"))
+        for jobid in jobids:
+            if jobid in states:
+                continue
+            try:
+                result = self.request("GET", "/slurm/%s/job/%s" % (self.api_version, jobid))
+            except SlurmRestError:
+                continue
+            for job in result.get("jobs", ()):
+                if jobid in self._job_ids(job):
+                    states[jobid] = self._state(job.get("job_state"))
+        return states
+
+    @staticmethod
+    def _state(state):
+        """Return the job state, of which newer API versions report a list."""
+        if isinstance(state, list):
+            return state[0] if state else None
+        return state
+
+    @staticmethod
+    def _number(value):
+        """Return a number that newer API versions wrap, or None if unset."""
+        if isinstance(value, dict):
+            return value.get("number") if value.get("set", True) else None
+        return value
+
+    @staticmethod
+    def _job_ids(job):
+        """Return the job IDs of a job record, one per task of job arrays."""
+        array_id = RestBackend._number(job.get("array_job_id"))
+        task_id = RestBackend._number(job.get("array_task_id"))
+        if array_id:
+            if task_id is not None:
+                return ["%s_%s" % (array_id, task_id)]
+            if job.get("array_task_string"):
+                return expand_array_jobid("%s_[%s]" % (array_id, job["array_task_string"]))
+        return [str(job["job_id"])]
+
+    @staticmethod
+    def _db_job_ids(job):
+        """Return the job IDs of a slurmdbd job record, like ``_job_ids``."""
+        array = job.get("array") or {}
+        array_id = RestBackend._number(array.get("job_id"))
+        task_id = RestBackend._number(array.get("task_id"))
+        if array_id:
+            if task_id is not None:
+                return ["%s_%s" % (array_id, task_id)]
+            if array.get("task"):
+                return expand_array_jobid("%s_[%s]" % (array_id, array["task"]))
+        return [str(job["job_id"])]
+
+
+class AdmissionController:
+    """Token bucket pacing the sbatch calls of all processes of the user.
+
+    The bucket is kept in a JSON file in ``RUNTIME_DIR`` that is locked
+    while read and updated, such that concurrent submit scripts and sidecars
+    share it. The rate increases additively while sbatch answers within
+    ``target_latency`` and is cut multiplicatively if sbatch is slow or fails
+    because the controller is busy. When a submission limit is hit, the
+    number of the user's queued jobs at that time is taken as the limit and
+    further submissions wait until ``squeue`` reports fewer queued jobs.
+    """
+
+    #: Seconds after which the learned queue limit is forgotten
+    limit_ttl = 3600
+    #: Seconds between ``squeue`` calls while waiting for the queue to drain
+    queue_check_interval = 30
+
+    def __init__(
+        self,
+        path=None,
+        min_rate=0.1,
+        max_rate=ADMISSION_MAX_RATE,
+        burst=5.0,
+        target_latency=2.0,
+    ):
+        self.path = path or os.path.join(RUNTIME_DIR, "admission.json")
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.target_latency = target_latency
+
+    @contextlib.contextmanager
+    def _state(self):
+        """Yield the shared state, holding the file lock."""
+        ensure_private_dir(dirname(self.path))
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "r+") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                state = json.load(fh)
+            except ValueError:
+                state = {}
+            now = unix_time()
+            state.setdefault("rate", self.max_rate / 2)
+            state.setdefault("tokens", self.burst)
+            state.setdefault("updated", now)
+            state.setdefault("queue_limit", None)
+            state.setdefault("queue_limit_time", 0.0)
+            state.setdefault("queued", 0)
+            state.setdefault("queued_checked", 0.0)
+            state["tokens"] = min(
+                self.burst, state["tokens"] + (now - state["updated"]) * state["rate"]
+            )
+            state["updated"] = now
+            if now - state["queue_limit_time"] > self.limit_ttl:
+                state["queue_limit"] = None
+            yield state
+            fh.seek(0)
+            fh.truncate()
+            json.dump(state, fh)
+
+    def acquire(self):
+        """Block until a submission is admitted.
+
+        While the learned queue limit is reached, one process at a time
+        calls ``squeue`` every ``queue_check_interval`` seconds, without
+        holding the lock.
+        """
+        while True:
+            check_queue = False
+            with self._state() as state:
+                now = state["updated"]
+                if state["queue_limit"] is not None and state["queued"] >= state["queue_limit"]:
+                    wait = self.queue_check_interval
+                    if now - state["queued_checked"] >= self.queue_check_interval:
+                        state["queued_checked"] = now
+                        check_queue = True
+                elif state["tokens"] >= 1:
+                    state["tokens"] -= 1
+                    state["queued"] += 1
+                    return
+                else:
+                    wait = (1 - state["tokens"]) / state["rate"]
+            if check_queue:
+                queued = _count_queued_jobs()
+                if queued is not None:
+                    with self._state() as state:
+                        state["queued"] = queued
+                continue
+            logger.debug(f"admission control: waiting {wait:.2f}s before sbatch")
+            sleep(wait)
+
+    def record(self, latency, error=None):
+        """Adapt the rate to the latency and error output of an sbatch call."""
+        kind = slurm_retry.classify_error(error)
+        # count the queued jobs before taking the lock, squeue may be slow
+        queued = _count_queued_jobs() if kind == slurm_retry.LIMIT else None
+        with self._state() as state:
+            if kind == slurm_retry.LIMIT:
+                if queued is not None:
+                    # a limit of no jobs would block all submissions until it expires
+                    state["queued"] = queued
+                    state["queue_limit"] = max(queued, 1)
+                    state["queued_checked"] = state["queue_limit_time"] = state["updated"]
+                state["rate"] = max(self.min_rate, state["rate"] / 2)
+            elif kind == slurm_retry.TRANSIENT or latency > self.target_latency:
+                state["rate"] = max(self.min_rate, state["rate"] / 2)
+                state["tokens"] = min(state["tokens"], 0.0)
+            elif not error:
+                state["rate"] = min(self.max_rate, state["rate"] + 0.1 * self.max_rate)
+
+
+def _count_queued_jobs(timeout=30):
+    """Return the number of pending and running jobs of the user or None.
+
+    None is also returned if ``squeue`` does not answer within ``timeout``
+    seconds.
+    """
+    cmd = ["squeue", "--user={}".format(os.environ.get("USER")), "--noheader", "--format=%i"]
+    cluster = CookieCutter.get_cluster_option()
+    if cluster:
+        cmd.append(cluster)
     try:
-        jobid = re.search(r"(\d+)", res).group(1)
-    except Exception as e:
-        raise e
-    return jobid
+        return len(sp.check_output(cmd, text=True, timeout=timeout).splitlines())
+    except (sp.CalledProcessError, sp.TimeoutExpired, OSError) as e:
+        logger.debug(f"admission control: could not count queued jobs: {e}")
+        return None
+
+
+def expand_array_jobid(jobid):
+    """Expand a job array ID like ``123_[0-3,7%2]`` to its task IDs.
+
+    Other job IDs are returned as single element list.
+    """
+    m = re.match(r"^(\d+)_\[([^\]]+)\]$", jobid)
+    if m is None:
+        return [jobid]
+    base, tasks = m.groups()
+    jobids = []
+    for part in tasks.split("%")[0].split(","):
+        part, _, step = part.partition(":")
+        start, _, end = part.partition("-")
+        for task in range(int(start), int(end or start) + 1, int(step or 1)):
+            jobids.append(f"{base}_{task}")
+    return jobids
 
 
 timeformats = [
@@ -349,6 +991,15 @@ class JobLog:
     def short_uid(self) -> str:
         return self.uid.split("-")[0]
 
+    @property
+    def uid_bucket(self) -> str:
+        return "{}/{}".format(self.uid[:2], self.uid[2:4])
+
+    @property
+    def jobid_bucket(self) -> str:
+        digest = hashlib.sha1(self.jobid.encode()).hexdigest()
+        return "{}/{}".format(digest[:2], digest[2:4])
+
     def pattern_replace(self, s: str) -> str:
         """
         %r - rule name. If group job, will use the group ID instead
@@ -357,6 +1008,8 @@ class JobLog:
         %U - a random universally unique identifier
         %S - shortened version od %U
         %T - Unix time, aka seconds since epoch (rounded to an integer)
+        %h - two levels of hex buckets derived from %U, e.g. '16/fd'
+        %H - two levels of hex buckets derived from %i
         """
         replacement = {
             "%r": self.rule_name,
@@ -365,6 +1018,8 @@ class JobLog:
             "%U": self.uid,
             "%T": str(int(unix_time())),
             "%S": self.short_uid,
+            "%h": self.uid_bucket,
+            "%H": self.jobid_bucket,
         }
         for old, new in replacement.items():
             s = s.replace(old, new)